@@ -0,0 +1,118 @@
+"""
+Memory-mapped frame store
+
+All frames of a directory in one file: a 4096-byte header (magic, version, frame count, height, width,
+channels) followed by the frames as a single uint8 array of shape (count, height, width, channels) in BGR
+order (FFmpeg pix_fmt bgr24). FFmpeg writes and reads the array directly as rawvideo, and services get any
+frame by index as a view of the mapping, without per-frame files, directory globs or image codecs.
+
+Same layout as realesrgan.utils.FrameStore, which the Real-ESRGAN CLI uses to read and write stores.
+"""
+
+import os
+import struct
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+# Frame format name of stores (FRAME_FORMAT=raw)
+STORE_FORMAT = "raw"
+# File name of the store of a frame directory
+STORE_NAME = "frames.raw"
+# FFmpeg pixel format of the stored frames
+STORE_PIX_FMT = "bgr24"
+
+HEADER_SIZE = 4096
+MAGIC = b"AUFRAMES"
+VERSION = 1
+# magic, version, frame count, height, width, channels
+_HEADER = struct.Struct("<8sIQIII")
+
+
+def store_path(directory: Path) -> Path:
+    """Path of the frame store of a frame directory"""
+    return directory / STORE_NAME
+
+
+class FrameStore:
+    """
+    Memory-mapped store of same-sized 8-bit BGR frames
+
+    Args:
+        path: Path of an existing store
+        writable: Map the frames for writing
+    """
+
+    def __init__(self, path: Path, writable: bool = False):
+        self.path = path
+        with path.open("rb") as f:
+            magic, version, count, height, width, channels = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a frame store: {path}")
+        self.shape = (height, width, channels)
+        self.frames = np.memmap(
+            path, dtype=np.uint8, mode="r+" if writable else "r", offset=HEADER_SIZE,
+            shape=(count, height, width, channels)
+        ) if count else np.zeros((0, height, width, channels), dtype=np.uint8)
+
+    @staticmethod
+    def create(path: Path, count: int, height: int, width: int, channels: int = 3) -> "FrameStore":
+        """
+        Create a store of count frames and map it for writing
+
+        The file is allocated up front, so that frames can be written in any order by several processes.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, count, height, width, channels).ljust(HEADER_SIZE, b"\0"))
+            size = HEADER_SIZE + count * height * width * channels
+            f.truncate(size)
+            allocate(f.fileno(), size)
+        return FrameStore(path, writable=True)
+
+    @staticmethod
+    def write_header(path: Path, count: int, height: int, width: int, channels: int = 3):
+        """Write the header of a store whose frames another program wrote, and trim the file to count frames"""
+        with path.open("r+b") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, count, height, width, channels))
+            f.truncate(HEADER_SIZE + count * height * width * channels)
+
+    @staticmethod
+    def open(directory: Path, writable: bool = False) -> Optional["FrameStore"]:
+        """The store of a frame directory, or None if it has none"""
+        path = store_path(directory)
+        if not path.exists():
+            return None
+        return FrameStore(path, writable=writable)
+
+    @property
+    def height(self) -> int:
+        return self.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.shape[1]
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.height * self.width * self.shape[2]
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """Frame by 0-based index, as a view of the mapping (writable if the store is)"""
+        return self.frames[index]
+
+    def flush(self):
+        if isinstance(self.frames, np.memmap):
+            self.frames.flush()
+
+
+def allocate(fd: int, size: int):
+    """Reserve the blocks of a file where the file system supports it, so that writes do not fail halfway"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        pass
@@ -5,12 +5,17 @@ import os
 import logging
 from .routes import router
 from .models.schemas import RootResponse, HealthResponse
+from .tracing import TraceContextFilter
+
+# Log records carry the trace and span ids of the job they were logged for
+log_handler = logging.StreamHandler()
+log_handler.addFilter(TraceContextFilter())
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [trace=%(trace_id)s span=%(span_id)s] %(message)s',
     handlers=[
-        logging.StreamHandler()
+        log_handler
     ]
 )
 
@@ -0,0 +1,218 @@
+"""
+Prometheus-style metrics for the enhancement pipeline
+
+Counters, gauges and histograms with labels, rendered in the Prometheus text exposition format by
+the /metrics endpoint. Kept in-house so the service has no extra dependency.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Default buckets for durations in seconds, from sub-second probes to hour-long enhancement runs
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Buckets for enhancement throughput in frames per second
+THROUGHPUT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    """Base class of labelled metrics"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+STAGE_DURATION = Histogram(
+    "anime_upscaler_stage_duration_seconds",
+    "Duration of each enhancement pipeline stage",
+    ["stage"]
+)
+STAGE_FAILURES = Counter(
+    "anime_upscaler_stage_failures_total",
+    "Enhancement pipeline stages that failed",
+    ["stage"]
+)
+ENHANCE_THROUGHPUT = Histogram(
+    "anime_upscaler_enhance_frames_per_second",
+    "Frames enhanced per second by each job, per engine",
+    ["engine"],
+    buckets=THROUGHPUT_BUCKETS
+)
+FRAMES_ENHANCED = Counter(
+    "anime_upscaler_frames_enhanced_total",
+    "Frames enhanced, per engine",
+    ["engine"]
+)
+FRAME_SECONDS = Histogram(
+    "anime_upscaler_frame_enhance_seconds",
+    "Time the enhancement engine spent on each frame, per engine (Real-ESRGAN engines only)",
+    ["engine"]
+)
+TEMP_BYTES_WRITTEN = Counter(
+    "anime_upscaler_temp_bytes_written_total",
+    "Bytes written to storage (not tmpfs) by the service and its child processes, per pipeline stage",
+    ["stage"]
+)
+JOBS_FINISHED = Counter(
+    "anime_upscaler_jobs_finished_total",
+    "Enhancement jobs that finished, per final status and kind (full or preview)",
+    ["status", "kind"]
+)
+QUEUE_DEPTH = Gauge(
+    "anime_upscaler_queue_depth",
+    "Jobs uploaded and waiting for the pipeline"
+)
+ACTIVE_JOBS = Gauge(
+    "anime_upscaler_active_jobs",
+    "Jobs running in the pipeline"
+)
+
+
+@contextmanager
+def track_stage(stage: str):
+    """
+    Time a pipeline stage into STAGE_DURATION; exceptions also count as a failure of the stage
+
+    Args:
+        stage: Stage name (probe, audio, extract, enhance, merge, optimize, ...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage)
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
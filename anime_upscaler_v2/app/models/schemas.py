@@ -17,6 +17,8 @@ class ModelEnum(str, Enum):
     test = "test"
     waifu2x = "waifu2x"
     esrgan = "esrgan"
+    esrgan_video = "esrgan_video"
+    auto = "auto"
 
 class ScaleEnum(int, Enum):
     """Available upscaling factors"""
@@ -42,6 +44,27 @@ class EnhanceVideoResponse(BaseModel):
     file_size: int = Field(..., description="File size in bytes")
     model: ModelEnum = Field(..., description="AI model used for enhancement")
     scale: ScaleEnum = Field(..., description="Upscaling factor")
+    denoise_strength: Optional[float] = Field(None, description="Real-ESRGAN denoise strength (0-1), if requested")
+    preview_job_id: Optional[str] = Field(None, description="Job identifier of the preview clip, if requested")
+    deadline_seconds: Optional[float] = Field(None, description="Requested turnaround time in seconds (auto only)")
+    profile: bool = Field(False, description="Whether the job is profiled")
+    stream_url: Optional[str] = Field(None, description="Live HLS playlist of the job, if requested")
+
+class StageResources(BaseModel):
+    """Resources used by a pipeline stage"""
+    wall_seconds: float = Field(..., description="Wall time in seconds")
+    cpu_seconds: float = Field(..., description="CPU seconds of the service process (shared by all jobs)")
+    peak_rss_bytes: int = Field(..., description="Peak RSS of the service process in bytes, sampled while the stage ran")
+    child_processes: int = Field(..., description="FFmpeg, waifu2x and Real-ESRGAN processes run")
+    child_cpu_seconds: float = Field(..., description="CPU seconds of the child processes")
+    child_peak_rss_bytes: int = Field(..., description="Largest peak RSS of a child process in bytes")
+    bytes_read: int = Field(..., description="Bytes read from storage, without page cache hits")
+    bytes_written: int = Field(..., description="Bytes written to storage; tmpfs-staged frames are not counted")
+
+class JobResources(BaseModel):
+    """Resources used by a job"""
+    stages: Dict[str, StageResources] = Field(..., description="Resources per pipeline stage")
+    total: StageResources = Field(..., description="Resources of the whole job (peak RSS: largest of the stages)")
 
 class JobStatusResponse(BaseModel):
     """Job status response"""
@@ -51,6 +74,19 @@ class JobStatusResponse(BaseModel):
     message: str = Field(..., description="Current status message")
     updated_at: Optional[str] = Field(None, description="Last update timestamp (ISO format)")
     estimated_completion: Optional[str] = Field(None, description="Estimated completion time (ISO format)")
+    parent_job_id: Optional[str] = Field(None, description="Job this preview was created for")
+    preview_job_id: Optional[str] = Field(None, description="Preview job of this job")
+    engine: Optional[str] = Field(None, description="Enhancement engine running the job")
+    engine_reason: Optional[str] = Field(None, description="Why the auto model chose the engine")
+    trace_id: Optional[str] = Field(None, description="Trace of the job in the trace spans file")
+    stream_url: Optional[str] = Field(None, description="Live HLS playlist of the job, if requested")
+    crop: Optional[Dict[str, int]] = Field(
+        None, description="Picture area enhanced without black bars: width, height, x, y, source_width, source_height"
+    )
+    resolution: Optional[Dict[str, float]] = Field(
+        None, description="Plan of a target resolution job: scale, factor, shrink, frame and output sizes"
+    )
+    resources: Optional[JobResources] = Field(None, description="Resources used so far, per stage and in total")
 
 class ModelInfo(BaseModel):
     """AI model information"""
@@ -58,6 +94,7 @@ class ModelInfo(BaseModel):
     description: str = Field(..., description="Model description")
     scales: List[int] = Field(..., description="Supported upscaling factors")
     optimal_for: str = Field(..., description="Content type this model is optimized for")
+    networks: Optional[Dict[int, str]] = Field(None, description="Network the model runs at each scale")
 
 class AvailableModelsResponse(BaseModel):
     """Available models response"""
@@ -87,6 +124,12 @@ class EnhanceVideoRequest(BaseModel):
     """Video enhancement request parameters"""
     model: ModelEnum = Field(ModelEnum.waifu2x, description="AI model to use for enhancement")
     scale: ScaleEnum = Field(ScaleEnum.x2, description="Upscaling factor")
+    denoise_strength: Optional[float] = Field(None, ge=0, le=1, description="Real-ESRGAN denoise strength (esrgan only)")
+    preview: bool = Field(False, description="Also create a short, low-resolution preview job that runs first")
+    preview_start: float = Field(0, ge=0, description="Start of the preview clip in seconds")
+    preview_seconds: float = Field(5, gt=0, le=30, description="Length of the preview clip in seconds")
+    deadline_seconds: Optional[float] = Field(None, gt=0, description="Turnaround target in seconds (auto only)")
+    profile: bool = Field(False, description="Capture a CPU, torch and memory profile of the job (admin only)")
     
     class Config:
         json_schema_extra = {
@@ -0,0 +1,163 @@
+"""
+Opt-in per-job profiling
+
+A sampling profiler of all Python threads (collapsed stacks, for flame graphs) and tracemalloc
+snapshots at the pipeline stage boundaries, written to a profile directory next to the job output.
+Only one job is profiled at a time, since tracemalloc is process-wide.
+"""
+
+import collections
+import logging
+import os
+import secrets
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Token that admin-only options (profile=true) must be sent with, in the X-Admin-Token header.
+# Profiling is disabled when it is not set.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Frames traced by the torch profiler inside Real-ESRGAN per profiled job
+TORCH_PROFILE_FRAMES = 3
+
+_PROFILE_LOCK = threading.Lock()
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Check an admin token against ADMIN_TOKEN, in constant time"""
+    if not ADMIN_TOKEN or token is None:
+        return False
+    return secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Sample the Python stacks of all other threads at a fixed interval
+
+    Args:
+        interval: Seconds between samples
+    """
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, path: Path):
+        """Write the samples as collapsed stacks (thread;outer;...;inner count), e.g. for flamegraph.pl"""
+        with path.open("w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class JobProfiler:
+    """
+    Profile one pipeline job
+
+    Args:
+        profile_dir: Directory for the profile artifacts
+        interval: Seconds between stack samples
+    """
+
+    def __init__(self, profile_dir: Path, interval: float = 0.01):
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.sampler = None
+        self.active = False
+        self._snapshots = 0
+        self._started_tracemalloc = False
+        self._start_time = None
+
+    def start(self) -> bool:
+        """
+        Start profiling
+
+        Returns:
+            bool: False if another job is being profiled, or if profiling could not be started
+        """
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            logger.warning(f"Another job is being profiled, not profiling {self.profile_dir}")
+            return False
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self._started_tracemalloc = True
+            self.sampler = SamplingProfiler(self.interval)
+            self.sampler.start()
+        except Exception as e:
+            # Leave the profiler free for the next job
+            logger.error(f"Could not start profiling {self.profile_dir}: {str(e)}")
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            self.sampler = None
+            _PROFILE_LOCK.release()
+            return False
+        self._start_time = time.perf_counter()
+        self.active = True
+        return True
+
+    def snapshot(self, stage: str):
+        """Dump a tracemalloc snapshot, and a summary of its top allocation sites, at the end of a stage"""
+        if not self.active:
+            return
+        self._snapshots += 1
+        name = f"tracemalloc_{self._snapshots:02d}_{stage}"
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(str(self.profile_dir / f"{name}.snapshot"))
+        current, peak = tracemalloc.get_traced_memory()
+        with (self.profile_dir / f"{name}.txt").open("w") as f:
+            f.write(f"stage: {stage}\n")
+            f.write(f"elapsed: {time.perf_counter() - self._start_time:.2f}s\n")
+            f.write(f"traced: {current / 1e6:.1f} MB, peak: {peak / 1e6:.1f} MB\n\n")
+            for stat in snapshot.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+
+    def stop(self) -> Optional[Path]:
+        """
+        Stop profiling and bundle the artifacts
+
+        Returns:
+            Path: Zip archive of the profile directory, or None if the job was not profiled
+        """
+        if not self.active:
+            return None
+        try:
+            self.sampler.stop()
+            self.sampler.write_collapsed(self.profile_dir / "cpu_samples.collapsed")
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            archive = shutil.make_archive(str(self.profile_dir), "zip", root_dir=str(self.profile_dir))
+            logger.info(f"Profile written to {archive}")
+            return Path(archive)
+        finally:
+            self.active = False
+            _PROFILE_LOCK.release()
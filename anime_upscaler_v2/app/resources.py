@@ -0,0 +1,299 @@
+"""
+Per-job resource accounting
+
+Wall time, CPU seconds and peak RSS per pipeline stage, for the service process and, separately, for the
+FFmpeg/waifu2x/Real-ESRGAN processes it starts, plus the bytes each stage read from and wrote to storage.
+Child processes are reaped with os.wait4 so that each one's own rusage is known. The service process is
+shared by all jobs, so its CPU seconds and peak RSS include whatever else ran during the stage. Its peak
+RSS is the largest of the VmRSS samples taken while the stage ran: resetting the process-wide peak
+(VmHWM) at every stage start would reset it for the stages of the other jobs as well.
+
+I/O is the read_bytes and write_bytes of /proc/<pid>/io: what actually went to or came from the block
+devices. Page cache hits, pipes and tmpfs (staged frames in /dev/shm) are not I/O. It is read from each
+child just before it is reaped, and, for the service process itself, from the thread that runs the stage.
+
+Configuration:
+    RSS_SAMPLE_SECONDS: Interval of the RSS samples of the service process while stages run (default: 0.1)
+"""
+
+import contextvars
+import json
+import os
+import re
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+_current_job = contextvars.ContextVar("current_job_usage", default=None)
+_current_stage = contextvars.ContextVar("current_stage_usage", default=None)
+
+RSS_SAMPLE_SECONDS = float(os.getenv("RSS_SAMPLE_SECONDS", "0.1"))
+
+
+def _cpu_seconds(usage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+def _rss() -> int:
+    """Current RSS of this process in bytes, or its peak RSS where /proc is unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            match = re.search(r"VmRSS:\s+(\d+) kB", f.read())
+        if match:
+            return int(match.group(1)) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _io_bytes(path: str) -> Tuple[int, int]:
+    """Bytes read from and written to storage by a task, from a /proc io file; zeros where unavailable"""
+    try:
+        with open(path) as f:
+            fields = dict(line.split(": ", 1) for line in f.read().splitlines() if ": " in line)
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class StageUsage:
+    """Resources used by one pipeline stage"""
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.child_processes = 0
+        self.child_cpu_seconds = 0.0
+        self.child_peak_rss_bytes = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def add_child(self, usage, bytes_read: int = 0, bytes_written: int = 0):
+        """Add the rusage and the I/O of a finished child process"""
+        with self._lock:
+            self.child_processes += 1
+            self.child_cpu_seconds += _cpu_seconds(usage)
+            self.child_peak_rss_bytes = max(self.child_peak_rss_bytes, usage.ru_maxrss * 1024)
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def add_rss(self, rss: int):
+        """Fold an RSS sample of the service process into the peak of the stage"""
+        with self._lock:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "wall_seconds": round(self.wall_seconds, 3),
+                "cpu_seconds": round(self.cpu_seconds, 3),
+                "peak_rss_bytes": self.peak_rss_bytes,
+                "child_processes": self.child_processes,
+                "child_cpu_seconds": round(self.child_cpu_seconds, 3),
+                "child_peak_rss_bytes": self.child_peak_rss_bytes,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+            }
+
+
+class RssSampler:
+    """
+    Samples the RSS of the service process into the stages that are running, from a daemon thread that
+    idles while no stage runs
+
+    Args:
+        interval: Seconds between samples
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stages: List[StageUsage] = []
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, usage: StageUsage):
+        """Sample into a stage until it is removed, starting with a sample now"""
+        usage.add_rss(_rss())
+        with self._condition:
+            self._stages.append(usage)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def remove(self, usage: StageUsage):
+        """Stop sampling into a stage, after a last sample"""
+        with self._condition:
+            self._stages.remove(usage)
+        usage.add_rss(_rss())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stages)
+                stages = list(self._stages)
+            rss = _rss()
+            for usage in stages:
+                usage.add_rss(rss)
+            time.sleep(self.interval)
+
+
+RSS_SAMPLER = RssSampler(RSS_SAMPLE_SECONDS)
+
+
+class JobUsage:
+    """Resources used by the stages of one job"""
+
+    def __init__(self):
+        self.stages: Dict[str, StageUsage] = {}
+        self._lock = threading.Lock()
+
+    def get_stage(self, stage: str) -> StageUsage:
+        with self._lock:
+            return self.stages.setdefault(stage, StageUsage())
+
+    def to_dict(self) -> dict:
+        """Usage per stage, and the total of the job (peak RSS is the largest of the stages)"""
+        with self._lock:
+            stages = {name: usage.to_dict() for name, usage in self.stages.items()}
+        total = StageUsage().to_dict()
+        for usage in stages.values():
+            for key, value in usage.items():
+                if key.endswith("peak_rss_bytes"):
+                    total[key] = max(total[key], value)
+                else:
+                    total[key] = round(total[key] + value, 3)
+        return {"stages": stages, "total": total}
+
+    def save(self, path: Path):
+        """Persist the usage as JSON next to the job output"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=2))
+
+
+@contextmanager
+def job_usage():
+    """
+    Account the stages run in this block to a job; nested blocks share the usage of the outer one
+
+    Yields:
+        JobUsage: The usage of the job
+    """
+    usage = _current_job.get()
+    if usage is not None:
+        yield usage
+        return
+    usage = JobUsage()
+    token = _current_job.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_job.reset(token)
+
+
+@contextmanager
+def track_stage(stage: str):
+    """
+    Measure wall time, CPU seconds, peak RSS and I/O of a stage of the current job, and of the child
+    processes it runs. Does nothing outside job_usage().
+
+    Args:
+        stage: Stage name
+    """
+    job = _current_job.get()
+    if job is None:
+        yield None
+        return
+    usage = job.get_stage(stage)
+    token = _current_stage.set(usage)
+    RSS_SAMPLER.add(usage)
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF))
+    # Only this thread: the process-wide counters include every other job and all reaped children
+    start_read, start_written = _io_bytes("/proc/thread-self/io")
+    try:
+        yield usage
+    finally:
+        _current_stage.reset(token)
+        RSS_SAMPLER.remove(usage)
+        end_read, end_written = _io_bytes("/proc/thread-self/io")
+        with usage._lock:
+            usage.wall_seconds += time.perf_counter() - start_wall
+            usage.cpu_seconds += _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF)) - start_cpu
+            usage.bytes_read += max(end_read - start_read, 0)
+            usage.bytes_written += max(end_written - start_written, 0)
+
+
+def wait(process: subprocess.Popen) -> int:
+    """
+    Wait for a child process with os.wait4 and account its rusage and I/O to the current stage
+
+    Use instead of process.wait(); the process must not have been waited for.
+
+    Returns:
+        int: The return code of the process
+    """
+    # Wait for the exit without reaping, so that the I/O counters of the child can still be read
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    bytes_read, bytes_written = _io_bytes(f"/proc/{process.pid}/io")
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    stage = _current_stage.get()
+    if stage is not None:
+        stage.add_child(usage, bytes_read, bytes_written)
+    return process.returncode
+
+
+def run(cmd, capture_output: bool = False, text: bool = False, timeout: Optional[float] = None,
+        check: bool = False, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run with the rusage and I/O of the child accounted to the current stage
+
+    Supports the capture_output, text, timeout and check arguments of subprocess.run; other keyword
+    arguments are passed to subprocess.Popen.
+    """
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    process = subprocess.Popen(cmd, text=text, **kwargs)
+    outputs = {}
+
+    def read(name, pipe):
+        outputs[name] = pipe.read()
+        pipe.close()
+
+    readers = [
+        threading.Thread(target=read, args=(name, pipe), daemon=True)
+        for name, pipe in (("stdout", process.stdout), ("stderr", process.stderr)) if pipe is not None
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill) if timeout is not None else None
+    if timer is not None:
+        timer.start()
+    try:
+        returncode = wait(process)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    for reader in readers:
+        reader.join()
+
+    stdout, stderr = outputs.get("stdout"), outputs.get("stderr")
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=stdout, stderr=stderr)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
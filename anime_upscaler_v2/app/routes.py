@@ -1,13 +1,17 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form, Header
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 import os
 import uuid
 import shutil
 from pathlib import Path
+from contextlib import contextmanager
+from typing import Optional
 import mimetypes
+import re
 import logging
 import json
 import threading
+import time
 
 logger = logging.getLogger(__name__)
 from datetime import datetime, timedelta
@@ -16,6 +20,15 @@ from .services.audio import AudioService
 from .services.frames import FrameService
 from .services.clarity import ClarityService
 from .services.merge import MergeService
+from .services.manifest import FrameManifest
+from .services.stream import SegmentEncoder, PLAYLIST_NAME
+from .framestore import STORE_FORMAT
+from . import metrics
+from . import profiling
+from . import resources
+from . import scheduler
+from . import staging
+from . import tracing
 from .models.schemas import (
     JobStatusEnum, ModelEnum, ScaleEnum,
     EnhanceVideoResponse, JobStatusResponse, AvailableModelsResponse,
@@ -35,6 +48,10 @@ OUTPUT_DIR = TEMP_DIR / "output"
 JOB_STATUS = {}
 JOB_LOCK = threading.Lock()
 
+# Preview clips are downscaled to at most this many lines before enhancement
+PREVIEW_MAX_HEIGHT = 360
+PREVIEW_MAX_SECONDS = 30
+
 def update_job_status(job_id: str, status: str, progress: float = 0, message: str = ""):
     """Update job status in thread-safe manner"""
     with JOB_LOCK:
@@ -48,6 +65,77 @@ def update_job_status(job_id: str, status: str, progress: float = 0, message: st
             "updated_at": datetime.now().isoformat()
         })
 
+def update_job_info(job_id: str, **info):
+    """Store extra job information next to its status in thread-safe manner"""
+    with JOB_LOCK:
+        JOB_STATUS.setdefault(job_id, {}).update(info)
+
+def is_cancelled(job_id: str) -> bool:
+    """Whether a job was cancelled, so that a pipeline that was already dequeued does not start"""
+    return get_job_status_info(job_id).get("status") == "cancelled"
+
+def job_kind(job_id: str) -> str:
+    """Kind of a job for the metrics: preview for the preview of another job, full otherwise"""
+    return "preview" if get_job_status_info(job_id).get("parent_job_id") else "full"
+
+def fail_job(job_id: str, stage: str, progress: float, message: str):
+    """Mark a job as failed at a pipeline stage and count the failure"""
+    metrics.STAGE_FAILURES.inc(stage=stage)
+    metrics.JOBS_FINISHED.inc(status="failed", kind=job_kind(job_id))
+    update_job_status(job_id, "failed", progress, message)
+    span = tracing.current_span()
+    if span is not None:
+        span.set_attributes(failed_stage=stage)
+        span.set_error(message)
+
+def link_preview_job(job_id: str, preview_job_id: str):
+    """Record a preview job and its parent job on each other"""
+    update_job_info(job_id, preview_job_id=preview_job_id)
+    update_job_info(preview_job_id, parent_job_id=job_id)
+
+def get_backlog_seconds(exclude_job_id: Optional[str] = None) -> float:
+    """
+    Estimated remaining enhancement time of the running jobs
+    
+    An auto job picks its engine when it starts, so the jobs still queued start after it and are not
+    counted; the time it waited behind earlier jobs is taken off its deadline instead. What is left is the
+    work of the jobs running alongside it (other full job workers and previews), which share the engines.
+    """
+    backlog = 0.0
+    with JOB_LOCK:
+        for job_id, info in JOB_STATUS.items():
+            if job_id == exclude_job_id or info.get("status") != "processing":
+                continue
+            backlog += info.get("estimated_seconds", 0) * (1 - info.get("progress", 0) / 100)
+    return backlog
+
+def job_span(job_id: str, name: str, **attributes):
+    """Span of a background job, continuing the trace of its upload when not already inside a span"""
+    trace = {}
+    if tracing.current_span() is None:
+        info = get_job_status_info(job_id)
+        trace = {"trace_id": info.get("trace_id"), "parent_id": info.get("trace_parent_id")}
+    return tracing.start_span(name, job_id=job_id, **trace, **attributes)
+
+@contextmanager
+def pipeline_stage(stage: str, **attributes):
+    """Time a pipeline stage into the stage metrics, account its resources to the job and trace it as a span"""
+    usage = None
+    written = 0
+    try:
+        with metrics.track_stage(stage), resources.track_stage(stage) as usage, \
+                tracing.start_span(stage, **attributes) as span:
+            written = usage.bytes_written if usage else 0
+            yield span
+    finally:
+        # The I/O of the stage is known once resources.track_stage has exited
+        if usage is not None:
+            metrics.TEMP_BYTES_WRITTEN.inc(usage.bytes_written - written, stage=stage)
+
+def stream_url(job_id: str) -> str:
+    """URL of the live HLS playlist of a job"""
+    return f"/stream/{job_id}/{PLAYLIST_NAME}"
+
 def get_job_status_info(job_id: str) -> dict:
     """Get job status in thread-safe manner"""
     with JOB_LOCK:
@@ -95,135 +183,418 @@ async def save_upload_file(upload_file: UploadFile, destination: Path) -> Path:
 
 def cleanup_files(job_id: str):
     """Background task to cleanup temporary files after processing"""
-    job_dir = PROCESSING_DIR / job_id
-    output_dir = OUTPUT_DIR / job_id
-    
     # Wait 24 hours before cleanup
     import time
     time.sleep(24 * 60 * 60)  # 24 hours
     
-    # Clean up processing directory
-    if job_dir.exists():
-        shutil.rmtree(job_dir, ignore_errors=True)
-    
-    # Clean up output directory
-    if output_dir.exists():
-        shutil.rmtree(output_dir, ignore_errors=True)
-    
-    # Remove from status tracking
-    with JOB_LOCK:
-        if job_id in JOB_STATUS:
-            del JOB_STATUS[job_id]
+    # The preview job of a job is cleaned up with it
+    preview_job_id = get_job_status_info(job_id).get("preview_job_id")
+    for cleanup_job_id in filter(None, [job_id, preview_job_id]):
+        job_dir = PROCESSING_DIR / cleanup_job_id
+        output_dir = OUTPUT_DIR / cleanup_job_id
+        
+        # Clean up processing directory
+        staging.STAGING.release(cleanup_job_id)
+        if job_dir.exists():
+            shutil.rmtree(job_dir, ignore_errors=True)
+        
+        # Clean up output directory
+        if output_dir.exists():
+            shutil.rmtree(output_dir, ignore_errors=True)
+        
+        # Remove from status tracking
+        with JOB_LOCK:
+            if cleanup_job_id in JOB_STATUS:
+                del JOB_STATUS[cleanup_job_id]
 
-async def enhance_video_pipeline(job_id: str, input_file: Path, model: str = "waifu2x", scale: int = 2):
+def enhance_video_pipeline(
+    job_id: str,
+    input_file: Path,
+    model: str = "waifu2x",
+    scale: int = 2,
+    denoise_strength: Optional[float] = None,
+    quality: str = "high",
+    optimize: bool = True,
+    profile: bool = False,
+    stream: bool = False,
+    crop: bool = True,
+    target_height: Optional[int] = None,
+    max_dimension: Optional[int] = None
+):
     """
     Main video enhancement pipeline
     
+    A plain function, run on a worker thread of the job scheduler: the stages block on FFmpeg and the
+    engines, and must not hold up the event loop that serves /status and /stream while the job runs.
+    
     Args:
         job_id: Unique job identifier
         input_file: Path to input video file
         model: AI model to use for enhancement
         scale: Upscaling factor
+        denoise_strength: Real-ESRGAN denoise strength (esrgan only)
+        quality: Encoder quality preset of the merge (high, medium, fast)
+        optimize: Re-encode the merged video to reduce its size
+        profile: Capture a CPU, torch and memory profile of the job
+        stream: Encode enhanced frames into a live HLS stream while the job runs
+        crop: Enhance only the picture inside black bars and pad the bars back in the merge
+        target_height: Output height; the engine scale is picked to reach it and scale is ignored
+        max_dimension: Largest output width or height, like target_height
     """
-    try:
-        job_dir = PROCESSING_DIR / job_id
-        output_dir = OUTPUT_DIR / job_id
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Initialize services
-        audio_service = AudioService()
-        frame_service = FrameService()
-        clarity_service = ClarityService()
-        merge_service = MergeService()
-        
-        update_job_status(job_id, "processing", 0, "Starting video enhancement pipeline")
-        
-        # Step 1: Get video information
-        video_info = frame_service.get_video_info(input_file)
-        if not video_info:
-            update_job_status(job_id, "failed", 0, "Failed to analyze video file")
-            return
-        
-        fps = video_info.get("fps", 24.0)
-        logger.info(f"Video info: {video_info}")
-        
-        # Step 2: Extract audio
-        update_job_status(job_id, "processing", 10, "Extracting audio track")
-        audio_file = job_dir / "audio.wav"
-        
-        if not audio_service.extract_audio(input_file, audio_file):
-            update_job_status(job_id, "failed", 10, "Failed to extract audio")
-            return
-        
-        # Step 3: Extract frames
-        update_job_status(job_id, "processing", 20, "Extracting video frames")
-        frames_dir = job_dir / "frames"
-        
-        if not frame_service.extract_frames(input_file, frames_dir, fps=fps):
-            update_job_status(job_id, "failed", 20, "Failed to extract frames")
-            return
-        
-        # Step 4: Enhance frames with AI
-        update_job_status(job_id, "processing", 30, f"Enhancing frames with {model}")
-        enhanced_frames_dir = job_dir / "enhanced_frames"
-        
-        def progress_callback(progress, completed, failed):
-            # Update progress from 30% to 80% during frame enhancement
-            overall_progress = 30 + (progress * 0.5)
+    if is_cancelled(job_id):
+        logger.info(f"Job {job_id} was cancelled before its pipeline started")
+        return
+    with job_span(job_id, "pipeline", model=getattr(model, "value", model), scale=scale) as span, \
+            resources.job_usage() as usage:
+        update_job_info(job_id, resources=usage)
+        profiler = profiling.JobProfiler(OUTPUT_DIR / job_id / "profile")
+        encoder = None
+        try:
+            model = getattr(model, "value", model)
+            job_dir = PROCESSING_DIR / job_id
+            output_dir = OUTPUT_DIR / job_id
+            output_dir.mkdir(parents=True, exist_ok=True)
+            
+            if profile:
+                profiler.start()
+            
+            # Initialize services
+            audio_service = AudioService()
+            frame_service = FrameService()
+            clarity_service = ClarityService()
+            merge_service = MergeService()
+            
+            update_job_status(job_id, "processing", 0, "Starting video enhancement pipeline")
+            
+            # Step 1: Get video information
+            with pipeline_stage("probe"):
+                video_info = frame_service.get_video_info(input_file)
+            profiler.snapshot("probe")
+            if not video_info:
+                fail_job(job_id, "probe", 0, "Failed to analyze video file")
+                return
+            
+            fps = video_info.get("fps", 24.0)
+            # The keyframe index is too long for the log
+            summary = {key: value for key, value in video_info.items() if key != "keyframes"}
+            logger.info(f"Video info: {summary}, {len(video_info.get('keyframes', []))} keyframes")
+            
+            frame_count = video_info.get("frame_count") or int(video_info.get("duration", 0) * fps)
+            width, height = video_info.get("width", 0), video_info.get("height", 0)
+            span.set_attributes(width=width, height=height, frame_count=frame_count, fps=fps)
+            
+            # Letterboxed and pillarboxed videos are enhanced without their black bars, so the size of
+            # the job is the size of the active area
+            crop_area = None
+            if crop:
+                with pipeline_stage("cropdetect"):
+                    crop_area = frame_service.detect_crop(input_file)
+                if crop_area:
+                    width, height = crop_area["width"], crop_area["height"]
+                    update_job_info(job_id, crop=crop_area)
+                    span.set_attributes(crop_width=width, crop_height=height)
+            
+            # With a target resolution the engine runs at the smallest scale that reaches it, on frames
+            # shrunk first if even that scale overshoots, and the merge resizes to the target
+            resolution = None
+            if target_height or max_dimension:
+                resolution = clarity_service.plan_resolution(
+                    model, video_info["width"], video_info["height"], target_height, max_dimension, crop=crop_area
+                )
+                scale = resolution["scale"]
+                width, height = resolution["frame_width"], resolution["frame_height"]
+                update_job_info(job_id, resolution=resolution)
+                span.set_attributes(scale=scale, output_width=resolution["output_width"],
+                                    output_height=resolution["output_height"])
+                logger.info(f"Resolution plan for job {job_id}: {resolution}")
+            
+            # Resolve the auto model now that the size of the job is known
+            engine_reason = None
+            if model == "auto":
+                job_info = get_job_status_info(job_id)
+                deadline = job_info.get("deadline_seconds")
+                if deadline is not None:
+                    deadline -= time.time() - job_info.get("submitted_at", time.time())
+                selection = clarity_service.select_engine(
+                    scale, frame_count, width, height,
+                    backlog_seconds=get_backlog_seconds(exclude_job_id=job_id),
+                    deadline_seconds=deadline
+                )
+                if not selection:
+                    fail_job(job_id, "probe", 0, f"No engine available for {scale}x")
+                    return
+                model, engine_reason = selection
+                logger.info(f"Auto model for job {job_id}: {engine_reason}")
+            
+            update_job_info(
+                job_id,
+                engine=model,
+                engine_reason=engine_reason,
+                estimated_seconds=clarity_service.estimate_seconds(model, scale, frame_count, width, height) or 0
+            )
+            span.set_attributes(model=model, engine_reason=engine_reason)
+            
+            # Place the frame directories in RAM or on disk, and reserve the disk space of the job before
+            # anything is extracted, so that a job too large for the disk fails now rather than halfway through
+            frame_format = clarity_service.input_frame_format(model)
+            output_format = clarity_service.output_frame_format(model, frame_format)
+            frames_bytes = staging.estimate_frames_bytes(frame_count, width, height, frame_format)
+            enhanced_bytes = staging.estimate_frames_bytes(frame_count, width * scale, height * scale, output_format)
+            frames_dir = staging.STAGING.allocate(job_id, "frames", frames_bytes, job_dir)
+            enhanced_frames_dir = staging.STAGING.allocate(job_id, "enhanced_frames", enhanced_bytes, job_dir)
+            # 16-bit stereo audio at 48 kHz, and an output of at most scale² times the input bitrate
+            output_factor = resolution["factor"] if resolution else scale
+            disk_bytes = int(video_info.get("duration", 0) * 192000) + input_file.stat().st_size * output_factor ** 2
+            for directory, estimated_bytes in ((frames_dir, frames_bytes), (enhanced_frames_dir, enhanced_bytes)):
+                if directory.parent == job_dir:
+                    disk_bytes += estimated_bytes
+            update_job_info(job_id, estimated_disk_bytes=disk_bytes)
+            
+            wait_start = time.monotonic()
+            try:
+                while not staging.STAGING.reserve_disk(job_id, disk_bytes, job_dir):
+                    if time.monotonic() - wait_start > staging.DISK_WAIT_SECONDS:
+                        fail_job(job_id, "quota", 0, "Not enough free disk space for the job")
+                        return
+                    update_job_status(job_id, "processing", 0, "Waiting for free disk space")
+                    time.sleep(10)
+            except staging.QuotaExceeded as e:
+                fail_job(job_id, "quota", 0, str(e))
+                return
+            
+            # Step 2: Extract audio
+            update_job_status(job_id, "processing", 10, "Extracting audio track")
+            audio_file = job_dir / "audio.wav"
+            
+            with pipeline_stage("audio"):
+                audio_ok = audio_service.extract_audio(input_file, audio_file)
+            profiler.snapshot("audio")
+            if not audio_ok:
+                fail_job(job_id, "audio", 10, "Failed to extract audio")
+                return
+            
+            # Step 3: Extract frames
+            update_job_status(job_id, "processing", 20, "Extracting video frames")
+            
+            # Image frames keep their source timestamps (in the frame manifest) and are merged with them;
+            # frame stores are read back at a constant rate, so they are converted to fps here
+            def extract(directory):
+                return frame_service.extract_frames(
+                    input_file,
+                    directory,
+                    fps=fps if frame_format == STORE_FORMAT else None,
+                    format=frame_format,
+                    crop=crop_area,
+                    size=(width, height) if resolution and resolution["shrink"] < 1.0 else None
+                )
+            
+            with pipeline_stage("extract"):
+                frames_ok = extract(frames_dir)
+                # A RAM-staged directory that filled its tmpfs after all is moved to disk and written again
+                frame_bytes = staging.estimate_frames_bytes(1, width, height, frame_format)
+                if not frames_ok and staging.STAGING.out_of_space(frames_dir, frame_bytes):
+                    frames_dir = staging.STAGING.spill(job_id, frames_dir, job_dir)
+                    frames_ok = extract(frames_dir)
+            profiler.snapshot("extract")
+            if not frames_ok:
+                fail_job(job_id, "extract", 20, "Failed to extract frames")
+                return
+            
+            # Step 4: Enhance frames with AI
+            update_job_status(job_id, "processing", 30, f"Enhancing frames with {model}")
+            enhanced = {"completed": 0, "failed": 0}
+            
+            def progress_callback(progress, completed, failed):
+                enhanced["completed"] = completed
+                enhanced["failed"] = failed
+                # Update progress from 30% to 80% during frame enhancement
+                overall_progress = 30 + (progress * 0.5)
+                update_job_status(
+                    job_id, 
+                    "processing", 
+                    overall_progress, 
+                    f"Enhanced {completed} frames, {failed} failed"
+                )
+            
+            def engine_event(event):
+                if event["event"] == "tile":
+                    # Progress within the frame, so that a slow frame does not look like a hung job
+                    progress = (event["index"] + event["done"] / event["total"]) / event["frames"] * 100
+                    update_job_status(
+                        job_id,
+                        "processing",
+                        30 + (progress * 0.5),
+                        f"Enhanced {enhanced['completed']} frames, {enhanced['failed']} failed; "
+                        f"frame {event['index'] + 1}: tile {event['done']}/{event['total']}"
+                    )
+                elif event["event"] == "frame":
+                    metrics.FRAME_SECONDS.observe(event["seconds"], engine=model)
+            
+            output_size = (resolution["output_width"], resolution["output_height"]) if resolution else None
+            enhance_start = time.perf_counter()
+            with pipeline_stage("enhance") as enhance_span:
+                if stream:
+                    # Finished frames are encoded into HLS segments while the rest is enhanced
+                    encoder = SegmentEncoder(
+                        enhanced_frames_dir,
+                        audio_file,
+                        output_dir / "hls",
+                        frame_count=frame_service.count_frames(frames_dir, frame_format),
+                        fps=fps,
+                        format=output_format,
+                        crop=crop_area,
+                        size=output_size,
+                        # Variable frame rate sources are streamed with the timestamps the merge uses
+                        manifest=FrameManifest.load(frames_dir)
+                        if frame_service.uses_timestamps(frames_dir, frame_format) else None
+                    )
+                    encoder.start()
+                def enhance(directory):
+                    return clarity_service.enhance_frames_batch(
+                        frames_dir,
+                        directory,
+                        model=model,
+                        scale=scale,
+                        max_workers=1,
+                        progress_callback=progress_callback,
+                        denoise_strength=denoise_strength,
+                        frame_format=frame_format,
+                        profile_dir=profiler.profile_dir if profiler.active else None,
+                        profile_frames=profiling.TORCH_PROFILE_FRAMES,
+                        event_callback=engine_event,
+                        frame_callback=encoder.frame_done if encoder else None
+                    )
+                
+                enhance_ok = enhance(enhanced_frames_dir)
+                enhanced_frame_bytes = staging.estimate_frames_bytes(1, width * scale, height * scale, output_format)
+                if not enhance_ok and staging.STAGING.out_of_space(enhanced_frames_dir, enhanced_frame_bytes):
+                    enhanced_frames_dir = staging.STAGING.spill(job_id, enhanced_frames_dir, job_dir)
+                    if encoder:
+                        encoder.frames_dir = enhanced_frames_dir
+                    enhance_ok = enhance(enhanced_frames_dir)
+                enhance_span.set_attributes(frames_enhanced=enhanced["completed"], frames_failed=enhanced["failed"])
+            enhance_seconds = time.perf_counter() - enhance_start
+            profiler.snapshot("enhance")
+            metrics.FRAMES_ENHANCED.inc(enhanced["completed"], engine=model)
+            if enhanced["completed"] and enhance_seconds > 0:
+                metrics.ENHANCE_THROUGHPUT.observe(enhanced["completed"] / enhance_seconds, engine=model)
+            if not enhance_ok:
+                fail_job(job_id, "enhance", 50, "Failed to enhance frames")
+                return
+            
+            if encoder:
+                update_job_status(job_id, "processing", 80, "Encoding the last stream segments")
+                with pipeline_stage("stream"):
+                    stream_ok = encoder.finish()
+                if not stream_ok:
+                    # Not fatal, the MP4 is still produced
+                    metrics.STAGE_FAILURES.inc(stage="stream")
+            
+            # Step 5: Merge enhanced frames with audio
+            update_job_status(job_id, "processing", 80, "Merging enhanced video with audio")
+            output_video = output_dir / "enhanced.mp4"
+            
+            with pipeline_stage("merge"):
+                merge_ok = merge_service.merge_frames_and_audio(
+                    enhanced_frames_dir,
+                    audio_file,
+                    output_video,
+                    fps=fps,
+                    quality=quality,
+                    format=output_format,
+                    crop=crop_area,
+                    size=output_size
+                )
+            profiler.snapshot("merge")
+            if not merge_ok:
+                fail_job(job_id, "merge", 80, "Failed to merge video and audio")
+                return
+            
+            # Step 6: Optimize final video
+            update_job_status(job_id, "processing", 90, "Optimizing final video")
+            optimized_video = output_dir / "enhanced_optimized.mp4"
+            
+            if optimize:
+                with pipeline_stage("optimize"):
+                    optimize_ok = merge_service.optimize_video(output_video, optimized_video)
+                profiler.snapshot("optimize")
+                if optimize_ok:
+                    # Replace original with optimized version
+                    output_video.unlink()
+                    optimized_video.rename(output_video)
+                else:
+                    # Not fatal, the unoptimized video is kept
+                    metrics.STAGE_FAILURES.inc(stage="optimize")
+            
+            # Success!
+            file_size = output_video.stat().st_size
             update_job_status(
                 job_id, 
-                "processing", 
-                overall_progress, 
-                f"Enhanced {completed} frames, {failed} failed"
+                "completed", 
+                100, 
+                f"Enhancement completed. Output file size: {file_size / 1024 / 1024:.1f} MB"
             )
+            metrics.JOBS_FINISHED.inc(status="completed", kind=job_kind(job_id))
+            
+            logger.info(f"Enhancement pipeline completed for job {job_id}")
         
-        if not clarity_service.enhance_frames_batch(
-            frames_dir, 
-            enhanced_frames_dir, 
-            model=model, 
-            scale=scale,
-            max_workers=1,
-            progress_callback=progress_callback
-        ):
-            update_job_status(job_id, "failed", 50, "Failed to enhance frames")
-            return
-        
-        # Step 5: Merge enhanced frames with audio
-        update_job_status(job_id, "processing", 80, "Merging enhanced video with audio")
-        output_video = output_dir / "enhanced.mp4"
+        except Exception as e:
+            logger.error(f"Enhancement pipeline failed for job {job_id}: {str(e)}")
+            metrics.JOBS_FINISHED.inc(status="failed", kind=job_kind(job_id))
+            update_job_status(job_id, "failed", 0, f"Pipeline error: {str(e)}")
+            span.set_error(f"Pipeline error: {str(e)}")
+        finally:
+            if encoder and encoder.is_alive():
+                encoder.stop()
+            profile_archive = profiler.stop()
+            if profile_archive:
+                update_job_info(job_id, profile_archive=str(profile_archive))
+            usage.save(OUTPUT_DIR / job_id / "resources.json")
+            # Staged frames only live as long as the pipeline
+            staging.STAGING.release(job_id)
+
+def enhance_preview_pipeline(
+    job_id: str,
+    input_file: Path,
+    model: str = "waifu2x",
+    scale: int = 2,
+    denoise_strength: Optional[float] = None,
+    start: float = 0.0,
+    seconds: float = 5.0,
+    crop: bool = True
+):
+    """
+    Preview pipeline: enhance a short, downscaled clip of the input with the job settings
+    
+    Args:
+        job_id: Preview job identifier
+        input_file: Path to the input video file of the parent job
+        model: AI model to use for enhancement
+        scale: Upscaling factor
+        denoise_strength: Real-ESRGAN denoise strength (esrgan only)
+        start: Start of the clip in seconds
+        seconds: Length of the clip in seconds
+        crop: Enhance only the picture inside black bars, as in the full job
+    """
+    if is_cancelled(job_id):
+        logger.info(f"Preview job {job_id} was cancelled before its pipeline started")
+        return
+    with job_span(job_id, "preview", model=getattr(model, "value", model), scale=scale, preview_start=start,
+                  preview_seconds=seconds), resources.job_usage() as usage:
+        update_job_info(job_id, resources=usage)
+        update_job_status(job_id, "processing", 0, "Extracting preview clip")
+        clip_file = PROCESSING_DIR / job_id / "input.mp4"
         
-        if not merge_service.merge_frames_and_audio(
-            enhanced_frames_dir,
-            audio_file,
-            output_video,
-            fps=fps
-        ):
-            update_job_status(job_id, "failed", 80, "Failed to merge video and audio")
+        with pipeline_stage("preview_clip"):
+            clip_ok = FrameService.extract_clip(input_file, clip_file, start, seconds, max_height=PREVIEW_MAX_HEIGHT)
+        if not clip_ok:
+            fail_job(job_id, "preview_clip", 0, "Failed to extract preview clip")
             return
         
-        # Step 6: Optimize final video
-        update_job_status(job_id, "processing", 90, "Optimizing final video")
-        optimized_video = output_dir / "enhanced_optimized.mp4"
-        
-        if merge_service.optimize_video(output_video, optimized_video):
-            # Replace original with optimized version
-            output_video.unlink()
-            optimized_video.rename(output_video)
-        
-        # Success!
-        file_size = output_video.stat().st_size
-        update_job_status(
-            job_id, 
-            "completed", 
-            100, 
-            f"Enhancement completed. Output file size: {file_size / 1024 / 1024:.1f} MB"
+        # The preview is only watched once, so merge with the fast preset and skip the optimization pass
+        enhance_video_pipeline(
+            job_id, clip_file, model, scale, denoise_strength, quality="fast", optimize=False, crop=crop
         )
-        
-        logger.info(f"Enhancement pipeline completed for job {job_id}")
-        
-    except Exception as e:
-        logger.error(f"Enhancement pipeline failed for job {job_id}: {str(e)}")
-        update_job_status(job_id, "failed", 0, f"Pipeline error: {str(e)}")
 
 @router.post("/enhance_video/", 
             response_model=EnhanceVideoResponse,
@@ -241,7 +612,28 @@ async def enhance_video(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(..., description="Video file to enhance (MP4, AVI, MOV, MKV, WebM - max 100MB)"),
     model: ModelEnum = Form(ModelEnum.waifu2x, description="AI model to use for enhancement"),
-    scale: ScaleEnum = Form(ScaleEnum.x2, description="Upscaling factor")
+    scale: ScaleEnum = Form(ScaleEnum.x2, description="Upscaling factor"),
+    denoise_strength: Optional[float] = Form(
+        None, ge=0, le=1, description="Real-ESRGAN denoise strength, 0 keeps noise and 1 removes it (esrgan only)"
+    ),
+    preview: bool = Form(False, description="Also create a short, low-resolution preview job that runs first"),
+    preview_start: float = Form(0, ge=0, description="Start of the preview clip in seconds"),
+    preview_seconds: float = Form(
+        5, gt=0, le=PREVIEW_MAX_SECONDS, description="Length of the preview clip in seconds"
+    ),
+    deadline_seconds: Optional[float] = Form(
+        None, gt=0, description="Turnaround target in seconds; the auto model picks a faster engine to meet it"
+    ),
+    profile: bool = Form(False, description="Capture a CPU, torch and memory profile of the job (admin only)"),
+    stream: bool = Form(False, description="Serve the video as a live HLS stream while it is enhanced"),
+    crop: bool = Form(True, description="Enhance only the picture inside black bars (letterbox, pillarbox)"),
+    target_height: Optional[int] = Form(
+        None, gt=0, description="Output height; the smallest engine scale that reaches it is used instead of scale"
+    ),
+    max_dimension: Optional[int] = Form(
+        None, gt=0, description="Largest output width or height; the engine scale is picked as for target_height"
+    ),
+    x_admin_token: Optional[str] = Header(None, description="Admin token, required for profile=true")
 ):
     """
     Upload and enhance anime video
@@ -250,12 +642,26 @@ async def enhance_video(
         file: Video file to enhance
         model: AI model to use (waifu2x, esrgan)
         scale: Upscaling factor (2, 4)
+        denoise_strength: Real-ESRGAN denoise strength (esrgan only)
+        preview: Also create a preview job for a short clip of the video
+        preview_start: Start of the preview clip in seconds
+        preview_seconds: Length of the preview clip in seconds
+        deadline_seconds: Turnaround target in seconds (auto only)
+        profile: Capture a profile of the job, downloadable from /profile/{job_id} (admin only)
+        stream: Serve the video as a live HLS stream from /stream/{job_id}/playlist.m3u8
+        crop: Detect black bars, enhance only the picture inside them and pad them back
+        target_height: Output height (replaces scale)
+        max_dimension: Largest output width or height (replaces scale)
+        x_admin_token: Admin token
     
     Returns:
         Job information for tracking enhancement progress
     """
     ensure_directories()
     
+    if profile and not profiling.is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="profile=true requires a valid X-Admin-Token")
+    
     # Validate file
     if not validate_video_file(file):
         raise HTTPException(
@@ -284,47 +690,93 @@ async def enhance_video(
             detail=f"Model '{model}' not available. Available models: {list(available_models.keys())}"
         )
     
-    if scale not in available_models[model]["scales"]:
+    if target_height is None and max_dimension is None and scale not in available_models[model]["scales"]:
         raise HTTPException(
             status_code=400,
             detail=f"Scale {scale} not supported for model '{model}'. Supported scales: {available_models[model]['scales']}"
         )
     
-    # Generate unique job ID
-    job_id = str(uuid.uuid4())
-    
-    # Create job directory
-    job_dir = PROCESSING_DIR / job_id
-    job_dir.mkdir(exist_ok=True)
-    
-    # Save uploaded file
-    file_extension = Path(file.filename).suffix if file.filename else ".mp4"
-    input_file = job_dir / f"input{file_extension}"
-    
-    try:
-        await save_upload_file(file, input_file)
-    except Exception as e:
-        shutil.rmtree(job_dir, ignore_errors=True)
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    # Initialize job status
-    update_job_status(job_id, "uploaded", 0, "Video uploaded successfully")
+    if denoise_strength is not None and model != ModelEnum.esrgan:
+        raise HTTPException(
+            status_code=400,
+            detail="denoise_strength is only supported for the 'esrgan' model"
+        )
     
-    # Start enhancement pipeline in background
-    background_tasks.add_task(enhance_video_pipeline, job_id, input_file, model, scale.value)
+    if deadline_seconds is not None and model != ModelEnum.auto:
+        raise HTTPException(
+            status_code=400,
+            detail="deadline_seconds is only supported for the 'auto' model"
+        )
     
-    # Schedule cleanup after 24 hours
-    background_tasks.add_task(cleanup_files, job_id)
+    # Generate unique job ID
+    job_id = str(uuid.uuid4())
     
-    return EnhanceVideoResponse(
-        message="Video upload successful, enhancement started",
-        job_id=job_id,
-        status=JobStatusEnum.uploaded,
-        filename=file.filename or "unknown",
-        file_size=file_size,
-        model=model,
-        scale=scale
-    )
+    # The upload span starts the trace of the job, its background pipelines continue it
+    with tracing.start_span(
+        "upload", job_id=job_id, model=model.value, scale=scale.value, file_size=file_size, filename=file.filename
+    ) as span:
+        # Create job directory
+        job_dir = PROCESSING_DIR / job_id
+        job_dir.mkdir(exist_ok=True)
+        
+        # Save uploaded file
+        file_extension = Path(file.filename).suffix if file.filename else ".mp4"
+        input_file = job_dir / f"input{file_extension}"
+        
+        try:
+            await save_upload_file(file, input_file)
+        except Exception as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise HTTPException(status_code=500, detail=str(e))
+        # The upload is written by the event loop, outside of the stages of the job
+        metrics.TEMP_BYTES_WRITTEN.inc(file_size, stage="upload")
+        
+        # Initialize job status
+        update_job_status(job_id, "uploaded", 0, "Video uploaded successfully")
+        update_job_info(
+            job_id, submitted_at=time.time(), deadline_seconds=deadline_seconds,
+            trace_id=span.trace_id, trace_parent_id=span.span_id, stream_url=stream_url(job_id) if stream else None
+        )
+        
+        # Previews run on their own worker and full jobs wait for the previews submitted before them, so the
+        # preview is ready long before the full video, even behind the full jobs of earlier uploads
+        preview_job_id = None
+        if preview:
+            preview_job_id = str(uuid.uuid4())
+            (PROCESSING_DIR / preview_job_id).mkdir(exist_ok=True)
+            update_job_status(preview_job_id, "uploaded", 0, "Preview queued")
+            update_job_info(
+                preview_job_id, submitted_at=time.time(), trace_id=span.trace_id, trace_parent_id=span.span_id
+            )
+            link_preview_job(job_id, preview_job_id)
+            scheduler.SCHEDULER.submit(
+                scheduler.PREVIEW, enhance_preview_pipeline, preview_job_id, input_file, model, scale.value,
+                denoise_strength, preview_start, preview_seconds, crop=crop
+            )
+        
+        # Queue the enhancement pipeline
+        scheduler.SCHEDULER.submit(
+            scheduler.FULL, enhance_video_pipeline, job_id, input_file, model, scale.value, denoise_strength,
+            profile=profile, stream=stream, crop=crop, target_height=target_height, max_dimension=max_dimension
+        )
+        
+        # Schedule cleanup after 24 hours
+        background_tasks.add_task(cleanup_files, job_id)
+        
+        return EnhanceVideoResponse(
+            message="Video upload successful, enhancement started",
+            job_id=job_id,
+            status=JobStatusEnum.uploaded,
+            filename=file.filename or "unknown",
+            file_size=file_size,
+            model=model,
+            scale=scale,
+            denoise_strength=denoise_strength,
+            preview_job_id=preview_job_id,
+            deadline_seconds=deadline_seconds,
+            profile=profile,
+            stream_url=stream_url(job_id) if stream else None
+        )
 
 @router.get("/status/{job_id}",
            response_model=JobStatusResponse,
@@ -364,7 +816,16 @@ async def get_job_status(job_id: str):
         progress=status_info.get("progress", 0),
         message=status_info.get("message", ""),
         updated_at=status_info.get("updated_at"),
-        estimated_completion=estimated_completion
+        estimated_completion=estimated_completion,
+        parent_job_id=status_info.get("parent_job_id"),
+        preview_job_id=status_info.get("preview_job_id"),
+        engine=status_info.get("engine"),
+        engine_reason=status_info.get("engine_reason"),
+        trace_id=status_info.get("trace_id"),
+        stream_url=status_info.get("stream_url"),
+        crop=status_info.get("crop"),
+        resolution=status_info.get("resolution"),
+        resources=status_info["resources"].to_dict() if status_info.get("resources") else None
     )
 
 @router.get("/download/{job_id}",
@@ -399,6 +860,60 @@ async def download_enhanced_video(job_id: str):
         filename=f"enhanced_{job_id}.mp4"
     )
 
+@router.get("/stream/{job_id}/{filename}",
+           response_class=FileResponse,
+           summary="Stream enhanced video",
+           description="Live HLS playlist and segments of a job started with stream=true, available while it is enhanced",
+           tags=["video-enhancement"],
+           responses={
+               200: {"description": "HLS playlist or MPEG-TS segment",
+                     "content": {"application/vnd.apple.mpegurl": {}, "video/mp2t": {}}},
+               404: {"model": ErrorResponse, "description": "Stream or segment not available (yet)"}
+           })
+async def stream_enhanced_video(job_id: str, filename: str):
+    """Serve the live HLS playlist and segments of a job"""
+    if filename != PLAYLIST_NAME and not re.fullmatch(r"segment_\d{5}\.ts", filename):
+        raise HTTPException(status_code=404, detail="Stream file not found")
+    
+    stream_file = OUTPUT_DIR / job_id / "hls" / filename
+    if not stream_file.exists():
+        raise HTTPException(status_code=404, detail="Stream not available yet")
+    
+    if filename == PLAYLIST_NAME:
+        # The playlist grows while the job runs
+        return FileResponse(
+            path=str(stream_file),
+            media_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "no-cache"}
+        )
+    return FileResponse(path=str(stream_file), media_type="video/mp2t")
+
+@router.get("/profile/{job_id}",
+           response_class=FileResponse,
+           summary="Download job profile",
+           description="Download the profile of a job submitted with profile=true (admin only)",
+           tags=["job-management"],
+           responses={
+               200: {"description": "Zip of the CPU samples, torch traces and tracemalloc snapshots",
+                     "content": {"application/zip": {}}},
+               403: {"model": ErrorResponse, "description": "Missing or invalid admin token"},
+               404: {"model": ErrorResponse, "description": "No profile for this job"}
+           })
+async def download_profile(job_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Download the profile artifacts of a job"""
+    if not profiling.is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="A valid X-Admin-Token is required")
+    
+    profile_archive = OUTPUT_DIR / job_id / "profile.zip"
+    if not profile_archive.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    return FileResponse(
+        path=str(profile_archive),
+        media_type="application/zip",
+        filename=f"profile_{job_id}.zip"
+    )
+
 @router.get("/models/",
            response_model=AvailableModelsResponse,
            summary="Get available AI models",
@@ -421,7 +936,8 @@ async def get_available_models():
             name=model_name.title(),  # Capitalize first letter
             description=model_data["description"],
             scales=model_data["scales"],
-            optimal_for="anime" if "anime" in model_data["description"].lower() else "general"
+            optimal_for="anime" if "anime" in model_data["description"].lower() else "general",
+            networks=model_data.get("networks")
         )
     
     # Determine default model - prefer waifu2x if available, otherwise use first available
@@ -443,20 +959,34 @@ async def get_available_models():
                   404: {"model": ErrorResponse, "description": "Job not found"}
               })
 async def cancel_job(job_id: str):
-    """Cancel enhancement job and cleanup files"""
-    job_dir = PROCESSING_DIR / job_id
-    output_dir = OUTPUT_DIR / job_id
-    
-    if not job_dir.exists():
+    """Cancel enhancement job and its preview, and cleanup files"""
+    if not (PROCESSING_DIR / job_id).exists():
         raise HTTPException(status_code=404, detail="Job not found")
     
-    # Update status to cancelled
-    update_job_status(job_id, "cancelled", 0, "Job cancelled by user")
+    preview_job_id = get_job_status_info(job_id).get("preview_job_id")
+    for cancelled_id in filter(None, (job_id, preview_job_id)):
+        # Update status to cancelled, and drop the pipeline if it is still queued
+        update_job_status(cancelled_id, "cancelled", 0, "Job cancelled by user")
+        scheduler.SCHEDULER.cancel(cancelled_id)
+        
+        # Clean up directories
+        staging.STAGING.release(cancelled_id)
+        for directory in (PROCESSING_DIR / cancelled_id, OUTPUT_DIR / cancelled_id):
+            if directory.exists():
+                shutil.rmtree(directory, ignore_errors=True)
     
-    # Clean up directories
-    if job_dir.exists():
-        shutil.rmtree(job_dir, ignore_errors=True)
-    if output_dir.exists():
-        shutil.rmtree(output_dir, ignore_errors=True)
+    return JobCancelResponse(message=f"Job {job_id} cancelled and cleaned up")
+
+@router.get("/metrics",
+           response_class=PlainTextResponse,
+           summary="Pipeline metrics",
+           description="Pipeline stage durations, throughput, queue depth and failures in the Prometheus text format",
+           tags=["system"])
+async def get_metrics():
+    """Export pipeline metrics for Prometheus"""
+    with JOB_LOCK:
+        statuses = [info.get("status") for info in JOB_STATUS.values()]
+    metrics.QUEUE_DEPTH.set(statuses.count("uploaded"))
+    metrics.ACTIVE_JOBS.set(statuses.count("processing"))
     
-    return JobCancelResponse(message=f"Job {job_id} cancelled and cleaned up")
\ No newline at end of file
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
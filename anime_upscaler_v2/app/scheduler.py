@@ -0,0 +1,119 @@
+"""
+Scheduling of the enhancement pipelines: previews first, full jobs yield to them
+
+Pipelines are submitted to queues instead of the per-request background tasks, which ran the jobs of
+different uploads side by side, so that the preview of a new upload waited on (and competed with) every
+full job already running. Previews run on a dedicated worker thread; full jobs run on JOB_WORKERS threads
+of their own.
+
+Ordering guarantees:
+    - Previews start in submission order and never wait behind a full job
+    - Full jobs start in submission order, and only once every preview submitted before them has
+      finished; previews submitted later do not hold them back, so a stream of previews cannot starve
+      them. A full job that has already started is not interrupted
+    - A preview submitted before its full job (as /enhance_video/ does) has therefore finished before
+      the full job starts
+
+Configuration:
+    JOB_WORKERS: Number of full jobs that run at the same time (default: 2)
+"""
+
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "2")))
+
+# Queue priorities
+PREVIEW = 0
+FULL = 1
+
+
+class JobScheduler:
+    """
+    Queues of previews and full jobs with a preview worker and full job workers
+
+    Args:
+        workers: Number of full job worker threads
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._queues: Dict[int, Deque[Tuple[int, Callable, tuple, dict]]] = {PREVIEW: deque(), FULL: deque()}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        # Submission numbers of the previews that are running
+        self._previews_running: Set[int] = set()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, priority: int, func: Callable, *args, **kwargs):
+        """Queue a pipeline with a priority (PREVIEW or FULL)"""
+        with self._condition:
+            self._start_workers()
+            self._queues[priority].append((next(self._sequence), func, args, kwargs))
+            self._condition.notify_all()
+
+    def cancel(self, job_id: str) -> int:
+        """Drop the queued pipelines of a job (their first argument); returns how many were dropped"""
+        with self._condition:
+            dropped = 0
+            for queue in self._queues.values():
+                kept = [entry for entry in queue if not (entry[2] and entry[2][0] == job_id)]
+                dropped += len(queue) - len(kept)
+                queue.clear()
+                queue.extend(kept)
+            # A full job may have been waiting on a dropped preview
+            self._condition.notify_all()
+            return dropped
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        self._threads.append(threading.Thread(target=self._run, args=(PREVIEW,), name="preview-worker",
+                                              daemon=True))
+        for index in range(self.workers):
+            self._threads.append(threading.Thread(target=self._run, args=(FULL,), name=f"job-worker-{index}",
+                                                  daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _ready(self, priority: int) -> bool:
+        """Whether a worker of a priority can take the head of its queue"""
+        queue = self._queues[priority]
+        if not queue:
+            return False
+        if priority == PREVIEW:
+            return True
+        # A full job only yields to the previews submitted before it
+        sequence = queue[0][0]
+        previews = self._queues[PREVIEW]
+        return (not previews or previews[0][0] > sequence) and \
+            all(running > sequence for running in self._previews_running)
+
+    def _run(self, priority: int):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._ready(priority))
+                sequence, func, args, kwargs = self._queues[priority].popleft()
+                if priority == PREVIEW:
+                    self._previews_running.add(sequence)
+                # The next entry may be for the other workers
+                self._condition.notify_all()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                # The pipelines report their own failures; this only keeps the worker alive
+                logger.error(f"Scheduled pipeline {getattr(func, '__name__', func)} failed: {str(e)}")
+            finally:
+                if priority == PREVIEW:
+                    with self._condition:
+                        self._previews_running.discard(sequence)
+                        self._condition.notify_all()
+
+
+SCHEDULER = JobScheduler(JOB_WORKERS)
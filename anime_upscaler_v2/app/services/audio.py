@@ -4,6 +4,9 @@ from pathlib import Path
 from typing import Optional
 import logging
 
+from .probe import ProbeService
+from ..tracing import traced_run
+
 logger = logging.getLogger(__name__)
 
 class AudioService:
@@ -40,7 +43,7 @@ class AudioService:
             
             logger.info(f"Extracting audio: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -65,46 +68,15 @@ class AudioService:
     @staticmethod
     def get_audio_info(video_file: Path) -> Optional[dict]:
         """
-        Get audio information from video file
+        Get audio information from the cached FFprobe analysis of the file
         
         Returns:
             dict: Audio information or None if failed
         """
-        try:
-            cmd = [
-                "ffprobe",
-                "-v", "quiet",
-                "-print_format", "json",
-                "-show_streams",
-                "-select_streams", "a:0",
-                str(video_file)
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            
-            import json
-            data = json.loads(result.stdout)
-            
-            if data.get("streams"):
-                stream = data["streams"][0]
-                return {
-                    "codec": stream.get("codec_name"),
-                    "duration": float(stream.get("duration", 0)),
-                    "sample_rate": int(stream.get("sample_rate", 0)),
-                    "channels": int(stream.get("channels", 0)),
-                    "bit_rate": int(stream.get("bit_rate", 0))
-                }
-            
-            return None
-            
-        except Exception as e:
-            logger.error(f"Failed to get audio info: {str(e)}")
+        info = ProbeService.probe(video_file)
+        if not info or not info["audio"]:
             return None
+        return info["audio"]
     
     @staticmethod
     def merge_audio_video(video_file: Path, audio_file: Path, output_file: Path) -> bool:
@@ -137,7 +109,7 @@ class AudioService:
             
             logger.info(f"Merging audio and video: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
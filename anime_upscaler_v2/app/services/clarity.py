@@ -1,15 +1,70 @@
 import subprocess
 import os
 from pathlib import Path
-from typing import Optional, List, Dict, Any, Callable
+from typing import Optional, List, Dict, Any, Callable, Tuple
 import logging
 import concurrent.futures
+import contextvars
+import functools
+import json
+import queue
 import threading
+import time
 from PIL import Image
 import numpy as np
 
+from .frames import FrameService, FRAME_FORMAT
+from .manifest import FrameManifest, link_frame
+from .. import resources
+from ..framestore import FrameStore, STORE_FORMAT, store_path
+from ..tracing import start_span, traced_run
+
 logger = logging.getLogger(__name__)
 
+# Formats waifu2x-ncnn-vulkan can write (it reads PPM and BMP too)
+WAIFU2X_OUTPUT_FORMATS = ("png", "jpg")
+
+# Engines that read and write frame stores (FRAME_FORMAT=raw); waifu2x-ncnn-vulkan only reads image files
+FRAME_STORE_ENGINES = ("test", "esrgan", "esrgan_video")
+
+# Engines the auto model picks from, best quality first
+AUTO_ENGINES = ["esrgan", "esrgan_video", "waifu2x"]
+# At 2x the engines that run natively at 2x come first: waifu2x (anime) and RealESRGAN_x2plus (general-purpose).
+# realesr-animevideov3 only exists at 4x, so esrgan_video computes 4x output and downscales it
+AUTO_ENGINES_2X = ["waifu2x", "esrgan", "esrgan_video"]
+
+# (model, scale) pairs whose network runs at a larger scale, whose output is then downscaled
+ENGINE_RUN_SCALES = {("esrgan_video", 2): 4}
+# Seconds per megapixel of network output that is downscaled to the requested scale
+DOWNSCALE_COST = 0.01
+
+# Turnaround target of auto jobs without a deadline, in seconds
+AUTO_TARGET_SECONDS = float(os.getenv("AUTO_TARGET_SECONDS", "1800"))
+
+# Jobs with a target resolution shrink their frames before enhancement when the engine output would be at
+# least this many times the target size (0 to always enhance at the source size)
+PRESHRINK_RATIO = float(os.getenv("PRESHRINK_RATIO", "1.5"))
+
+# Seconds per input megapixel for each (model, scale), measured on this host while frames are enhanced.
+# Seeded with rough defaults; 4x waifu2x runs a second 2x pass on four times the pixels. Pairs of
+# ENGINE_RUN_SCALES are measured and estimated as the larger scale they run at.
+ENGINE_COSTS = {
+    ("test", 1): 0.3,
+    ("test", 2): 0.3,
+    ("waifu2x", 2): 6.5,
+    ("waifu2x", 4): 32.5,
+    ("esrgan", 2): 11.0,
+    ("esrgan", 4): 16.0,
+    ("esrgan_video", 4): 5.0,
+}
+COST_LOCK = threading.Lock()
+# Weight of a new measurement in the moving average
+COST_SMOOTHING = 0.2
+
+# Real-ESRGAN is stopped when it reports no progress for this many seconds. A frame may take longer in total
+# (e.g. 4K frames on CPU) as long as its tiles keep finishing.
+ESRGAN_IDLE_TIMEOUT = 60
+
 class ClarityService:
     """Service for AI-based video frame enhancement"""
     
@@ -26,15 +81,31 @@ class ClarityService:
                 "requirements": ["mpv", "anime4k"]
             },
             "esrgan": {
-                "description": "High-quality anime upscaling using Real-ESRGAN (RealESRGAN_x4plus_anime_6B)",
-                "scales": [4],
-                "requirements": ["python3"]
+                "description": "High-quality upscaling using Real-ESRGAN: the anime network "
+                               "RealESRGAN_x4plus_anime_6B at 4x, the general-purpose RealESRGAN_x2plus at 2x",
+                "scales": [2, 4],
+                "networks": {2: "RealESRGAN_x2plus", 4: "RealESRGAN_x4plus_anime_6B"},
+                "requirements": ["python3"],
+                "note": "2x runs the 2x network RealESRGAN_x2plus instead of downscaling 4x output"
+            },
+            "esrgan_video": {
+                "description": "Fast anime video upscaling using Real-ESRGAN (realesr-animevideov3)",
+                "scales": [2, 4],
+                "networks": {2: "realesr-animevideov3", 4: "realesr-animevideov3"},
+                "requirements": ["python3"],
+                "note": "2x downscales the 4x output"
             },
             "waifu2x": {
                 "description": "Anime-style image upscaling",
                 "scales": [2, 4],
                 "requirements": ["waifu2x-ncnn-vulkan"],
                 "note": "4x is achieved by chaining two 2x passes"
+            },
+            "auto": {
+                "description": "Picks esrgan, esrgan_video or waifu2x per job from the measured speed of this host, "
+                               "the jobs running alongside and the deadline",
+                "scales": [2, 4],
+                "requirements": []
             }
         }
         
@@ -55,9 +126,12 @@ class ClarityService:
         if model_name not in self.supported_models:
             return False
         
-        if model_name == "esrgan":
+        if model_name in ("esrgan", "esrgan_video"):
             return self.realesrgan_venv.exists() and self.realesrgan_path.exists()
         
+        if model_name == "auto":
+            return any(self.check_model_availability(engine) for engine in AUTO_ENGINES)
+        
         model_info = self.supported_models[model_name]
         requirements = model_info.get("requirements", [])
         
@@ -94,6 +168,36 @@ class ClarityService:
         
         return available
     
+    def output_frame_format(self, model: str, frame_format: str = FRAME_FORMAT) -> str:
+        """
+        Get the format of the enhanced frames written by a model
+        
+        Args:
+            model: AI model to use
+            frame_format: Format of the input frames
+            
+        Returns:
+            str: frame_format, or png if the model cannot write frame_format
+        """
+        if model == "waifu2x" and frame_format not in WAIFU2X_OUTPUT_FORMATS:
+            return "png"
+        return frame_format
+    
+    def input_frame_format(self, model: str, frame_format: str = FRAME_FORMAT) -> str:
+        """
+        Get the format frames should be extracted in for a model
+        
+        Args:
+            model: AI model to use
+            frame_format: Configured frame format
+            
+        Returns:
+            str: frame_format, or png if the model cannot read frame stores
+        """
+        if frame_format == STORE_FORMAT and model not in FRAME_STORE_ENGINES:
+            return "png"
+        return frame_format
+    
     def enhance_frame_waifu2x(self, input_frame: Path, output_frame: Path, scale: int = 2) -> bool:
         """
         Enhance single frame using Waifu2x
@@ -128,10 +232,10 @@ class ClarityService:
                     "-s", "2",
                     "-n", "2",
                     "-m", str(model_path),
-                    "-f", "png"
+                    "-f", output_frame.suffix.lstrip(".")
                 ]
                 
-                result1 = subprocess.run(
+                result1 = traced_run(
                     cmd1,
                     capture_output=True,
                     text=True,
@@ -146,10 +250,10 @@ class ClarityService:
                     "-s", "2",
                     "-n", "0",
                     "-m", str(model_path),
-                    "-f", "png"
+                    "-f", output_frame.suffix.lstrip(".")
                 ]
                 
-                result2 = subprocess.run(
+                result2 = traced_run(
                     cmd2,
                     capture_output=True,
                     text=True,
@@ -169,11 +273,11 @@ class ClarityService:
                     "-s", str(scale),
                     "-n", "2",
                     "-m", str(model_path),
-                    "-f", "png"
+                    "-f", output_frame.suffix.lstrip(".")
                 ]
                 
                 logger.info(f"Running command: {' '.join(cmd)}")
-                result = subprocess.run(
+                result = traced_run(
                     cmd,
                     capture_output=True,
                     text=True,
@@ -194,14 +298,30 @@ class ClarityService:
             logger.error(f"Frame enhancement failed: {str(e)}")
             return False
     
-    def enhance_frame_esrgan(self, input_frame: Path, output_frame: Path, scale: int = 4) -> bool:
+    def enhance_frame_esrgan(
+        self,
+        input_frame: Path,
+        output_frame: Path,
+        scale: int = 4,
+        denoise_strength: Optional[float] = None,
+        model_name: str = "RealESRGAN_x4plus_anime_6B",
+        profile_dir: Optional[Path] = None,
+        progress: Optional[Callable[[dict], None]] = None
+    ) -> bool:
         """
         Enhance single frame using Real-ESRGAN
         
         Args:
             input_frame: Path to input frame
             output_frame: Path to output frame
-            scale: Upscaling factor (only 4x supported)
+            scale: Upscaling factor (4x models; other scales are resized by Real-ESRGAN)
+            denoise_strength: Denoise strength (0-1). When set, the realesr-general-x4v3 model is used with
+                interpolated weights, which Real-ESRGAN caches per strength
+            model_name: Real-ESRGAN model name
+            profile_dir: Write a torch profiler trace of the frame to this directory
+            progress: Function to call with each progress event of Real-ESRGAN: {"event": "tile", "done",
+                "total", "computed"} per finished tile and {"event": "frame", "seconds", "height", "width"}
+                when the frame is done
             
         Returns:
             bool: True if enhancement successful, False otherwise
@@ -209,46 +329,29 @@ class ClarityService:
         try:
             output_frame.parent.mkdir(parents=True, exist_ok=True)
             
-            if not self.realesrgan_venv.exists():
-                logger.error(f"Real-ESRGAN virtual environment not found at {self.realesrgan_venv}")
-                return False
-            
-            inference_script = self.realesrgan_path / "inference_realesrgan.py"
-            if not inference_script.exists():
-                logger.error(f"Real-ESRGAN inference script not found at {inference_script}")
-                return False
-            
             output_frame = output_frame.resolve()
             output_dir = output_frame.parent
             
-            cmd = [
-                str(self.realesrgan_venv),
-                str(inference_script),
-                "-n", "RealESRGAN_x4plus_anime_6B",
-                "-i", str(input_frame.resolve()),
-                "-o", str(output_dir),
-                "-s", str(scale),
-                "--fp32",
-                "--tile", "256"
-            ]
+            cmd = self._esrgan_command(
+                ["-i", str(input_frame.resolve()), "-o", str(output_dir)],
+                scale, denoise_strength, model_name, profile_dir
+            )
+            if cmd is None:
+                return False
             
             logger.info(f"Running Real-ESRGAN: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            returncode, output = self.run_with_progress(
                 cmd,
-                capture_output=True,
-                text=True,
-                cwd=str(self.realesrgan_path),
-                timeout=60
+                progress or (lambda event: None),
+                idle_timeout=ESRGAN_IDLE_TIMEOUT,
+                cwd=str(self.realesrgan_path)
             )
             
-            logger.info(f"Real-ESRGAN stdout: {result.stdout}")
-            logger.info(f"Real-ESRGAN stderr: {result.stderr}")
-            logger.info(f"Real-ESRGAN return code: {result.returncode}")
-            
-            if result.returncode != 0:
-                logger.error(f"Real-ESRGAN error: {result.stderr}")
+            if returncode != 0:
+                logger.error(f"Real-ESRGAN error (return code {returncode}): {output}")
                 return False
+            logger.debug(f"Real-ESRGAN output: {output}")
             
             output_filename = input_frame.stem + "_out" + input_frame.suffix
             actual_output = output_dir / output_filename
@@ -272,6 +375,208 @@ class ClarityService:
             logger.error(f"Frame enhancement failed: {str(e)}")
             return False
     
+    def enhance_store_esrgan(
+        self,
+        input_store: Path,
+        output_store: Path,
+        indices: List[int],
+        scale: int = 4,
+        denoise_strength: Optional[float] = None,
+        model_name: str = "RealESRGAN_x4plus_anime_6B",
+        profile_dir: Optional[Path] = None,
+        profile_frames: int = 3,
+        progress: Optional[Callable[[dict], None]] = None
+    ) -> bool:
+        """
+        Enhance frames of a frame store with a single Real-ESRGAN run
+        
+        Real-ESRGAN reads the frames from the mapped input store and writes its outputs into the output store,
+        which must already have the output size. The model is loaded once for all frames, and tiles that did
+        not change since the previous frame keep their output.
+        
+        Args:
+            input_store: Frame store of the input frames
+            output_store: Frame store of the enhanced frames
+            indices: Indexes of the frames to enhance, passed to Real-ESRGAN in a list file next to the output store
+            scale: Upscaling factor
+            denoise_strength: Denoise strength (0-1), see enhance_frame_esrgan
+            model_name: Real-ESRGAN model name
+            profile_dir: Write torch profiler traces of the first frames of the store to this directory
+            profile_frames: Number of frames to trace with profile_dir
+            progress: Function to call with each progress event of Real-ESRGAN, see enhance_frame_esrgan.
+                Events carry the store index of their frame ("index"); a frame event means the frame is written
+            
+        Returns:
+            bool: True if Real-ESRGAN ran through the frames. Frames it failed on have no frame event.
+        """
+        frame_list = output_store.parent / f"frame_list_{indices[0]:06d}.txt"
+        try:
+            frame_list.write_text("".join(f"{index}\n" for index in indices))
+            cmd = self._esrgan_command(
+                [
+                    "-i", str(input_store.resolve()),
+                    "--output_store", str(output_store.resolve()),
+                    "--frame_list", str(frame_list.resolve())
+                ],
+                scale, denoise_strength, model_name, profile_dir,
+                # The frames of a store run are consecutive, so static backgrounds are not enhanced again
+                tile_reuse=True
+            )
+            if cmd is None:
+                return False
+            if profile_dir is not None:
+                cmd.extend(["--profile_frames", str(profile_frames)])
+            
+            logger.info(f"Running Real-ESRGAN: {' '.join(cmd)}")
+            
+            returncode, output = self.run_with_progress(
+                cmd,
+                progress or (lambda event: None),
+                idle_timeout=ESRGAN_IDLE_TIMEOUT,
+                cwd=str(self.realesrgan_path)
+            )
+            
+            if returncode != 0:
+                logger.error(f"Real-ESRGAN error (return code {returncode}): {output}")
+                return False
+            logger.debug(f"Real-ESRGAN output: {output}")
+            return True
+            
+        except subprocess.TimeoutExpired:
+            logger.error("Real-ESRGAN processing timed out")
+            return False
+        except Exception as e:
+            logger.error(f"Frame store enhancement failed: {str(e)}")
+            return False
+        finally:
+            frame_list.unlink(missing_ok=True)
+    
+    @staticmethod
+    def esrgan_model_name(model: str, scale: int) -> str:
+        """
+        Real-ESRGAN network of an engine at a scale
+        
+        esrgan runs its 2x network for 2x, as the 4x network would compute four times the output pixels
+        only for them to be downscaled. realesr-animevideov3 only exists as a 4x network.
+        """
+        if model == "esrgan_video":
+            return "realesr-animevideov3"
+        return "RealESRGAN_x2plus" if scale == 2 else "RealESRGAN_x4plus_anime_6B"
+    
+    def _esrgan_command(
+        self,
+        io_args: List[str],
+        scale: int,
+        denoise_strength: Optional[float],
+        model_name: str,
+        profile_dir: Optional[Path],
+        tile_reuse: bool = False
+    ) -> Optional[List[str]]:
+        """
+        Real-ESRGAN command line with the service's tile settings, or None if Real-ESRGAN is not installed
+        
+        With tile_reuse, Real-ESRGAN only runs the tiles that changed since the previous frame of the run.
+        Only runs over consecutive frames of one video gain from it: a single-frame run has no previous frame.
+        """
+        if not self.realesrgan_venv.exists():
+            logger.error(f"Real-ESRGAN virtual environment not found at {self.realesrgan_venv}")
+            return None
+        
+        inference_script = self.realesrgan_path / "inference_realesrgan.py"
+        if not inference_script.exists():
+            logger.error(f"Real-ESRGAN inference script not found at {inference_script}")
+            return None
+        
+        model_args = ["-n", model_name]
+        if denoise_strength is not None:
+            model_args = ["-n", "realesr-general-x4v3", "-dn", str(denoise_strength)]
+        
+        cmd = [
+            str(self.realesrgan_venv),
+            str(inference_script),
+            *model_args,
+            *io_args,
+            "-s", str(scale),
+            "--fp32",
+            "--tile", "256",
+            "--tile_pad", "4",
+            "--tile_blend",
+            "--progress", "json"
+        ]
+        if tile_reuse:
+            cmd.append("--tile_reuse")
+        if profile_dir is not None:
+            cmd.extend(["--profile_dir", str(profile_dir.resolve())])
+        return cmd
+    
+    @staticmethod
+    def run_with_progress(
+        cmd: List[str],
+        on_event: Callable[[dict], None],
+        idle_timeout: float,
+        cwd: Optional[str] = None
+    ) -> Tuple[int, str]:
+        """
+        Run a command that reports progress as JSON lines on stdout, in a trace span
+        
+        Args:
+            cmd: Command line
+            on_event: Function to call with each progress event
+            idle_timeout: Seconds without any output after which the command is killed
+            cwd: Working directory
+            
+        Returns:
+            tuple: Return code, and the output lines that are not progress events
+            
+        Raises:
+            subprocess.TimeoutExpired: If the command printed nothing for idle_timeout seconds; like an
+                exception of on_event, the command is killed first
+        """
+        with start_span(f"subprocess {Path(cmd[0]).name}", command=" ".join(cmd)) as span:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=cwd)
+            lines = queue.Queue()
+            
+            def read_output():
+                for line in process.stdout:
+                    lines.put(line)
+                lines.put(None)
+            
+            threading.Thread(target=read_output, daemon=True).start()
+            
+            output = []
+            returncode = None
+            try:
+                while True:
+                    try:
+                        line = lines.get(timeout=idle_timeout)
+                    except queue.Empty:
+                        span.set_error(f"no progress for {idle_timeout}s")
+                        raise subprocess.TimeoutExpired(cmd, idle_timeout)
+                    if line is None:
+                        break
+                    try:
+                        event = json.loads(line) if line.startswith("{") else None
+                    except json.JSONDecodeError:
+                        event = None
+                    if isinstance(event, dict):
+                        if event.get("event") == "frame":
+                            span.set_attributes(frame_seconds=event.get("seconds"))
+                        on_event(event)
+                    else:
+                        output.append(line)
+                
+                returncode = resources.wait(process)
+            finally:
+                if returncode is None:
+                    # Stalled, or on_event raised: do not leave the engine running or unreaped
+                    process.kill()
+                    resources.wait(process)
+            
+            span.set_attributes(returncode=returncode)
+            if returncode != 0:
+                span.set_error(f"exit status {returncode}")
+            return returncode, "".join(output)
+    
     def _enhance_frame_test(self, input_frame: Path, output_frame: Path, scale: int = 1) -> bool:
         """
         Test mode: Simply copy frames without enhancement
@@ -311,7 +616,13 @@ class ClarityService:
         model: str = "waifu2x",
         scale: int = 2,
         max_workers: int = 4,
-        progress_callback: Optional[Callable] = None
+        progress_callback: Optional[Callable] = None,
+        denoise_strength: Optional[float] = None,
+        frame_format: str = FRAME_FORMAT,
+        profile_dir: Optional[Path] = None,
+        profile_frames: int = 3,
+        event_callback: Optional[Callable[[dict], None]] = None,
+        frame_callback: Optional[Callable[[int], None]] = None
     ) -> bool:
         """
         Enhance multiple frames in parallel
@@ -323,20 +634,42 @@ class ClarityService:
             scale: Upscaling factor
             max_workers: Number of parallel workers
             progress_callback: Function to call with progress updates
+            denoise_strength: Real-ESRGAN denoise strength (esrgan only)
+            frame_format: Format of the input frames. Enhanced frames are written in
+                output_frame_format(model, frame_format); raw reads and writes frame stores
+            profile_dir: Write torch profiler traces of the first frames here (Real-ESRGAN models only)
+            profile_frames: Number of frames to trace with profile_dir
+            event_callback: Function to call with the tile and frame progress events of Real-ESRGAN models,
+                with the index of the frame and the number of frames added ("index", "frames")
+            frame_callback: Function to call with the 0-based index of each frame once it is enhanced
             
+        Frames are listed from the frame manifest of input_dir. Frames the manifest marks as duplicates are
+        not enhanced again: they get the output of the frame they repeat, and the enhanced frames get a
+        manifest with the same timing.
+        
         Returns:
             bool: True if all frames enhanced successfully, False otherwise
         """
+        if frame_format == STORE_FORMAT:
+            return self._enhance_frames_store(
+                input_dir, output_dir, model, scale, max_workers, progress_callback, denoise_strength,
+                profile_dir, profile_frames, event_callback, frame_callback
+            )
+        
         try:
             # Get list of frame files
-            frame_files = sorted(list(input_dir.glob("frame_*.png")))
-            if not frame_files:
-                frame_files = sorted(list(input_dir.glob("frame_*.jpg")))
+            frame_files = FrameService.get_frame_list(input_dir, frame_format)
             
             if not frame_files:
                 logger.error(f"No frame files found in {input_dir}")
                 return False
             
+            manifest = FrameManifest.load(input_dir)
+            if manifest and manifest.format != frame_format:
+                manifest = None
+            duplicates = manifest.duplicates() if manifest else {}
+            skipped = {index for copies in duplicates.values() for index in copies}
+            
             # Ensure output directory exists
             output_dir.mkdir(parents=True, exist_ok=True)
             
@@ -346,25 +679,57 @@ class ClarityService:
             elif model == "waifu2x":
                 enhance_func = self.enhance_frame_waifu2x
             elif model == "esrgan":
-                enhance_func = self.enhance_frame_esrgan
+                enhance_func = functools.partial(
+                    self.enhance_frame_esrgan,
+                    denoise_strength=denoise_strength,
+                    model_name=self.esrgan_model_name(model, scale)
+                )
+            elif model == "esrgan_video":
+                enhance_func = functools.partial(
+                    self.enhance_frame_esrgan, model_name=self.esrgan_model_name(model, scale)
+                )
             else:
                 logger.error(f"Unsupported model: {model}")
                 return False
             
+            output_format = self.output_frame_format(model, frame_format)
+            
+            # Real-ESRGAN traces the first few frames when profiling
+            profiled_frames = set()
+            if profile_dir is not None and model in ("esrgan", "esrgan_video"):
+                profiled_frames = set(frame_files[:profile_frames])
+            
             # Process frames in parallel
             completed = 0
             failed = 0
             
-            def enhance_single_frame(frame_path):
+            def enhance_single_frame(index, frame_path):
                 nonlocal completed, failed
                 
-                output_path = output_dir / frame_path.name
-                success = enhance_func(frame_path, output_path, scale)
+                output_path = output_dir / f"{frame_path.stem}.{output_format}"
+                options = {}
+                if frame_path in profiled_frames:
+                    options["profile_dir"] = profile_dir
+                if event_callback is not None and model in ("esrgan", "esrgan_video"):
+                    options["progress"] = lambda event: event_callback(
+                        {**event, "index": index, "frames": len(frame_files)}
+                    )
+                start_time = time.perf_counter()
+                success = enhance_func(frame_path, output_path, scale, **options)
                 
+                copies = duplicates.get(index, [])
                 if success:
-                    completed += 1
+                    with Image.open(frame_path) as image:
+                        width, height = image.size
+                    self.record_cost(model, scale, time.perf_counter() - start_time, width * height)
+                    for copy in copies:
+                        link_frame(output_path, output_dir / f"{frame_files[copy].stem}.{output_format}")
+                    completed += 1 + len(copies)
+                    if frame_callback:
+                        for done in [index, *copies]:
+                            frame_callback(done)
                 else:
-                    failed += 1
+                    failed += 1 + len(copies)
                     logger.error(f"Failed to enhance frame: {frame_path}")
                 
                 # Call progress callback if provided
@@ -376,12 +741,20 @@ class ClarityService:
             
             # Use ThreadPoolExecutor for parallel processing
             with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(enhance_single_frame, frame) for frame in frame_files]
+                # Each task runs in a copy of the current context, so its spans join the trace of the job
+                futures = [executor.submit(contextvars.copy_context().run, enhance_single_frame, index, frame)
+                           for index, frame in enumerate(frame_files) if index not in skipped]
                 
                 # Wait for all tasks to complete
                 concurrent.futures.wait(futures)
             
-            logger.info(f"Frame enhancement completed: {completed} successful, {failed} failed")
+            if manifest:
+                output_scale = 1 if model == "test" else scale
+                width, height = manifest.width * output_scale, manifest.height * output_scale
+                manifest.derive(width, height, output_format).save(output_dir)
+            
+            logger.info(f"Frame enhancement completed: {completed} successful ({len(skipped)} duplicates), "
+                        f"{failed} failed")
             
             return failed == 0
             
@@ -389,6 +762,294 @@ class ClarityService:
             logger.error(f"Batch frame enhancement failed: {str(e)}")
             return False
     
+    def _enhance_frames_store(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        model: str,
+        scale: int,
+        max_workers: int,
+        progress_callback: Optional[Callable],
+        denoise_strength: Optional[float],
+        profile_dir: Optional[Path],
+        profile_frames: int,
+        event_callback: Optional[Callable[[dict], None]],
+        frame_callback: Optional[Callable[[int], None]]
+    ) -> bool:
+        """
+        Enhance the frame store of input_dir into a frame store in output_dir (see enhance_frames_batch)
+        
+        The test engine copies frames between the mappings. Real-ESRGAN models split the frames that are not
+        duplicates into one contiguous run per worker and enhance each run with a single Real-ESRGAN run.
+        """
+        try:
+            if model not in FRAME_STORE_ENGINES:
+                logger.error(f"Model {model} cannot read frame stores")
+                return False
+            
+            input_store = FrameStore.open(input_dir)
+            if input_store is None or not len(input_store):
+                logger.error(f"No frames found in the frame store of {input_dir}")
+                return False
+            
+            frame_count = len(input_store)
+            output_scale = 1 if model == "test" else scale
+            output_store = FrameStore.create(
+                store_path(output_dir), frame_count, input_store.height * output_scale, input_store.width * output_scale
+            )
+            pixels = input_store.height * input_store.width
+            
+            manifest = FrameManifest.load(input_dir)
+            if manifest and len(manifest) != frame_count:
+                logger.warning(f"Ignoring the frame manifest of {input_dir}, it does not match the frame store")
+                manifest = None
+            duplicates = manifest.duplicates() if manifest else {}
+            skipped = {index for copies in duplicates.values() for index in copies}
+            unique = [index for index in range(frame_count) if index not in skipped]
+            
+            counts = {"completed": 0, "failed": 0}
+            counts_lock = threading.Lock()
+            
+            def frame_finished(index, success, seconds):
+                copies = duplicates.get(index, [])
+                if success:
+                    self.record_cost(model, scale, seconds, pixels)
+                    for copy in copies:
+                        output_store[copy][...] = output_store[index]
+                    if frame_callback:
+                        for done in [index, *copies]:
+                            frame_callback(done)
+                else:
+                    logger.error(f"Failed to enhance frame {index + 1} of {input_store.path}")
+                with counts_lock:
+                    counts["completed" if success else "failed"] += 1 + len(copies)
+                    if progress_callback:
+                        progress = (counts["completed"] + counts["failed"]) / frame_count * 100
+                        progress_callback(progress, counts["completed"], counts["failed"])
+            
+            def copy_frame(index):
+                start_time = time.perf_counter()
+                output_store[index][...] = input_store[index]
+                frame_finished(index, True, time.perf_counter() - start_time)
+            
+            def enhance_run(indices):
+                done = set()
+                wanted = set(indices)
+                last_time = time.perf_counter()
+                
+                def on_event(event):
+                    nonlocal last_time
+                    if event_callback is not None:
+                        event_callback({**event, "frames": frame_count})
+                    if event.get("event") == "frame" and event.get("index") in wanted:
+                        # Wall time since the previous frame, so the model load is spread over the range
+                        now = time.perf_counter()
+                        done.add(event["index"])
+                        frame_finished(event["index"], True, now - last_time)
+                        last_time = now
+                
+                self.enhance_store_esrgan(
+                    input_store.path,
+                    output_store.path,
+                    indices,
+                    scale,
+                    denoise_strength=denoise_strength if model == "esrgan" else None,
+                    model_name=self.esrgan_model_name(model, scale),
+                    profile_dir=profile_dir,
+                    profile_frames=profile_frames,
+                    progress=on_event
+                )
+                for index in indices:
+                    if index not in done:
+                        frame_finished(index, False, 0.0)
+            
+            if model == "test":
+                tasks = [(copy_frame, index) for index in unique]
+            else:
+                workers = max(1, min(max_workers, len(unique)))
+                bounds = [len(unique) * worker // workers for worker in range(workers + 1)]
+                tasks = [(enhance_run, unique[bounds[worker]:bounds[worker + 1]]) for worker in range(workers)]
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Each task runs in a copy of the current context, so its spans join the trace of the job
+                futures = [executor.submit(contextvars.copy_context().run, *task) for task in tasks]
+                concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+            output_store.flush()
+            if manifest:
+                manifest.derive(output_store.width, output_store.height, STORE_FORMAT).save(output_dir)
+            
+            logger.info(f"Frame enhancement completed: {counts['completed']} successful ({len(skipped)} duplicates), "
+                        f"{counts['failed']} failed")
+            
+            return counts["failed"] == 0
+            
+        except Exception as e:
+            logger.error(f"Batch frame enhancement failed: {str(e)}")
+            return False
+    
+    def record_cost(self, model: str, scale: int, seconds: float, pixels: int):
+        """
+        Fold the measured time of one frame into the per-pixel cost of a model
+        
+        Args:
+            model: AI model used
+            scale: Upscaling factor used
+            seconds: Wall time spent on the frame
+            pixels: Number of input pixels of the frame
+        """
+        if pixels <= 0:
+            return
+        # The frames of a downscaled scale are charged to the network scale, less the downscale
+        seconds = max(0.0, seconds - self.downscale_seconds(model, scale, 1, pixels))
+        key = (model, ENGINE_RUN_SCALES.get((model, scale), scale))
+        cost = seconds / (pixels / 1e6)
+        with COST_LOCK:
+            previous = ENGINE_COSTS.get(key)
+            ENGINE_COSTS[key] = cost if previous is None else previous + COST_SMOOTHING * (cost - previous)
+    
+    def downscale_seconds(self, model: str, scale: int, frame_count: int, pixels: int) -> float:
+        """Time spent downscaling the network output of frames of a pair of ENGINE_RUN_SCALES (0 for others)"""
+        run_scale = ENGINE_RUN_SCALES.get((model, scale))
+        if run_scale is None:
+            return 0.0
+        return frame_count * pixels * run_scale * run_scale / 1e6 * DOWNSCALE_COST
+    
+    def estimate_seconds(self, model: str, scale: int, frame_count: int, width: int, height: int) -> Optional[float]:
+        """
+        Estimate the enhancement time of a video from the measured per-pixel cost
+        
+        Scales that are computed at a larger scale and downscaled (ENGINE_RUN_SCALES) cost the larger scale,
+        plus the downscale of its output.
+        
+        Args:
+            model: AI model to use
+            scale: Upscaling factor
+            frame_count: Number of frames
+            width: Frame width in pixels
+            height: Frame height in pixels
+            
+        Returns:
+            float: Estimated time in seconds, or None if the model has no cost for this scale
+        """
+        with COST_LOCK:
+            cost = ENGINE_COSTS.get((model, ENGINE_RUN_SCALES.get((model, scale), scale)))
+        if cost is None:
+            return None
+        pixels = width * height
+        return frame_count * pixels / 1e6 * cost + self.downscale_seconds(model, scale, frame_count, pixels)
+    
+    def plan_resolution(
+        self,
+        model: str,
+        source_width: int,
+        source_height: int,
+        target_height: Optional[int] = None,
+        max_dimension: Optional[int] = None,
+        crop: Optional[dict] = None
+    ) -> dict:
+        """
+        Plan a job that upscales to a target resolution instead of a fixed factor
+        
+        The engine runs at the smallest of its scales that reaches the target (or its largest scale if none
+        does). If that overshoots the target by PRESHRINK_RATIO or more, the frames are shrunk before
+        enhancement so the engine output is the target size. The merge resizes the output to the target.
+        
+        Args:
+            model: AI model to use
+            source_width: Frame width of the video
+            source_height: Frame height of the video
+            target_height: Output height
+            max_dimension: Largest output width or height
+            crop: Active area the frames are cropped to (see FrameService.detect_crop)
+        
+        Returns:
+            dict: "scale" of the engine, "factor" from source to output, "shrink" applied to the frames
+                before enhancement (1.0 for none), "frame_width", "frame_height" of the extracted frames and
+                "output_width", "output_height" of the video
+        """
+        factors = []
+        if target_height:
+            factors.append(target_height / source_height)
+        if max_dimension:
+            factors.append(max_dimension / max(source_width, source_height))
+        factor = min(factors)
+        
+        scales = sorted(self.supported_models[model]["scales"])
+        scale = next((candidate for candidate in scales if candidate >= factor), scales[-1])
+        shrink = 1.0
+        if PRESHRINK_RATIO and scale >= factor * PRESHRINK_RATIO:
+            shrink = factor / scale
+        
+        def even(value: float) -> int:
+            return max(2, round(value / 2) * 2)
+        
+        frame_width, frame_height = (crop["width"], crop["height"]) if crop else (source_width, source_height)
+        if shrink < 1.0:
+            frame_width, frame_height = even(frame_width * shrink), even(frame_height * shrink)
+        return {
+            "scale": scale,
+            "factor": factor,
+            "shrink": shrink,
+            "frame_width": frame_width,
+            "frame_height": frame_height,
+            "output_width": even(source_width * factor),
+            "output_height": even(source_height * factor)
+        }
+    
+    def select_engine(
+        self,
+        scale: int,
+        frame_count: int,
+        width: int,
+        height: int,
+        backlog_seconds: float = 0.0,
+        deadline_seconds: Optional[float] = None
+    ) -> Optional[tuple]:
+        """
+        Pick the engine for an auto job
+        
+        The best quality engine whose estimated time, on top of the running jobs, fits in the deadline is
+        chosen. If none fits, the fastest engine is chosen. Quality ranks by AUTO_ENGINES, or AUTO_ENGINES_2X
+        for 2x, where the engines that run natively at 2x rank first, so that a 2x job (e.g. one planned by
+        plan_resolution) does not compute 4x output and throw most of it away.
+        
+        Args:
+            scale: Upscaling factor
+            frame_count: Number of frames of the video
+            width: Frame width in pixels
+            height: Frame height in pixels
+            backlog_seconds: Estimated remaining time of the jobs running alongside this one
+            deadline_seconds: Time left until the job should be done (None for AUTO_TARGET_SECONDS)
+            
+        Returns:
+            tuple: (engine, reason), or None if no engine supports the scale
+        """
+        deadline = AUTO_TARGET_SECONDS if deadline_seconds is None else deadline_seconds
+        estimates = {}
+        for engine in AUTO_ENGINES_2X if scale == 2 else AUTO_ENGINES:
+            if scale not in self.supported_models[engine]["scales"] or not self.check_model_availability(engine):
+                continue
+            estimate = self.estimate_seconds(engine, scale, frame_count, width, height)
+            if estimate is not None:
+                estimates[engine] = estimate
+        
+        if not estimates:
+            return None
+        
+        summary = ", ".join(f"{engine} {estimate:.0f}s" for engine, estimate in estimates.items())
+        for engine, estimate in estimates.items():
+            if backlog_seconds + estimate <= deadline:
+                reason = (f"{engine} fits the {deadline:.0f}s deadline with {backlog_seconds:.0f}s of backlog "
+                          f"(estimates: {summary})")
+                return engine, reason
+        
+        engine = min(estimates, key=estimates.get)
+        reason = (f"no engine fits the {deadline:.0f}s deadline with {backlog_seconds:.0f}s of backlog, "
+                  f"using the fastest (estimates: {summary})")
+        return engine, reason
+    
     def estimate_processing_time(self, frame_count: int, model: str = "waifu2x") -> float:
         """
         Estimate processing time for given number of frames
@@ -405,6 +1066,7 @@ class ClarityService:
             "test": 0.1,
             "waifu2x": 2.0,
             "esrgan": 5.0,
+            "esrgan_video": 1.5,
             "anime4k": 0.5
         }
         
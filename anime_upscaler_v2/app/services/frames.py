@@ -1,75 +1,249 @@
 import subprocess
 import os
+import re
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import logging
-import json
+
+from .probe import ProbeService
+from .manifest import FrameManifest
+from ..framestore import FrameStore, STORE_FORMAT, STORE_PIX_FMT, HEADER_SIZE, store_path, allocate
+from ..tracing import traced_run
 
 logger = logging.getLogger(__name__)
 
+# Intermediate frame formats for the on-disk pipeline and the FFmpeg options used to write them.
+# Intermediate frames are deleted with the job, so the defaults favour encode/decode speed over size:
+# PNG at zlib level 1, or uncompressed PPM/BMP. raw keeps all frames of a directory in one memory-mapped
+# frame store (see app/framestore.py) instead of one file per frame.
+FRAME_FORMATS = {
+    "png": ["-compression_level", "1"],
+    "ppm": [],
+    "bmp": [],
+    "jpg": ["-q:v", "2"],
+    STORE_FORMAT: ["-pix_fmt", STORE_PIX_FMT],
+}
+
+# Format shared by all services, set with the FRAME_FORMAT environment variable
+FRAME_FORMAT = os.getenv("FRAME_FORMAT", "png").lower()
+if FRAME_FORMAT not in FRAME_FORMATS:
+    logger.warning(f"Unsupported FRAME_FORMAT {FRAME_FORMAT!r}, using png")
+    FRAME_FORMAT = "png"
+
+# Black bar detection: pixels up to CROP_LIMIT (0-255) count as black, and FFmpeg cropdetect looks at
+# CROP_SAMPLES points spread over the video. Bars are only cropped if they cover at least CROP_MIN_FRACTION
+# of the frame.
+CROP_LIMIT = int(os.getenv("CROP_LIMIT", "24"))
+CROP_SAMPLES = int(os.getenv("CROP_SAMPLES", "8"))
+CROP_MIN_FRACTION = 0.02
+
+CROPDETECT_PATTERN = re.compile(r"crop=(-?\d+):(-?\d+):(-?\d+):(-?\d+)")
+
 class FrameService:
     """Service for extracting and processing video frames"""
     
     @staticmethod
     def get_video_info(video_file: Path) -> Optional[dict]:
         """
-        Get video information using FFprobe
+        Get video information from the cached FFprobe analysis of the file
         
         Returns:
             dict: Video information or None if failed
         """
+        info = ProbeService.probe(video_file)
+        if not info or not info["video"]:
+            logger.error(f"No video stream found in {video_file}")
+            return None
+        return info["video"]
+    
+    @staticmethod
+    def detect_crop(video_file: Path, samples: int = CROP_SAMPLES) -> Optional[dict]:
+        """
+        Find the active picture area of a letterboxed or pillarboxed video
+        
+        FFmpeg cropdetect runs on a few frames at each sample point, and the area is the union of the
+        areas found, so that no sample loses picture. Samples that are black all over are ignored.
+        
+        Args:
+            video_file: Path to video file
+            samples: Number of points of the video to sample
+        
+        Returns:
+            dict: "width", "height", "x", "y" of the active area and "source_width", "source_height" of the
+                frame, or None if the video has no black bars worth cropping
+        """
+        try:
+            video_info = FrameService.get_video_info(video_file)
+            if not video_info:
+                return None
+            width, height = video_info["width"], video_info["height"]
+            duration = video_info["duration"]
+            
+            areas = []
+            for sample in range(samples):
+                cmd = [
+                    "ffmpeg",
+                    "-ss", f"{duration * (sample + 0.5) / samples:.3f}",
+                    "-i", str(video_file),
+                    "-vf", f"cropdetect=limit={CROP_LIMIT}:round=2",
+                    "-frames:v", "5",
+                    "-an",
+                    "-f", "null",
+                    "-"
+                ]
+                result = traced_run(
+                    cmd,
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+                # cropdetect accumulates the area over the frames, so its last line covers all of them
+                detected = CROPDETECT_PATTERN.findall(result.stderr)
+                if detected:
+                    w, h, x, y = (int(value) for value in detected[-1])
+                    if w > 0 and h > 0:
+                        areas.append((x, y, x + w, y + h))
+            
+            if not areas:
+                return None
+            
+            # Even bounds, as chroma subsampled frames need them
+            left = max(0, min(area[0] for area in areas)) // 2 * 2
+            top = max(0, min(area[1] for area in areas)) // 2 * 2
+            right = min(width, (max(area[2] for area in areas) + 1) // 2 * 2)
+            bottom = min(height, (max(area[3] for area in areas) + 1) // 2 * 2)
+            
+            crop_width, crop_height = right - left, bottom - top
+            if crop_width <= 0 or crop_height <= 0:
+                return None
+            if crop_width * crop_height > (1 - CROP_MIN_FRACTION) * width * height:
+                return None
+            
+            logger.info(f"Active picture area of {video_file}: {crop_width}x{crop_height} at {left},{top} "
+                        f"of {width}x{height}")
+            return {
+                "width": crop_width,
+                "height": crop_height,
+                "x": left,
+                "y": top,
+                "source_width": width,
+                "source_height": height
+            }
+        
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg cropdetect error: {e.stderr}")
+            return None
+        except Exception as e:
+            logger.error(f"Crop detection failed: {str(e)}")
+            return None
+    
+    @staticmethod
+    def output_filter_args(crop: Optional[dict] = None, size: Optional[Tuple[int, int]] = None) -> List[str]:
+        """
+        FFmpeg options that turn enhanced frames into the output picture
+        
+        Args:
+            crop: Area the frames were cropped to; the black bars are padded back (see pad_filter)
+            size: Width and height of the output, reached with a Lanczos resize
+        
+        Returns:
+            List[str]: A -vf option, or nothing if the frames are the output picture
+        """
+        filters = []
+        if crop:
+            filters.append(FrameService.pad_filter(crop))
+        if size:
+            filters.append(f"scale={size[0]}:{size[1]}:flags=lanczos")
+        return ["-vf", ",".join(filters)] if filters else []
+    
+    @staticmethod
+    def pad_filter(crop: dict) -> str:
+        """
+        FFmpeg filter that puts frames of a cropped area back into the full frame, with black bars
+        
+        The bars are sized relative to the input frames, so the filter works at any upscaling factor.
+        """
+        w, h = crop["width"], crop["height"]
+        return (
+            f"pad=w=iw*{crop['source_width']}/{w}:h=ih*{crop['source_height']}/{h}"
+            f":x=iw*{crop['x']}/{w}:y=ih*{crop['y']}/{h}:color=black"
+        )
+    
+    @staticmethod
+    def extract_clip(
+        input_video: Path,
+        output_video: Path,
+        start: float = 0.0,
+        duration: float = 5.0,
+        max_height: Optional[int] = None
+    ) -> bool:
+        """
+        Cut a short clip out of a video, e.g. for previews
+        
+        Args:
+            input_video: Path to input video file
+            output_video: Path to output clip
+            start: Start of the clip in seconds
+            duration: Length of the clip in seconds
+            max_height: Downscale the clip to at most this many lines (None to keep the size)
+        
+        Returns:
+            bool: True if the clip was created, False otherwise
+        """
         try:
+            output_video.parent.mkdir(parents=True, exist_ok=True)
+            
+            # Seek before the input so that only the clip is decoded
             cmd = [
-                "ffprobe",
-                "-v", "quiet",
-                "-print_format", "json",
-                "-show_streams",
-                "-select_streams", "v:0",
-                str(video_file)
+                "ffmpeg",
+                "-ss", str(start),
+                "-t", str(duration),
+                "-i", str(input_video),
             ]
             
-            result = subprocess.run(
+            if max_height:
+                cmd.extend(["-vf", f"scale=-2:'min(ih,{max_height})'"])
+            
+            cmd.extend([
+                "-c:v", "libx264",
+                "-preset", "ultrafast",
+                "-crf", "18",
+                "-c:a", "aac",
+                "-y",
+                str(output_video)
+            ])
+            
+            logger.info(f"Extracting clip: {' '.join(cmd)}")
+            
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
                 check=True
             )
             
-            data = json.loads(result.stdout)
-            
-            if data.get("streams"):
-                stream = data["streams"][0]
-                
-                # Parse frame rate
-                fps_str = stream.get("r_frame_rate", "24/1")
-                if "/" in fps_str:
-                    num, den = fps_str.split("/")
-                    fps = float(num) / float(den)
-                else:
-                    fps = float(fps_str)
+            if output_video.exists() and output_video.stat().st_size > 0:
+                logger.info(f"Clip extraction successful: {output_video}")
+                return True
+            else:
+                logger.error("Clip file was not created or is empty")
+                return False
                 
-                return {
-                    "width": int(stream.get("width", 0)),
-                    "height": int(stream.get("height", 0)),
-                    "fps": fps,
-                    "duration": float(stream.get("duration", 0)),
-                    "codec": stream.get("codec_name"),
-                    "pixel_format": stream.get("pix_fmt"),
-                    "frame_count": int(stream.get("nb_frames", 0))
-                }
-            
-            return None
-            
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg error: {e.stderr}")
+            return False
         except Exception as e:
-            logger.error(f"Failed to get video info: {str(e)}")
-            return None
+            logger.error(f"Clip extraction failed: {str(e)}")
+            return False
     
     @staticmethod
     def extract_frames(
         input_video: Path, 
         output_dir: Path, 
         fps: Optional[float] = None,
-        format: str = "png"
+        format: str = FRAME_FORMAT,
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None
     ) -> bool:
         """
         Extract frames from video
@@ -78,11 +252,16 @@ class FrameService:
             input_video: Path to input video file
             output_dir: Directory to save extracted frames
             fps: Target frame rate (None to keep original)
-            format: Output image format (png, jpg)
+            format: Output image format (png, ppm, bmp, jpg)
+            crop: Extract only this area of the frames (see detect_crop)
+            size: Shrink the (cropped) frames to this width and height with a Lanczos resize
         
         Returns:
             bool: True if extraction successful, False otherwise
         """
+        if format == STORE_FORMAT:
+            return FrameService.extract_frames_to_store(input_video, output_dir, fps=fps, crop=crop, size=size)
+        
         try:
             # Ensure output directory exists
             output_dir.mkdir(parents=True, exist_ok=True)
@@ -94,21 +273,20 @@ class FrameService:
                 "-vsync", "0",  # Preserve original frame timing
             ]
             
-            # Add frame rate filter if specified
-            if fps:
-                cmd.extend(["-vf", f"fps={fps}"])
+            # Add crop and frame rate filters if specified; showinfo logs the timestamp and checksum of each frame
+            cmd.extend(["-vf", FrameService._frame_filters(fps, crop, size)])
             
             # Add output options
             cmd.extend([
                 "-f", "image2",
-                "-q:v", "2" if format == "jpg" else "1",  # Quality
+                *FRAME_FORMATS[format],
                 "-y",  # Overwrite output files
                 str(output_dir / f"frame_%06d.{format}")
             ])
             
             logger.info(f"Extracting frames: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -116,9 +294,10 @@ class FrameService:
             )
             
             # Verify frames were extracted
-            frame_files = list(output_dir.glob(f"frame_*.{format}"))
-            if frame_files:
-                logger.info(f"Extracted {len(frame_files)} frames to {output_dir}")
+            manifest = FrameService._write_manifest(input_video, output_dir, result.stderr, format, fps)
+            frame_count = len(manifest) if manifest else len(list(output_dir.glob(f"frame_*.{format}")))
+            if frame_count:
+                logger.info(f"Extracted {frame_count} frames to {output_dir}")
                 return True
             else:
                 logger.error("No frames were extracted")
@@ -132,9 +311,151 @@ class FrameService:
             return False
     
     @staticmethod
-    def get_frame_list(frames_dir: Path, format: str = "png") -> List[Path]:
+    def extract_frames_to_store(
+        input_video: Path,
+        output_dir: Path,
+        fps: Optional[float] = None,
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None
+    ) -> bool:
         """
-        Get sorted list of frame files
+        Decode a video straight into the frame store of output_dir
+        
+        The store is allocated for the probed frame count and FFmpeg writes the raw BGR frames into it
+        through its stdout, so no frame is written as a file or encoded as an image.
+        
+        Args:
+            input_video: Path to input video file
+            output_dir: Directory of the frame store
+            fps: Target frame rate (None to keep original)
+            crop: Extract only this area of the frames (see detect_crop)
+            size: Shrink the (cropped) frames to this width and height
+        
+        Returns:
+            bool: True if extraction successful, False otherwise
+        """
+        try:
+            video_info = FrameService.get_video_info(input_video)
+            if not video_info:
+                return False
+            width, height = video_info["width"], video_info["height"]
+            if crop:
+                width, height = crop["width"], crop["height"]
+            if size:
+                width, height = size
+            frame_count = video_info["frame_count"]
+            if fps:
+                frame_count = int(video_info["duration"] * fps) + 1
+            
+            path = store_path(output_dir)
+            FrameStore.create(path, 0, height, width)
+            
+            cmd = [
+                "ffmpeg",
+                "-i", str(input_video),
+                "-vsync", "0",  # Preserve original frame timing
+            ]
+            
+            cmd.extend(["-vf", FrameService._frame_filters(fps, crop, size)])
+            
+            cmd.extend([
+                "-f", "rawvideo",
+                *FRAME_FORMATS[STORE_FORMAT],
+                "pipe:1"
+            ])
+            
+            logger.info(f"Extracting frames: {' '.join(cmd)} > {path}")
+            
+            # FFmpeg writes the frames after the header, into the space allocated for them
+            with path.open("r+b") as f:
+                allocate(f.fileno(), HEADER_SIZE + frame_count * width * height * 3)
+                f.seek(HEADER_SIZE)
+                result = traced_run(
+                    cmd,
+                    stdout=f,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    check=True
+                )
+                # FFmpeg shares the file offset, which ends after its last frame
+                written = os.lseek(f.fileno(), 0, os.SEEK_CUR) - HEADER_SIZE
+            
+            frame_bytes = width * height * 3
+            if written <= 0 or written % frame_bytes:
+                logger.error(f"FFmpeg wrote {written} bytes, not a whole number of {width}x{height} frames")
+                return False
+            
+            FrameStore.write_header(path, written // frame_bytes, height, width)
+            FrameService._write_manifest(input_video, output_dir, result.stderr, STORE_FORMAT, fps)
+            logger.info(f"Extracted {written // frame_bytes} frames to {path}")
+            return True
+            
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg error: {e.stderr}")
+            return False
+        except Exception as e:
+            logger.error(f"Frame extraction failed: {str(e)}")
+            return False
+    
+    @staticmethod
+    def _frame_filters(
+        fps: Optional[float],
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None
+    ) -> str:
+        """Extraction filter graph: optional crop, resize and frame rate conversion, then showinfo for the manifest"""
+        filters = []
+        if crop:
+            filters.append(f"crop={crop['width']}:{crop['height']}:{crop['x']}:{crop['y']}")
+        if size:
+            filters.append(f"scale={size[0]}:{size[1]}:flags=lanczos")
+        if fps:
+            filters.append(f"fps={fps}")
+        return ",".join(filters + ["showinfo"])
+    
+    @staticmethod
+    def _write_manifest(
+        input_video: Path,
+        output_dir: Path,
+        ffmpeg_log: str,
+        format: str,
+        fps: Optional[float]
+    ) -> Optional[FrameManifest]:
+        """
+        Write the manifest of freshly extracted frames from the showinfo lines of the FFmpeg log
+        
+        Returns:
+            FrameManifest: The manifest, or None if the log does not describe the extracted frames
+        """
+        if not fps:
+            video_info = FrameService.get_video_info(input_video)
+            fps = video_info["fps"] if video_info else 24.0
+        manifest = FrameManifest.from_showinfo(ffmpeg_log or "", format, fps)
+        
+        if manifest and format == STORE_FORMAT:
+            store = FrameStore.open(output_dir)
+            complete = store is not None and len(store) == len(manifest)
+        elif manifest:
+            # Frames are numbered without gaps, so the last one must exist and have no successor
+            complete = (output_dir / manifest.file_name(len(manifest) - 1)).exists() and \
+                not (output_dir / manifest.file_name(len(manifest))).exists()
+        else:
+            complete = False
+        
+        if not complete:
+            logger.warning(f"No frame manifest for {output_dir}, frames will be listed from the directory")
+            return None
+        
+        manifest.save(output_dir)
+        duplicates = sum(1 for frame in manifest.frames if frame["duplicate_of"] is not None)
+        logger.info(f"Frame manifest: {len(manifest)} frames, {duplicates} duplicates, "
+                    f"{'constant' if manifest.is_constant_rate() else 'variable'} frame rate")
+        return manifest
+    
+    @staticmethod
+    def get_frame_list(frames_dir: Path, format: str = FRAME_FORMAT) -> List[Path]:
+        """
+        Get sorted list of frame files, from the frame manifest if the directory has one
         
         Args:
             frames_dir: Directory containing frames
@@ -143,16 +464,89 @@ class FrameService:
         Returns:
             List[Path]: Sorted list of frame file paths
         """
+        manifest = FrameManifest.load(frames_dir)
+        if manifest and manifest.format == format:
+            return manifest.files(frames_dir)
         frame_files = list(frames_dir.glob(f"frame_*.{format}"))
         frame_files.sort()  # Ensure proper ordering
         return frame_files
     
+    @staticmethod
+    def count_frames(frames_dir: Path, format: str = FRAME_FORMAT) -> int:
+        """Number of frames in a frame directory"""
+        if format == STORE_FORMAT:
+            store = FrameStore.open(frames_dir)
+            return len(store) if store else 0
+        return len(FrameService.get_frame_list(frames_dir, format))
+    
+    @staticmethod
+    def uses_timestamps(frames_dir: Path, format: str = FRAME_FORMAT) -> bool:
+        """
+        Whether the frames of a directory are encoded with their own timestamps instead of a constant rate
+        
+        That is the case for image frames whose manifest shows a variable frame rate. Frame stores are
+        extracted at a constant rate and always read at it.
+        """
+        if format == STORE_FORMAT:
+            return False
+        manifest = FrameManifest.load(frames_dir)
+        return bool(manifest) and manifest.format == format and not manifest.is_constant_rate()
+    
+    @staticmethod
+    def input_args(
+        frames_dir: Path,
+        fps: float,
+        format: str = FRAME_FORMAT,
+        start_frame: int = 1,
+        constant_rate: bool = False
+    ) -> List[str]:
+        """
+        FFmpeg input options that read the frames of a directory
+        
+        Args:
+            frames_dir: Directory containing frames
+            fps: Frame rate of the frames
+            format: Frame format
+            start_frame: Number of the first frame to read (frame_%06d numbering, starting at 1)
+            constant_rate: Read the frames at fps even if the manifest gives them their own timestamps
+        
+        Returns:
+            List[str]: Options up to and including the -i input
+        """
+        if not constant_rate and start_frame == 1 and FrameService.uses_timestamps(frames_dir, format):
+            # Concat script with the duration of every frame from the manifest
+            manifest = FrameManifest.load(frames_dir)
+            return ["-f", "concat", "-i", str(manifest.write_concat(frames_dir))]
+        if format == STORE_FORMAT:
+            # Rawvideo from the store, skipping its header and the frames before start_frame
+            store = FrameStore.open(frames_dir)
+            return [
+                "-f", "rawvideo",
+                "-pix_fmt", STORE_PIX_FMT,
+                "-video_size", f"{store.width}x{store.height}",
+                "-framerate", str(fps),
+                "-skip_initial_bytes", str(HEADER_SIZE + (start_frame - 1) * store.frame_bytes),
+                "-i", str(store.path)
+            ]
+        return [
+            "-framerate", str(fps),
+            "-start_number", str(start_frame),
+            "-i", str(frames_dir / f"frame_%06d.{format}")
+        ]
+    
+    @staticmethod
+    def output_args(frames_dir: Path, format: str = FRAME_FORMAT) -> List[str]:
+        """FFmpeg output options that keep the frame timing of input_args"""
+        if FrameService.uses_timestamps(frames_dir, format):
+            return ["-vsync", "vfr"]  # Keep the timestamps instead of converting to a constant rate
+        return []
+    
     @staticmethod
     def frames_to_video(
         frames_dir: Path,
         output_video: Path,
         fps: float = 24.0,
-        format: str = "png",
+        format: str = FRAME_FORMAT,
         codec: str = "libx264"
     ) -> bool:
         """
@@ -173,15 +567,14 @@ class FrameService:
             output_video.parent.mkdir(parents=True, exist_ok=True)
             
             # Verify frames exist
-            frame_pattern = frames_dir / f"frame_%06d.{format}"
-            if not list(frames_dir.glob(f"frame_*.{format}")):
+            if not FrameService.count_frames(frames_dir, format):
                 logger.error(f"No frames found in {frames_dir}")
                 return False
             
             cmd = [
                 "ffmpeg",
-                "-framerate", str(fps),
-                "-i", str(frame_pattern),
+                *FrameService.input_args(frames_dir, fps, format),
+                *FrameService.output_args(frames_dir, format),
                 "-c:v", codec,
                 "-pix_fmt", "yuv420p",  # Ensure compatibility
                 "-crf", "18",  # High quality
@@ -192,7 +585,7 @@ class FrameService:
             
             logger.info(f"Creating video from frames: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
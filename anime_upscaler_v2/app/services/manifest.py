@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import shutil
+import logging
+import statistics
+from pathlib import Path
+from typing import Optional, List, Dict
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+CONCAT_NAME = "frames.ffconcat"
+MANIFEST_VERSION = 1
+
+# One line of the FFmpeg showinfo filter per frame: frame number, timestamp, size and Adler-32 checksum
+SHOWINFO_PATTERN = re.compile(
+    r"\bn:\s*(\d+)\s+pts:\s*-?\d+\s+pts_time:(-?[\d.e+-]+).*?\ss:(\d+)x(\d+).*?\schecksum:([0-9A-Fa-f]+)"
+)
+
+class FrameManifest:
+    """
+    Frames of a frame directory with their source timestamps, written when the frames are extracted
+    
+    Later stages read the frame list from the manifest instead of scanning the directory, and the encoder
+    uses the timestamps, so variable frame rate sources keep their timing. Runs of identical frames (held
+    frames) point to their first frame, which is the only one that needs to be enhanced.
+    
+    Args:
+        frames: One dict per frame, in order: "index", "pts" (seconds), "checksum" (Adler-32 of the decoded
+            frame, None for enhanced frames) and "duplicate_of" (index of the identical frame it repeats, or None)
+        width: Frame width in pixels
+        height: Frame height in pixels
+        format: Frame format (file extension, or raw for a frame store)
+        fps: Nominal frame rate of the frames
+    """
+    
+    def __init__(self, frames: List[dict], width: int, height: int, format: str, fps: float):
+        self.frames = frames
+        self.width = width
+        self.height = height
+        self.format = format
+        self.fps = fps
+    
+    def __len__(self) -> int:
+        return len(self.frames)
+    
+    @staticmethod
+    def from_showinfo(output: str, format: str, fps: float) -> Optional["FrameManifest"]:
+        """
+        Build a manifest from the log of the FFmpeg showinfo filter
+        
+        Args:
+            output: FFmpeg stderr with one showinfo line per frame
+            format: Frame format of the extracted frames
+            fps: Nominal frame rate of the extracted frames
+        
+        Returns:
+            FrameManifest: The manifest, or None if the log has no frames
+        """
+        frames = []
+        width = height = 0
+        for match in SHOWINFO_PATTERN.finditer(output):
+            index = int(match.group(1))
+            if index != len(frames):
+                logger.warning(f"Unexpected showinfo frame number {index}, expected {len(frames)}")
+                return None
+            width, height = int(match.group(3)), int(match.group(4))
+            checksum = match.group(5).upper()
+            duplicate_of = None
+            if frames and frames[-1]["checksum"] == checksum:
+                previous = frames[-1]
+                duplicate_of = previous["index"] if previous["duplicate_of"] is None else previous["duplicate_of"]
+            frames.append({
+                "index": index,
+                "pts": float(match.group(2)),
+                "checksum": checksum,
+                "duplicate_of": duplicate_of
+            })
+        
+        if not frames:
+            return None
+        return FrameManifest(frames, width, height, format, fps)
+    
+    @staticmethod
+    def load(frames_dir: Path) -> Optional["FrameManifest"]:
+        """The manifest of a frame directory, or None if it has none"""
+        path = frames_dir / MANIFEST_NAME
+        if not path.exists():
+            return None
+        try:
+            data = json.loads(path.read_text())
+            return FrameManifest(data["frames"], data["width"], data["height"], data["format"], data["fps"])
+        except (ValueError, KeyError) as e:
+            logger.error(f"Invalid frame manifest {path}: {str(e)}")
+            return None
+    
+    def save(self, frames_dir: Path):
+        """Write the manifest into a frame directory"""
+        frames_dir.mkdir(parents=True, exist_ok=True)
+        data = {
+            "version": MANIFEST_VERSION,
+            "width": self.width,
+            "height": self.height,
+            "format": self.format,
+            "fps": self.fps,
+            "frames": self.frames
+        }
+        (frames_dir / MANIFEST_NAME).write_text(json.dumps(data))
+    
+    def derive(self, width: int, height: int, format: str) -> "FrameManifest":
+        """Manifest of frames made from these frames one to one (e.g. enhanced), with the same timing"""
+        frames = [{**frame, "checksum": None} for frame in self.frames]
+        return FrameManifest(frames, width, height, format, self.fps)
+    
+    def file_name(self, index: int) -> str:
+        """File name of a frame (frame_%06d numbering, starting at 1)"""
+        return f"frame_{index + 1:06d}.{self.format}"
+    
+    def files(self, frames_dir: Path) -> List[Path]:
+        """Paths of all frames, in order"""
+        return [frames_dir / self.file_name(frame["index"]) for frame in self.frames]
+    
+    def duplicates(self) -> Dict[int, List[int]]:
+        """Indexes of the duplicates of each frame that has any"""
+        duplicates = {}
+        for frame in self.frames:
+            if frame["duplicate_of"] is not None:
+                duplicates.setdefault(frame["duplicate_of"], []).append(frame["index"])
+        return duplicates
+    
+    def durations(self) -> List[float]:
+        """Display duration of each frame in seconds; the last frame lasts as long as a typical frame"""
+        pts = [frame["pts"] for frame in self.frames]
+        durations = [next_pts - current for current, next_pts in zip(pts, pts[1:])]
+        typical = statistics.median(durations) if durations else 1 / self.fps
+        return durations + [typical]
+    
+    def is_constant_rate(self) -> bool:
+        """Whether every frame lasts 1/fps, within the rounding of the container timestamps"""
+        tolerance = min(0.002, 0.1 / self.fps)
+        return all(abs(duration - 1 / self.fps) <= tolerance for duration in self.durations()[:-1])
+    
+    def write_concat(self, frames_dir: Path) -> Path:
+        """
+        Write an FFmpeg concat script that shows each frame for its own duration
+        
+        Returns:
+            Path: The script, next to the frames
+        """
+        names = [self.file_name(frame["index"]) for frame in self.frames]
+        return write_concat_script(frames_dir / CONCAT_NAME, names, self.durations())
+    
+    def start_times(self) -> List[float]:
+        """Position of each frame in the encoded video in seconds, which starts with the first frame"""
+        first = self.frames[0]["pts"]
+        return [frame["pts"] - first for frame in self.frames]
+
+def write_concat_script(path: Path, names: List[str], durations: List[float]) -> Path:
+    """Write an FFmpeg concat script that shows each frame file (relative to the script) for its duration"""
+    lines = ["ffconcat version 1.0"]
+    for name, duration in zip(names, durations):
+        lines.extend([f"file '{name}'", f"duration {duration:.6f}"])
+    # The duration of the last file only applies if it is followed by another entry
+    lines.append(f"file '{names[-1]}'")
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+def link_frame(source: Path, destination: Path):
+    """Make destination the same frame as source, as a hard link where the file system allows it"""
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
@@ -1,12 +1,23 @@
 import subprocess
 import os
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 import logging
-import json
+
+from .frames import FrameService, FRAME_FORMAT
+from .manifest import write_concat_script
+from .probe import ProbeService
+from ..tracing import traced_run
 
 logger = logging.getLogger(__name__)
 
+# x264 CRF and preset of each quality preset
+QUALITY_SETTINGS = {
+    "high": {"crf": "18", "preset": "slow"},
+    "medium": {"crf": "23", "preset": "medium"},
+    "fast": {"crf": "28", "preset": "fast"}
+}
+
 class MergeService:
     """Service for merging enhanced frames with audio to create final video"""
     
@@ -18,7 +29,10 @@ class MergeService:
         fps: float = 24.0,
         video_codec: str = "libx264",
         audio_codec: str = "aac",
-        quality: str = "high"
+        quality: str = "high",
+        format: str = FRAME_FORMAT,
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None
     ) -> bool:
         """
         Merge enhanced frames with extracted audio to create final video
@@ -31,6 +45,10 @@ class MergeService:
             video_codec: Video codec to use
             audio_codec: Audio codec to use
             quality: Quality preset (high, medium, fast)
+            format: Frame image format
+            crop: Area the frames were cropped to (see FrameService.detect_crop); the black bars around it
+                are padded back at the size of the enhanced frames
+            size: Resize the video to this width and height (target resolution jobs)
             
         Returns:
             bool: True if merge successful, False otherwise
@@ -40,13 +58,7 @@ class MergeService:
             output_video.parent.mkdir(parents=True, exist_ok=True)
             
             # Verify frames exist
-            frame_pattern = frames_dir / "frame_%06d.png"
-            frame_files = list(frames_dir.glob("frame_*.png"))
-            if not frame_files:
-                frame_files = list(frames_dir.glob("frame_*.jpg"))
-                frame_pattern = frames_dir / "frame_%06d.jpg"
-            
-            if not frame_files:
+            if not FrameService.count_frames(frames_dir, format):
                 logger.error(f"No frames found in {frames_dir}")
                 return False
             
@@ -56,20 +68,15 @@ class MergeService:
                 return False
             
             # Set quality parameters based on preset
-            quality_settings = {
-                "high": {"crf": "18", "preset": "slow"},
-                "medium": {"crf": "23", "preset": "medium"},
-                "fast": {"crf": "28", "preset": "fast"}
-            }
-            
-            settings = quality_settings.get(quality, quality_settings["medium"])
+            settings = QUALITY_SETTINGS.get(quality, QUALITY_SETTINGS["medium"])
             
             # Build FFmpeg command
             cmd = [
                 "ffmpeg",
-                "-framerate", str(fps),
-                "-i", str(frame_pattern),
+                *FrameService.input_args(frames_dir, fps, format),
                 "-i", str(audio_file),
+                *FrameService.output_args(frames_dir, format),
+                *FrameService.output_filter_args(crop, size),
                 "-c:v", video_codec,
                 "-c:a", audio_codec,
                 "-crf", settings["crf"],
@@ -84,7 +91,7 @@ class MergeService:
             
             logger.info(f"Merging frames and audio: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -112,7 +119,8 @@ class MergeService:
         output_video: Path,
         fps: float = 24.0,
         video_codec: str = "libx264",
-        quality: str = "high"
+        quality: str = "high",
+        format: str = FRAME_FORMAT
     ) -> bool:
         """
         Create video from frames without audio
@@ -123,6 +131,7 @@ class MergeService:
             fps: Frame rate for output video
             video_codec: Video codec to use
             quality: Quality preset (high, medium, fast)
+            format: Frame image format
             
         Returns:
             bool: True if creation successful, False otherwise
@@ -132,29 +141,17 @@ class MergeService:
             output_video.parent.mkdir(parents=True, exist_ok=True)
             
             # Verify frames exist
-            frame_pattern = frames_dir / "frame_%06d.png"
-            frame_files = list(frames_dir.glob("frame_*.png"))
-            if not frame_files:
-                frame_files = list(frames_dir.glob("frame_*.jpg"))
-                frame_pattern = frames_dir / "frame_%06d.jpg"
-            
-            if not frame_files:
+            if not FrameService.count_frames(frames_dir, format):
                 logger.error(f"No frames found in {frames_dir}")
                 return False
             
             # Set quality parameters
-            quality_settings = {
-                "high": {"crf": "18", "preset": "slow"},
-                "medium": {"crf": "23", "preset": "medium"},
-                "fast": {"crf": "28", "preset": "fast"}
-            }
-            
-            settings = quality_settings.get(quality, quality_settings["medium"])
+            settings = QUALITY_SETTINGS.get(quality, QUALITY_SETTINGS["medium"])
             
             cmd = [
                 "ffmpeg",
-                "-framerate", str(fps),
-                "-i", str(frame_pattern),
+                *FrameService.input_args(frames_dir, fps, format),
+                *FrameService.output_args(frames_dir, format),
                 "-c:v", video_codec,
                 "-crf", settings["crf"],
                 "-preset", settings["preset"],
@@ -165,7 +162,7 @@ class MergeService:
             
             logger.info(f"Creating video from frames: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -187,6 +184,116 @@ class MergeService:
             logger.error(f"Video creation failed: {str(e)}")
             return False
     
+    @staticmethod
+    def encode_segment(
+        frames_dir: Path,
+        audio_file: Path,
+        segment_file: Path,
+        start_frame: int,
+        frame_count: int,
+        fps: float = 24.0,
+        quality: str = "fast",
+        format: str = FRAME_FORMAT,
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None,
+        durations: Optional[List[float]] = None,
+        start_time: Optional[float] = None
+    ) -> bool:
+        """
+        Encode a range of enhanced frames and the matching audio into an MPEG-TS segment for HLS
+        
+        Segments are encoded independently, each starting with a keyframe, and carry their position in
+        the video as timestamps so that consecutive segments play back as one stream. Frames of a variable
+        frame rate source are shown for their own durations, as in merge_frames_and_audio, so that the
+        stream stays in sync with its audio and with the final video.
+        
+        Args:
+            frames_dir: Directory containing enhanced frames
+            audio_file: Path to extracted audio file
+            segment_file: Path to output segment (.ts)
+            start_frame: Number of the first frame (frame_%06d numbering, starting at 1)
+            frame_count: Number of frames in the segment
+            fps: Frame rate of the video
+            quality: Quality preset (high, medium, fast)
+            format: Frame image format
+            crop: Area the frames were cropped to, padded back as in merge_frames_and_audio
+            size: Resize the segment to this width and height, as in merge_frames_and_audio
+            durations: Display duration of each frame of the segment, from the frame manifest of a variable
+                frame rate source (see FrameService.uses_timestamps); None for frames at a constant fps
+            start_time: Position of the segment in the video in seconds, from the manifest with durations;
+                (start_frame - 1) / fps by default
+        
+        Returns:
+            bool: True if the segment was written, False otherwise
+        """
+        concat_file = None
+        try:
+            segment_file.parent.mkdir(parents=True, exist_ok=True)
+            
+            settings = QUALITY_SETTINGS.get(quality, QUALITY_SETTINGS["medium"])
+            if start_time is None:
+                start_time = (start_frame - 1) / fps
+            if durations:
+                # Concat script of the frames of the segment, next to them, with their own durations
+                names = [f"frame_{start_frame + offset:06d}.{format}" for offset in range(frame_count)]
+                concat_file = write_concat_script(frames_dir / f"segment_{start_frame:06d}.ffconcat", names, durations)
+                input_args = ["-f", "concat", "-i", str(concat_file)]
+                timing_args = ["-vsync", "vfr"]
+                duration = sum(durations)
+            else:
+                input_args = FrameService.input_args(
+                    frames_dir, fps, format, start_frame=start_frame, constant_rate=True
+                )
+                timing_args = []
+                duration = frame_count / fps
+            
+            cmd = [
+                "ffmpeg",
+                *input_args,
+                "-ss", f"{start_time:.6f}",
+                "-t", f"{duration:.6f}",
+                "-i", str(audio_file),
+                "-frames:v", str(frame_count),
+                *timing_args,
+                *FrameService.output_filter_args(crop, size),
+                "-c:v", "libx264",
+                "-c:a", "aac",
+                "-crf", settings["crf"],
+                "-preset", settings["preset"],
+                "-pix_fmt", "yuv420p",
+                "-map", "0:v:0",
+                "-map", "1:a:0?",  # Audio is optional
+                "-output_ts_offset", f"{start_time:.6f}",
+                "-f", "mpegts",
+                "-y",
+                str(segment_file)
+            ]
+            
+            logger.info(f"Encoding segment: {' '.join(cmd)}")
+            
+            traced_run(
+                cmd,
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            
+            if segment_file.exists() and segment_file.stat().st_size > 0:
+                return True
+            else:
+                logger.error(f"Segment was not created: {segment_file}")
+                return False
+        
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg segment error: {e.stderr}")
+            return False
+        except Exception as e:
+            logger.error(f"Segment encoding failed: {str(e)}")
+            return False
+        finally:
+            if concat_file is not None:
+                concat_file.unlink(missing_ok=True)
+    
     @staticmethod
     def optimize_video(
         input_video: Path,
@@ -237,7 +344,7 @@ class MergeService:
             
             logger.info(f"Optimizing video: {' '.join(cmd)}")
             
-            result = subprocess.run(
+            result = traced_run(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -262,27 +369,6 @@ class MergeService:
     @staticmethod
     def _get_video_duration(video_file: Path) -> Optional[float]:
         """Get video duration in seconds"""
-        try:
-            cmd = [
-                "ffprobe",
-                "-v", "quiet",
-                "-print_format", "json",
-                "-show_format",
-                str(video_file)
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            
-            data = json.loads(result.stdout)
-            duration = data.get("format", {}).get("duration")
-            
-            return float(duration) if duration else None
-            
-        except Exception as e:
-            logger.error(f"Failed to get video duration: {str(e)}")
-            return None
\ No newline at end of file
+        info = ProbeService.probe(video_file)
+        duration = info["format"]["duration"] if info else None
+        return duration or None
@@ -0,0 +1,183 @@
+import subprocess
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, List
+import logging
+import json
+
+from ..tracing import traced_run
+
+logger = logging.getLogger(__name__)
+
+# Number of probed files kept in memory
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "64"))
+
+def parse_rate(rate: Optional[str]) -> float:
+    """Parse an FFprobe frame rate such as "24000/1001" (0.0 if unknown)"""
+    try:
+        if rate and "/" in rate:
+            num, den = rate.split("/")
+            return float(num) / float(den) if float(den) else 0.0
+        return float(rate) if rate else 0.0
+    except ValueError:
+        return 0.0
+
+class ProbeService:
+    """
+    Single FFprobe analysis per media file, shared by the other services
+    
+    One FFprobe run reads the streams, the container format and every packet of the file, which gives the
+    keyframe index and an exact frame count when the container does not store nb_frames. Results are
+    cached by path, size and modification time, so the services of a job all reuse the probe of its input.
+    """
+    
+    _cache: "OrderedDict[tuple, dict]" = OrderedDict()
+    _lock = threading.Lock()
+    
+    @staticmethod
+    def probe(media_file: Path) -> Optional[dict]:
+        """
+        Analyze a media file, or return the cached analysis
+        
+        Args:
+            media_file: Path to the video or audio file
+        
+        Returns:
+            dict: "format", "video" and "audio" information (video and audio are None if the file has no
+                such stream), or None if the file could not be probed
+        """
+        try:
+            stat = media_file.stat()
+        except OSError as e:
+            logger.error(f"Failed to probe {media_file}: {str(e)}")
+            return None
+        key = (str(media_file.resolve()), stat.st_size, stat.st_mtime_ns)
+        
+        with ProbeService._lock:
+            if key in ProbeService._cache:
+                ProbeService._cache.move_to_end(key)
+                return ProbeService._cache[key]
+        
+        info = ProbeService._run_probe(media_file)
+        if info is None:
+            return None
+        
+        with ProbeService._lock:
+            ProbeService._cache[key] = info
+            while len(ProbeService._cache) > PROBE_CACHE_SIZE:
+                ProbeService._cache.popitem(last=False)
+        return info
+    
+    @staticmethod
+    def clear_cache():
+        """Forget all cached analyses"""
+        with ProbeService._lock:
+            ProbeService._cache.clear()
+    
+    @staticmethod
+    def _run_probe(media_file: Path) -> Optional[dict]:
+        """Run FFprobe and parse its output"""
+        try:
+            cmd = [
+                "ffprobe",
+                "-v", "quiet",
+                "-print_format", "json",
+                "-show_format",
+                "-show_streams",
+                "-count_packets",
+                "-show_entries", "packet=stream_index,pts_time,flags",
+                str(media_file)
+            ]
+            
+            result = traced_run(
+                cmd,
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            
+            return ProbeService.parse(json.loads(result.stdout))
+        
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFprobe error: {e.stderr}")
+            return None
+        except Exception as e:
+            logger.error(f"Failed to probe {media_file}: {str(e)}")
+            return None
+    
+    @staticmethod
+    def parse(data: dict) -> dict:
+        """
+        Build the analysis from FFprobe JSON output
+        
+        Args:
+            data: Output of ffprobe -print_format json with streams, format and packets
+        
+        Returns:
+            dict: "format", "video" and "audio" information
+        """
+        fmt = data.get("format", {})
+        format_duration = float(fmt.get("duration", 0) or 0)
+        streams = data.get("streams", [])
+        video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+        audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        
+        video = None
+        if video_stream:
+            avg_fps = parse_rate(video_stream.get("avg_frame_rate"))
+            r_fps = parse_rate(video_stream.get("r_frame_rate"))
+            # avg_frame_rate is frames / duration, r_frame_rate the base rate of the timestamps; they
+            # differ for variable frame rate video, where only the average keeps the duration
+            fps = avg_fps or r_fps or 24.0
+            duration = float(video_stream.get("duration", 0) or 0) or format_duration
+            frame_count = int(video_stream.get("nb_frames", 0) or 0) or int(video_stream.get("nb_read_packets", 0) or 0)
+            
+            video = {
+                "width": int(video_stream.get("width", 0)),
+                "height": int(video_stream.get("height", 0)),
+                "fps": fps,
+                "avg_frame_rate": avg_fps,
+                "r_frame_rate": r_fps,
+                "vfr": bool(avg_fps and r_fps and abs(avg_fps - r_fps) / r_fps > 0.001),
+                "duration": duration,
+                "codec": video_stream.get("codec_name"),
+                "pixel_format": video_stream.get("pix_fmt"),
+                "frame_count": frame_count,
+                "keyframes": ProbeService._keyframes(data.get("packets", []), video_stream.get("index"))
+            }
+        
+        audio = None
+        if audio_stream:
+            audio = {
+                "codec": audio_stream.get("codec_name"),
+                "duration": float(audio_stream.get("duration", 0) or 0) or format_duration,
+                "sample_rate": int(audio_stream.get("sample_rate", 0) or 0),
+                "channels": int(audio_stream.get("channels", 0) or 0),
+                "bit_rate": int(audio_stream.get("bit_rate", 0) or 0)
+            }
+        
+        return {
+            "format": {
+                "format_name": fmt.get("format_name"),
+                "duration": format_duration,
+                "size": int(fmt.get("size", 0) or 0),
+                "bit_rate": int(fmt.get("bit_rate", 0) or 0)
+            },
+            "video": video,
+            "audio": audio
+        }
+    
+    @staticmethod
+    def _keyframes(packets: List[dict], stream_index: Optional[int]) -> List[float]:
+        """Sorted timestamps in seconds of the keyframe packets of a stream"""
+        keyframes = []
+        for packet in packets:
+            if packet.get("stream_index") != stream_index or "K" not in packet.get("flags", ""):
+                continue
+            try:
+                keyframes.append(float(packet["pts_time"]))
+            except (KeyError, ValueError):
+                continue
+        return sorted(keyframes)
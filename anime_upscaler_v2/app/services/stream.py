@@ -0,0 +1,190 @@
+import contextvars
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+from .frames import FRAME_FORMAT
+from .manifest import FrameManifest
+from .merge import MergeService
+
+logger = logging.getLogger(__name__)
+
+# Target length of the HLS segments in seconds
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "6"))
+
+PLAYLIST_NAME = "playlist.m3u8"
+
+class HlsPlaylist:
+    """
+    Live HLS playlist of a job, rewritten atomically whenever a segment is added
+    
+    Args:
+        hls_dir: Directory of the playlist and its segments
+        target_duration: Longest segment duration in seconds
+    """
+    
+    def __init__(self, hls_dir: Path, target_duration: float):
+        self.hls_dir = hls_dir
+        self.target_duration = target_duration
+        self.segments: List[Tuple[str, float]] = []
+        self.ended = False
+    
+    @property
+    def path(self) -> Path:
+        return self.hls_dir / PLAYLIST_NAME
+    
+    def add_segment(self, name: str, duration: float):
+        self.segments.append((name, duration))
+        self._write()
+    
+    def end(self):
+        """Mark the stream as complete, so players stop polling the playlist"""
+        self.ended = True
+        self._write()
+    
+    def render(self) -> str:
+        target = max([self.target_duration] + [duration for _, duration in self.segments])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(target + 0.999)}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+        ]
+        for name, duration in self.segments:
+            lines.extend([f"#EXTINF:{duration:.3f},", name])
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+    
+    def _write(self):
+        self.hls_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(self.render())
+        tmp_path.replace(self.path)
+
+class SegmentEncoder(threading.Thread):
+    """
+    Encode enhanced frames into HLS segments while the rest of the video is still being enhanced
+    
+    A segment is encoded as soon as all of its frames are done. Frames are reported with frame_done;
+    finish() encodes the remaining frames and ends the playlist, stop() abandons the stream.
+    
+    Args:
+        frames_dir: Directory of the enhanced frames
+        audio_file: Extracted audio of the video
+        hls_dir: Output directory of the playlist and segments
+        frame_count: Number of frames of the video
+        fps: Frame rate of the video
+        format: Format of the enhanced frames
+        segment_seconds: Target segment length in seconds
+        crop: Area the frames were cropped to, padded back in every segment (see MergeService.encode_segment)
+        size: Width and height the segments are resized to
+        manifest: Frame manifest of a variable frame rate source (see FrameService.uses_timestamps), whose
+            timestamps place the segments and time their frames; None for frames at a constant fps
+    """
+    
+    def __init__(
+        self,
+        frames_dir: Path,
+        audio_file: Path,
+        hls_dir: Path,
+        frame_count: int,
+        fps: float,
+        format: str = FRAME_FORMAT,
+        segment_seconds: float = HLS_SEGMENT_SECONDS,
+        crop: Optional[dict] = None,
+        size: Optional[Tuple[int, int]] = None,
+        manifest: Optional[FrameManifest] = None
+    ):
+        super().__init__(name="segment-encoder", daemon=True)
+        self.frames_dir = frames_dir
+        self.audio_file = audio_file
+        self.frame_count = frame_count
+        self.fps = fps
+        self.format = format
+        self.crop = crop
+        self.size = size
+        self.segment_frames = max(1, round(fps * segment_seconds))
+        self.durations = self.start_times = None
+        if manifest is not None:
+            if len(manifest) == frame_count:
+                self.durations, self.start_times = manifest.durations(), manifest.start_times()
+            else:
+                logger.warning("Streaming at a constant frame rate, the frame manifest does not match the frames")
+        self.playlist = HlsPlaylist(hls_dir, segment_seconds)
+        self.failed = False
+        self._done: Set[int] = set()
+        self._finished = False
+        self._stopped = False
+        self._condition = threading.Condition()
+        # Segments are traced and accounted to the job that started the encoder
+        self._context = contextvars.copy_context()
+    
+    def frame_done(self, index: int):
+        """Report that the enhanced frame with 0-based index is written"""
+        with self._condition:
+            self._done.add(index)
+            self._condition.notify()
+    
+    def finish(self) -> bool:
+        """
+        Encode the remaining frames, end the playlist and wait for the encoder
+        
+        Returns:
+            bool: True if every segment was encoded
+        """
+        with self._condition:
+            self._finished = True
+            self._condition.notify()
+        self.join()
+        return not self.failed
+    
+    def stop(self):
+        """Stop encoding without ending the playlist"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.join()
+    
+    def run(self):
+        try:
+            self._context.run(self._encode_segments)
+        except Exception as e:
+            logger.error(f"Stream encoding failed: {str(e)}")
+            self.failed = True
+    
+    def _encode_segments(self):
+        start = 0
+        while start < self.frame_count:
+            end = min(start + self.segment_frames, self.frame_count)
+            with self._condition:
+                while not self._stopped and not (self._finished or all(i in self._done for i in range(start, end))):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            
+            name = f"segment_{len(self.playlist.segments):05d}.ts"
+            durations = self.durations[start:end] if self.durations else None
+            ok = MergeService.encode_segment(
+                self.frames_dir,
+                self.audio_file,
+                self.playlist.hls_dir / name,
+                start_frame=start + 1,
+                frame_count=end - start,
+                fps=self.fps,
+                format=self.format,
+                crop=self.crop,
+                size=self.size,
+                durations=durations,
+                start_time=self.start_times[start] if self.start_times else None
+            )
+            if not ok:
+                logger.error(f"Stopping the stream after a failed segment at frame {start + 1}")
+                self.failed = True
+                return
+            self.playlist.add_segment(name, sum(durations) if durations else (end - start) / self.fps)
+            start = end
+        self.playlist.end()
@@ -0,0 +1,184 @@
+"""
+RAM-disk staging of intermediate frames, and per-job disk quotas
+
+The frame directories of a job (extracted and enhanced frames) are many small, short-lived files. They
+are placed in a tmpfs (/dev/shm by default) while the estimated size of the directory fits the memory
+budget, and on disk under temp/processing otherwise. A staged directory whose tmpfs fills up anyway is
+moved to disk and its stage is run again. A job also reserves its estimated disk usage before
+frames are extracted: jobs larger than the per-job quota are rejected, and jobs that do not fit the free
+disk space left by the running jobs wait for it.
+
+Configuration:
+    STAGING_DIR: tmpfs directory for staged frames (default: /dev/shm/anime_upscaler, if /dev/shm exists;
+        empty to disable staging)
+    STAGING_BUDGET_MB: Memory the staged frames of all jobs may use (default: 1024)
+    JOB_DISK_QUOTA_MB: Largest estimated disk usage of a single job (default: 20480)
+    JOB_DISK_WAIT_SECONDS: How long a job waits for free disk space (default: 600)
+"""
+
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_staging_dir = os.getenv("STAGING_DIR", "/dev/shm/anime_upscaler" if Path("/dev/shm").is_dir() else "")
+STAGING_DIR = Path(_staging_dir) if _staging_dir else None
+STAGING_BUDGET_BYTES = int(float(os.getenv("STAGING_BUDGET_MB", "1024")) * 1024 * 1024)
+JOB_DISK_QUOTA_BYTES = int(float(os.getenv("JOB_DISK_QUOTA_MB", "20480")) * 1024 * 1024)
+# How long a job waits for free disk space before it fails
+DISK_WAIT_SECONDS = float(os.getenv("JOB_DISK_WAIT_SECONDS", "600"))
+
+# Bytes per pixel of a frame in each intermediate format. PNGs are written at compression level 1, which
+# can reach the uncompressed size on grainy or noisy sources, so they are counted as uncompressed 24-bit
+# like PPM, BMP and raw frame stores. JPEG is a rough upper bound for anime content.
+FRAME_BYTES_PER_PIXEL = {"png": 3.0, "ppm": 3.0, "bmp": 3.0, "jpg": 0.5, "raw": 3.0}
+
+
+class QuotaExceeded(Exception):
+    """A job is estimated to need more disk space than its quota allows"""
+
+
+def estimate_frames_bytes(frame_count: int, width: int, height: int, frame_format: str) -> int:
+    """Estimated size of a directory of frames"""
+    return int(frame_count * width * height * FRAME_BYTES_PER_PIXEL.get(frame_format, 3.0))
+
+
+class StagingArea:
+    """
+    Places job directories in RAM or on disk, and tracks the reservations of running jobs
+
+    Args:
+        root: tmpfs directory for staged directories (None disables staging)
+        budget_bytes: Memory all staged directories may use
+        quota_bytes: Largest disk reservation of a single job
+    """
+
+    def __init__(self, root: Optional[Path], budget_bytes: int, quota_bytes: int):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        # job id -> {staged directory: reserved bytes}
+        self._staged: Dict[str, Dict[Path, int]] = {}
+        # job id -> reserved disk bytes
+        self._disk: Dict[str, int] = {}
+
+    def staged_bytes(self) -> int:
+        """Memory reserved by the staged directories of all jobs"""
+        with self._lock:
+            return sum(sum(dirs.values()) for dirs in self._staged.values())
+
+    def allocate(self, job_id: str, name: str, estimated_bytes: int, disk_dir: Path) -> Path:
+        """
+        Pick the location of a job directory: staged in RAM if it fits the budget and the free space of the
+        tmpfs, otherwise disk_dir / name (spilled to disk)
+
+        Args:
+            job_id: Job the directory belongs to
+            name: Directory name
+            estimated_bytes: Estimated size of the directory
+            disk_dir: Job directory on disk
+
+        Returns:
+            Path: The directory, created
+        """
+        path = disk_dir / name
+        staged = False
+        if self.root is not None:
+            with self._lock:
+                reserved = sum(sum(dirs.values()) for dirs in self._staged.values())
+                try:
+                    self.root.mkdir(parents=True, exist_ok=True)
+                    free = shutil.disk_usage(self.root).free
+                except OSError as e:
+                    logger.warning(f"Staging directory {self.root} unavailable: {e}")
+                    free = 0
+                if reserved + estimated_bytes <= self.budget_bytes and estimated_bytes <= free:
+                    path = self.root / job_id / name
+                    self._staged.setdefault(job_id, {})[path] = estimated_bytes
+                    staged = True
+        if staged:
+            logger.info(f"Staging {name} of job {job_id} in RAM ({estimated_bytes / 1e6:.0f} MB estimated)")
+        else:
+            logger.info(f"Writing {name} of job {job_id} to disk ({estimated_bytes / 1e6:.0f} MB estimated)")
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def out_of_space(self, path: Path, needed_bytes: int) -> bool:
+        """
+        Whether a directory is staged and its tmpfs has less than needed_bytes free, i.e. a write into it
+        that failed most likely failed with ENOSPC
+        """
+        with self._lock:
+            if not any(path in dirs for dirs in self._staged.values()):
+                return False
+        try:
+            return shutil.disk_usage(path).free < needed_bytes
+        except OSError:
+            return True
+
+    def spill(self, job_id: str, path: Path, disk_dir: Path) -> Path:
+        """
+        Move a staged directory of a job to disk, e.g. after a write into it hit ENOSPC
+
+        The files already in the directory are moved with it, and its size is added to the disk
+        reservation of the job.
+
+        Returns:
+            Path: The directory on disk, or path if it is not staged
+        """
+        with self._lock:
+            reserved = self._staged.get(job_id, {}).pop(path, None)
+            if reserved is None:
+                return path
+            self._disk[job_id] = self._disk.get(job_id, 0) + reserved
+        disk_path = disk_dir / path.name
+        logger.warning(f"Staging area full, moving {path.name} of job {job_id} to disk")
+        shutil.rmtree(disk_path, ignore_errors=True)
+        disk_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(path), str(disk_path))
+        return disk_path
+
+    def reserve_disk(self, job_id: str, estimated_bytes: int, disk_dir: Path) -> bool:
+        """
+        Reserve the estimated disk usage of a job
+
+        Args:
+            job_id: Job identifier
+            estimated_bytes: Estimated bytes the job writes to disk
+            disk_dir: Directory on the disk the job writes to
+
+        Returns:
+            bool: False if the disk does not have enough free space besides the reservations of other jobs
+
+        Raises:
+            QuotaExceeded: If the job needs more than the per-job quota
+        """
+        if estimated_bytes > self.quota_bytes:
+            raise QuotaExceeded(
+                f"Job needs about {estimated_bytes / 1e9:.1f} GB of disk space, "
+                f"the limit is {self.quota_bytes / 1e9:.1f} GB"
+            )
+        with self._lock:
+            reserved = sum(size for other, size in self._disk.items() if other != job_id)
+            if shutil.disk_usage(disk_dir).free - reserved < estimated_bytes:
+                return False
+            self._disk[job_id] = estimated_bytes
+            return True
+
+    def release(self, job_id: str):
+        """Delete the staged directories of a job and free its reservations"""
+        with self._lock:
+            staged = self._staged.pop(job_id, {})
+            self._disk.pop(job_id, None)
+        for path in staged:
+            shutil.rmtree(path, ignore_errors=True)
+        if self.root is not None:
+            shutil.rmtree(self.root / job_id, ignore_errors=True)
+
+
+STAGING = StagingArea(STAGING_DIR, STAGING_BUDGET_BYTES, JOB_DISK_QUOTA_BYTES)
@@ -0,0 +1,187 @@
+"""
+Structured trace spans for jobs
+
+OpenTelemetry-style spans kept in a context variable, exported as one JSON object per line to a local
+file or to the console, so no collector is needed. Job attributes (job_id, model, scale, resolution,
+frame count) are inherited by child spans, and the current trace and span ids are added to log records
+by TraceContextFilter.
+
+Configuration:
+    TRACE_EXPORTER: file (default), console or none
+    TRACE_FILE: File the spans are appended to (default: temp/traces/spans.jsonl)
+    TRACE_FILE_MAX_MB: Size at which the span file is rotated to TRACE_FILE.1 (default: 64)
+    TRACE_FILE_BACKUPS: Rotated span files kept, older ones are deleted (default: 3)
+"""
+
+import contextvars
+import json
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from . import resources
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file").lower()
+TRACE_FILE = Path(os.getenv("TRACE_FILE", "temp/traces/spans.jsonl"))
+TRACE_FILE_MAX_BYTES = int(float(os.getenv("TRACE_FILE_MAX_MB", "64")) * 1024 * 1024)
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+
+# Attributes that child spans copy from their parent
+INHERITED_ATTRIBUTES = ("job_id", "model", "scale", "width", "height", "frame_count")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    """
+    A timed operation within a trace
+
+    Args:
+        name: Operation name
+        trace_id: 32 hex digit id shared by all spans of a trace
+        parent_id: Span id of the parent span (None for a root span)
+        attributes: Initial attributes
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.status = "ok"
+        self.status_message = None
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_error(self, message: str):
+        self.status = "error"
+        self.status_message = message
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": (self.end_time - self.start_time) / 1e6 if self.end_time else None,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+            "status": self.status,
+            "status_message": self.status_message,
+        }
+
+
+def rotate_file(path: Path, backups: int):
+    """Rename path to path.1, path.1 to path.2 and so on, keeping at most backups old files"""
+    for index in range(backups - 1, 0, -1):
+        older = path.with_name(f"{path.name}.{index}")
+        if older.exists():
+            older.replace(path.with_name(f"{path.name}.{index + 1}"))
+    if backups > 0:
+        path.replace(path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink()
+
+
+def export_span(span: Span):
+    """Write a finished span to the configured exporter"""
+    if TRACE_EXPORTER == "none":
+        return
+    line = json.dumps(span.to_dict(), default=str) + "\n"
+    with _export_lock:
+        if TRACE_EXPORTER == "console":
+            print(line, end="", file=sys.stderr)
+        else:
+            TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with TRACE_FILE.open("a") as f:
+                f.write(line)
+                full = f.tell() >= TRACE_FILE_MAX_BYTES
+            if full:
+                rotate_file(TRACE_FILE, TRACE_FILE_BACKUPS)
+
+
+def current_span() -> Optional[Span]:
+    """The span of the current context, if any"""
+    return _current_span.get()
+
+
+def set_attributes(**attributes):
+    """Set attributes on the current span, if any"""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+@contextmanager
+def start_span(name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None, **attributes):
+    """
+    Run a block in a new span, as a child of the current span
+
+    Args:
+        name: Operation name
+        trace_id: Continue this trace instead of the current one (e.g. a job started in a background task)
+        parent_id: Parent span id within trace_id
+        **attributes: Span attributes
+
+    Yields:
+        Span: The new span
+    """
+    parent = _current_span.get()
+    inherited = {}
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+        inherited = {key: parent.attributes[key] for key in INHERITED_ATTRIBUTES if key in parent.attributes}
+    span = Span(name, trace_id or secrets.token_hex(16), parent_id, {**inherited, **attributes})
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end_time = time.time_ns()
+        export_span(span)
+
+
+def traced_run(cmd, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run in a span named after the executable, with the command line and return code
+
+    Takes the arguments of resources.run and raises the same exceptions as subprocess.run. The rusage of the
+    process is accounted to the current stage of the job.
+    """
+    with start_span(f"subprocess {Path(str(cmd[0])).name}", command=" ".join(map(str, cmd))) as span:
+        try:
+            result = resources.run(cmd, **kwargs)
+        except subprocess.CalledProcessError as e:
+            span.set_attributes(returncode=e.returncode)
+            raise
+        span.set_attributes(returncode=result.returncode)
+        if result.returncode != 0:
+            span.set_error(f"exit status {result.returncode}")
+        return result
+
+
+class TraceContextFilter(logging.Filter):
+    """Add the trace_id and span_id of the current span (or "-") to log records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = _current_span.get()
+        record.trace_id = span.trace_id if span else "-"
+        record.span_id = span.span_id if span else "-"
+        return True
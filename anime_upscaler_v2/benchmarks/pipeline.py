@@ -0,0 +1,431 @@
+"""
+End-to-end benchmark of the enhancement pipeline
+
+Times every pipeline stage on the bundled sample.mp4 and on synthetic anime-like clips, and reports
+frames/s and MB/s per stage as JSON. Needs FFmpeg; the Real-ESRGAN stage also needs the Real-ESRGAN
+sources and torch, but no GPU and no network (the model weights are randomly initialized).
+
+Usage (from anime_upscaler_v2/):
+    python -m benchmarks.pipeline --output results.json
+    python -m benchmarks.pipeline --save-baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline --baseline benchmarks/baseline.json --threshold 0.15
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from app.framestore import FrameStore, STORE_FORMAT, store_path
+from app.services.audio import AudioService
+from app.services.clarity import ClarityService
+from app.services.frames import FRAME_FORMAT, FrameService
+from app.services.merge import MergeService
+from app.services.probe import ProbeService
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent.parent
+SAMPLE_VIDEO = REPO_ROOT / "sample.mp4"
+
+# Synthetic clips: name -> (width, height, seconds, fps)
+SYNTHETIC_CLIPS = {
+    "synthetic_480p": (854, 480, 4, 24),
+    "synthetic_720p": (1280, 720, 2, 24),
+}
+
+# Stages in pipeline order
+STAGES = ["probe", "audio_extract", "frame_extract", "enhance_test", "enhance_realesrgan", "merge", "optimize"]
+
+
+def render_anime_frame(width: int, height: int, index: int, fps: float = 24.0) -> np.ndarray:
+    """
+    Render one frame of a synthetic anime-like scene
+
+    A static background of flat colour areas with dark outlines, and a character that moves across it
+    and blinks, so that most of the frame stays the same between frames like a dialogue cut.
+
+    Args:
+        width: Frame width in pixels
+        height: Frame height in pixels
+        index: Frame number
+        fps: Frame rate, for the motion speed
+
+    Returns:
+        np.ndarray: BGR uint8 frame of shape (height, width, 3)
+    """
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    horizon = height * 2 // 3
+
+    # Sky in a few flat bands, and ground
+    for band, color in enumerate([(235, 206, 135), (225, 190, 110), (210, 170, 90)]):
+        frame[band * horizon // 3:(band + 1) * horizon // 3] = color
+    frame[horizon:] = (90, 160, 110)
+
+    # Outline width scales with the resolution, like hand-drawn line art
+    line = max(2, height // 180)
+    for i in range(4):
+        x = (i * 2 + 1) * width // 8
+        top = horizon - (i % 2 + 1) * height // 6
+        cv2.rectangle(frame, (x - width // 20, top), (x + width // 20, horizon), (150, 150, 170), -1)
+        cv2.rectangle(frame, (x - width // 20, top), (x + width // 20, horizon), (40, 30, 30), line)
+    cv2.line(frame, (0, horizon), (width, horizon), (40, 30, 30), line)
+
+    # Character walking across the scene
+    t = index / fps
+    radius = height // 8
+    cx = int((0.2 + 0.6 * ((t / 4) % 1)) * width)
+    cy = horizon - radius + int(radius * 0.1 * np.sin(t * 2 * np.pi))
+    cv2.circle(frame, (cx, cy), radius, (180, 200, 250), -1)
+    cv2.circle(frame, (cx, cy), radius, (40, 30, 30), line)
+
+    # Eyes, closed for a few frames every two seconds
+    eye_open = index % int(2 * fps) > 3
+    for dx in (-radius // 3, radius // 3):
+        eye = (cx + dx, cy - radius // 5)
+        if eye_open:
+            cv2.ellipse(frame, eye, (radius // 10, radius // 6), 0, 0, 360, (60, 40, 30), -1)
+        else:
+            cv2.line(frame, (eye[0] - radius // 10, eye[1]), (eye[0] + radius // 10, eye[1]), (60, 40, 30), line)
+    return frame
+
+
+def generate_clip(output_video: Path, width: int, height: int, seconds: float, fps: float) -> bool:
+    """
+    Encode a synthetic anime-like clip with a test tone as audio
+
+    Args:
+        output_video: Path to output video file
+        width: Frame width in pixels
+        height: Frame height in pixels
+        seconds: Clip length in seconds
+        fps: Frame rate
+
+    Returns:
+        bool: True if the clip was created, False otherwise
+    """
+    output_video.parent.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        "ffmpeg",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-s", f"{width}x{height}",
+        "-r", str(fps),
+        "-i", "-",
+        "-f", "lavfi",
+        "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264",
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac",
+        "-shortest",
+        "-y",
+        str(output_video)
+    ]
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for index in range(int(seconds * fps)):
+            process.stdin.write(render_anime_frame(width, height, index, fps).tobytes())
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.error(f"FFmpeg error: {stderr.decode(errors='replace')}")
+            return False
+        return output_video.exists() and output_video.stat().st_size > 0
+    except Exception as e:
+        logger.error(f"Clip generation failed: {str(e)}")
+        return False
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file()) if path.exists() else 0
+
+
+def _file_size(path: Path) -> int:
+    return path.stat().st_size if path.exists() else 0
+
+
+def load_realesrgan(realesrgan_path: Path, scale: int = 4, tile: int = 0):
+    """
+    Build a RealESRGANer around a randomly initialized realesr-animevideov3 sized network
+
+    Random weights produce meaningless images but the same amount of work as the trained model, so the
+    stage can be timed without downloading weights.
+
+    Args:
+        realesrgan_path: Directory of the Real-ESRGAN sources
+        scale: Network upscaling factor
+        tile: Tile size, 0 for no tiling
+
+    Returns:
+        RealESRGANer: The upsampler
+    """
+    import torch
+
+    sys.path.insert(0, str(realesrgan_path))
+    from realesrgan import RealESRGANer
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+    torch.manual_seed(0)
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=scale, act_type='prelu')
+    weights = Path(tempfile.mkdtemp()) / "random_init.pth"
+    torch.save({"params": model.state_dict()}, weights)
+    return RealESRGANer(scale=scale, model_path=str(weights), model=model, tile=tile, tile_pad=4, pre_pad=0)
+
+
+def enhance_frames_realesrgan(upsampler, input_dir: Path, output_dir: Path, max_frames: int) -> int:
+    """
+    Enhance up to max_frames frames in-process with a RealESRGANer
+
+    Returns:
+        int: Number of frames enhanced
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if FRAME_FORMAT == STORE_FORMAT:
+        # Frames are read from and written into the mapped stores without image codecs
+        input_store = FrameStore.open(input_dir)
+        frames = min(max_frames, len(input_store))
+        output_store = FrameStore.create(
+            store_path(output_dir), frames, input_store.height * upsampler.scale, input_store.width * upsampler.scale
+        )
+        for index in range(frames):
+            upsampler.enhance(input_store[index], out=output_store[index])
+        output_store.flush()
+        return frames
+    frame_files = FrameService.get_frame_list(input_dir)[:max_frames]
+    for frame_path in frame_files:
+        output, _ = upsampler.enhance(cv2.imread(str(frame_path), cv2.IMREAD_UNCHANGED))
+        cv2.imwrite(str(output_dir / frame_path.name), output)
+    return len(frame_files)
+
+
+def _run_stage(stages: dict, name: str, func: Callable[[], Optional[dict]]) -> bool:
+    """Time one stage; func returns {"frames": ..., "bytes": ...} or None on failure"""
+    start = time.perf_counter()
+    try:
+        counts = func()
+    except Exception as e:
+        logger.error(f"Stage {name} failed: {str(e)}")
+        counts = None
+    seconds = time.perf_counter() - start
+
+    if counts is None:
+        stages[name] = {"ok": False, "seconds": seconds}
+        return False
+
+    result = {"ok": True, "seconds": seconds}
+    if counts.get("frames"):
+        result["frames"] = counts["frames"]
+        result["frames_per_s"] = counts["frames"] / seconds
+    if counts.get("bytes"):
+        result["mb_per_s"] = counts["bytes"] / 1e6 / seconds
+    stages[name] = result
+    return True
+
+
+def benchmark_clip(
+    video: Path,
+    work_dir: Path,
+    upsampler=None,
+    esrgan_frames: int = 8
+) -> dict:
+    """
+    Run every pipeline stage on one clip
+
+    Args:
+        video: Path to the clip
+        work_dir: Scratch directory for the stage outputs
+        upsampler: RealESRGANer for the enhance_realesrgan stage (None to skip it)
+        esrgan_frames: Number of frames enhanced by the enhance_realesrgan stage
+
+    Returns:
+        dict: Clip information and per-stage results
+    """
+    stages = {}
+    clip = {"video": str(video), "size_bytes": _file_size(video), "stages": stages}
+    frames_dir = work_dir / "frames"
+    enhanced_dir = work_dir / "enhanced_test"
+    audio_file = work_dir / "audio.wav"
+    merged = work_dir / "merged.mp4"
+    optimized = work_dir / "optimized.mp4"
+
+    def probe():
+        # Measure the FFprobe run rather than the cache
+        ProbeService.clear_cache()
+        info = FrameService.get_video_info(video)
+        if not info:
+            return None
+        clip.update(width=info["width"], height=info["height"], fps=info["fps"], frames=info["frame_count"])
+        return {"frames": info["frame_count"], "bytes": _file_size(video)}
+
+    def audio_extract():
+        if not AudioService.extract_audio(video, audio_file):
+            return None
+        return {"bytes": _file_size(audio_file)}
+
+    def frame_extract():
+        if not FrameService.extract_frames(video, frames_dir, fps=clip.get("fps")):
+            return None
+        return {"frames": FrameService.count_frames(frames_dir), "bytes": _dir_size(frames_dir)}
+
+    def enhance_test():
+        if not ClarityService().enhance_frames_batch(frames_dir, enhanced_dir, model="test", scale=1, max_workers=1):
+            return None
+        return {"frames": FrameService.count_frames(enhanced_dir), "bytes": _dir_size(enhanced_dir)}
+
+    def enhance_realesrgan():
+        output_dir = work_dir / "enhanced_realesrgan"
+        frames = enhance_frames_realesrgan(upsampler, frames_dir, output_dir, esrgan_frames)
+        return {"frames": frames, "bytes": _dir_size(output_dir)} if frames else None
+
+    def merge():
+        if not MergeService.merge_frames_and_audio(enhanced_dir, audio_file, merged, fps=clip.get("fps", 24.0)):
+            return None
+        return {"frames": clip.get("frames"), "bytes": _dir_size(enhanced_dir)}
+
+    def optimize():
+        if not MergeService.optimize_video(merged, optimized):
+            return None
+        return {"frames": clip.get("frames"), "bytes": _file_size(merged)}
+
+    if not _run_stage(stages, "probe", probe):
+        return clip
+    audio_ok = _run_stage(stages, "audio_extract", audio_extract)
+    if not _run_stage(stages, "frame_extract", frame_extract):
+        return clip
+    enhanced_ok = _run_stage(stages, "enhance_test", enhance_test)
+    if upsampler is not None:
+        _run_stage(stages, "enhance_realesrgan", enhance_realesrgan)
+    if audio_ok and enhanced_ok and _run_stage(stages, "merge", merge):
+        _run_stage(stages, "optimize", optimize)
+    return clip
+
+
+def compare_results(current: dict, baseline: dict, threshold: float = 0.15) -> List[str]:
+    """
+    Compare benchmark results against a baseline
+
+    A stage regresses if its throughput (frames/s, or MB/s for stages without frames) drops by more
+    than threshold. Stages missing or failed in either result are not compared.
+
+    Args:
+        current: Results of this run
+        baseline: Stored baseline results
+        threshold: Allowed relative throughput drop (0.15 = 15%)
+
+    Returns:
+        List[str]: One message per regressed stage
+    """
+    regressions = []
+    for clip_name, clip in current.get("clips", {}).items():
+        baseline_stages = baseline.get("clips", {}).get(clip_name, {}).get("stages", {})
+        for stage, result in clip.get("stages", {}).items():
+            reference = baseline_stages.get(stage)
+            if not reference or not reference.get("ok") or not result.get("ok"):
+                continue
+            metric = "frames_per_s" if "frames_per_s" in result and "frames_per_s" in reference else "mb_per_s"
+            if metric not in result or metric not in reference:
+                continue
+            if result[metric] < reference[metric] * (1 - threshold):
+                regressions.append(
+                    f"{clip_name}/{stage}: {metric} {result[metric]:.2f} < baseline {reference[metric]:.2f} "
+                    f"(-{(1 - result[metric] / reference[metric]) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def host_info() -> Dict[str, str]:
+    """Describe the host, so results from different machines are not confused"""
+    info = {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": str(os.cpu_count()),
+        "frame_format": FRAME_FORMAT,
+    }
+    try:
+        import torch
+        info["torch"] = torch.__version__
+        info["cuda"] = str(torch.cuda.is_available())
+    except ImportError:
+        pass
+    return info
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the enhancement pipeline stages")
+    parser.add_argument("--clips", nargs="+", default=["sample", *SYNTHETIC_CLIPS],
+                        help=f"Clips to run: sample, {', '.join(SYNTHETIC_CLIPS)} or video paths")
+    parser.add_argument("--output", type=Path, help="Write the results JSON here (default: stdout)")
+    parser.add_argument("--baseline", type=Path, help="Compare against this baseline JSON")
+    parser.add_argument("--save-baseline", type=Path, help="Store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed relative throughput drop")
+    parser.add_argument("--realesrgan-path", type=Path, default=None,
+                        help="Real-ESRGAN sources (default: the ones ClarityService uses, else esrgan_au's)")
+    parser.add_argument("--esrgan-frames", type=int, default=8, help="Frames enhanced by the Real-ESRGAN stage")
+    parser.add_argument("--tile", type=int, default=0, help="Real-ESRGAN tile size, 0 for no tiling")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directories")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # Real-ESRGAN with random weights; skipped if its sources or dependencies are missing
+    upsampler = None
+    candidates = [args.realesrgan_path] if args.realesrgan_path else [
+        ClarityService().realesrgan_path, REPO_ROOT / "esrgan_au" / "sources" / "Real-ESRGAN"
+    ]
+    for path in candidates:
+        if (path / "realesrgan").is_dir():
+            try:
+                upsampler = load_realesrgan(path, tile=args.tile)
+            except Exception as e:
+                logger.warning(f"Skipping the Real-ESRGAN stage: {str(e)}")
+            break
+
+    scratch = Path(tempfile.mkdtemp(prefix="pipeline_bench_"))
+    results = {"host": host_info(), "clips": {}}
+    try:
+        for name in args.clips:
+            work_dir = scratch / Path(name).stem
+            if name == "sample":
+                video = SAMPLE_VIDEO
+            elif name in SYNTHETIC_CLIPS:
+                video = work_dir / "input.mp4"
+                if not generate_clip(video, *SYNTHETIC_CLIPS[name]):
+                    results["clips"][name] = {"error": "clip generation failed"}
+                    continue
+            else:
+                video = Path(name)
+            results["clips"][name] = benchmark_clip(video, work_dir, upsampler, args.esrgan_frames)
+    finally:
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        args.save_baseline.write_text(output)
+
+    if args.baseline:
+        regressions = compare_results(results, json.loads(args.baseline.read_text()), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,12 @@
+import os
+import re
 import pytest
 import asyncio
 from pathlib import Path
+
+# Spans of the test jobs are not written to temp/traces; the tracing tests export them explicitly
+os.environ["TRACE_EXPORTER"] = "none"
+
 from fastapi.testclient import TestClient
 from app.main import app
 
@@ -12,6 +18,53 @@ def test_health_endpoint():
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
+def test_metrics_endpoint():
+    """Test metrics endpoint"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE anime_upscaler_stage_duration_seconds histogram" in response.text
+    # Other tests may leave jobs queued, so only the sample and its format are checked
+    assert re.search(r"^anime_upscaler_queue_depth \d+(\.\d+)?$", response.text, re.MULTILINE)
+
+def test_metrics_histogram():
+    """Test histogram buckets and the text format"""
+    from app.metrics import Histogram, REGISTRY
+    
+    histogram = Histogram("test_duration_seconds", "Test durations", ["stage"], buckets=(1, 5))
+    REGISTRY.remove(histogram)
+    for value in (0.5, 2, 10):
+        histogram.observe(value, stage="merge")
+    
+    lines = histogram.render().splitlines()
+    assert 'test_duration_seconds_bucket{stage="merge",le="1.0"} 1' in lines
+    assert 'test_duration_seconds_bucket{stage="merge",le="5.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{stage="merge",le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_sum{stage="merge"} 12.5' in lines
+    assert histogram.count(stage="merge") == 3
+    with pytest.raises(ValueError):
+        histogram.observe(1, engine="esrgan")
+
+def test_jobs_finished_kind():
+    """Test that finished previews are counted apart from full jobs"""
+    from app import metrics, routes
+    
+    job_id, preview_job_id = "metrics-job", "metrics-preview"
+    routes.link_preview_job(job_id, preview_job_id)
+    full_before = metrics.JOBS_FINISHED.get(status="failed", kind="full")
+    preview_before = metrics.JOBS_FINISHED.get(status="failed", kind="preview")
+    try:
+        routes.fail_job(preview_job_id, "preview_clip", 0, "Failed to extract preview clip")
+        assert metrics.JOBS_FINISHED.get(status="failed", kind="preview") == preview_before + 1
+        assert metrics.JOBS_FINISHED.get(status="failed", kind="full") == full_before
+        routes.fail_job(job_id, "probe", 0, "Failed to probe video")
+        assert metrics.JOBS_FINISHED.get(status="failed", kind="full") == full_before + 1
+    finally:
+        with routes.JOB_LOCK:
+            routes.JOB_STATUS.pop(job_id, None)
+            routes.JOB_STATUS.pop(preview_job_id, None)
+    assert 'anime_upscaler_jobs_finished_total{status="failed",kind="preview"}' in client.get("/metrics").text
+
 def test_get_available_models():
     """Test models endpoint"""
     response = client.get("/models/")
@@ -39,6 +92,44 @@ def test_upload_invalid_file():
     assert response.status_code == 400
     assert "Invalid file type" in response.json()["detail"]
 
+def test_upload_invalid_denoise_strength():
+    """Test upload with an out of range denoise strength"""
+    fake_file = {"file": ("test.mp4", b"not really a video", "video/mp4")}
+    response = client.post("/enhance_video/", files=fake_file, data={"model": "test", "denoise_strength": "1.5"})
+    assert response.status_code == 422
+
+def test_upload_denoise_strength_requires_esrgan():
+    """Test that denoise strength is rejected for models other than esrgan"""
+    fake_file = {"file": ("test.mp4", b"not really a video", "video/mp4")}
+    response = client.post("/enhance_video/", files=fake_file, data={"model": "test", "denoise_strength": "0.5"})
+    assert response.status_code == 400
+    assert "denoise_strength" in response.json()["detail"]
+
+def test_upload_invalid_preview_length():
+    """Test upload with a preview clip longer than allowed"""
+    fake_file = {"file": ("test.mp4", b"not really a video", "video/mp4")}
+    response = client.post("/enhance_video/", files=fake_file, data={"model": "test", "preview": "true", "preview_seconds": "60"})
+    assert response.status_code == 422
+
+def test_upload_deadline_requires_auto():
+    """Test that a deadline is rejected for models other than auto"""
+    fake_file = {"file": ("test.mp4", b"not really a video", "video/mp4")}
+    response = client.post("/enhance_video/", files=fake_file, data={"model": "test", "deadline_seconds": "60"})
+    assert response.status_code == 400
+    assert "deadline_seconds" in response.json()["detail"]
+
+def test_upload_profile_requires_admin():
+    """Test that profiling is rejected without the admin token"""
+    fake_file = {"file": ("test.mp4", b"not really a video", "video/mp4")}
+    response = client.post("/enhance_video/", files=fake_file, data={"model": "test", "profile": "true"},
+                           headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == 403
+
+def test_download_profile_requires_admin():
+    """Test that job profiles are only served to admins"""
+    response = client.get("/profile/invalid-job-id")
+    assert response.status_code == 403
+
 def test_upload_no_file():
     """Test upload without file"""
     response = client.post("/enhance_video/")
@@ -73,6 +164,810 @@ async def test_clarity_service():
     # Should return dict even if no models available
     assert isinstance(available_models, dict)
 
+def test_frame_format_per_model():
+    """Test that models which cannot write the frame format fall back to png"""
+    from app.services.clarity import ClarityService
+    
+    service = ClarityService()
+    assert service.output_frame_format("esrgan", "ppm") == "ppm"
+    assert service.output_frame_format("waifu2x", "ppm") == "png"
+    assert service.output_frame_format("waifu2x", "jpg") == "jpg"
+
+def test_auto_engine_selection():
+    """Test that the auto model trades quality for speed to meet the deadline"""
+    from app.services.clarity import ClarityService
+    
+    service = ClarityService()
+    service.check_model_availability = lambda model_name: True
+    
+    # 240 frames of 640x360 fit the default target with the best engine
+    engine, reason = service.select_engine(4, 240, 640, 360)
+    assert engine == "esrgan"
+    assert "esrgan" in reason
+    
+    # A short deadline and a backlog push the job to faster engines
+    engine, _ = service.select_engine(4, 240, 640, 360, backlog_seconds=500, deadline_seconds=900)
+    assert engine == "esrgan_video"
+    engine, reason = service.select_engine(4, 240, 640, 360, deadline_seconds=1)
+    assert engine == min(["esrgan", "esrgan_video", "waifu2x"],
+                         key=lambda name: service.estimate_seconds(name, 4, 240, 640, 360))
+    assert "no engine fits" in reason
+    
+    # At 2x the engines that run natively at 2x are preferred; esrgan_video pays for its 4x output
+    assert service.esrgan_model_name("esrgan", 2) == "RealESRGAN_x2plus"
+    engine, _ = service.select_engine(2, 240, 640, 360)
+    assert engine == "waifu2x"
+    assert service.estimate_seconds("esrgan_video", 2, 240, 640, 360) > \
+        service.estimate_seconds("esrgan_video", 4, 240, 640, 360)
+
+def test_backlog_seconds():
+    """Test that the backlog of an auto job is the remaining work of the running jobs, not of the queued ones"""
+    from app import routes
+    
+    jobs = {"backlog-running": ("processing", 25), "backlog-queued": ("uploaded", 0), "backlog-self": ("processing", 0)}
+    # Jobs left behind by other tests
+    baseline = routes.get_backlog_seconds()
+    for job_id, (status, progress) in jobs.items():
+        routes.update_job_status(job_id, status, progress, "")
+        routes.update_job_info(job_id, estimated_seconds=100)
+    try:
+        assert routes.get_backlog_seconds(exclude_job_id="backlog-self") - baseline == pytest.approx(75)
+    finally:
+        with routes.JOB_LOCK:
+            for job_id in jobs:
+                routes.JOB_STATUS.pop(job_id, None)
+
+def test_target_resolution_plan():
+    """Test that target resolution jobs run the smallest adequate scale and shrink frames that overshoot"""
+    from app.services.clarity import ClarityService
+    from app.services.frames import FrameService
+    
+    service = ClarityService()
+    
+    # 720p to 1080p: 2x, then a small downscale in the merge
+    plan = service.plan_resolution("esrgan", 1280, 720, target_height=1080)
+    assert (plan["scale"], plan["shrink"], plan["frame_height"], plan["output_width"]) == (2, 1.0, 720, 1920)
+    
+    # 1080p to 1440p: 2x would overshoot by 1.5, so frames are shrunk to 720p first
+    plan = service.plan_resolution("esrgan", 1920, 1080, target_height=1440)
+    assert plan["scale"] == 2 and (plan["frame_width"], plan["frame_height"]) == (1280, 720)
+    assert (plan["output_width"], plan["output_height"]) == (2560, 1440)
+    
+    # The largest dimension bounds the output, and shrinking applies to the cropped area
+    plan = service.plan_resolution("waifu2x", 640, 480, max_dimension=2560)
+    assert (plan["scale"], plan["shrink"], plan["output_width"], plan["output_height"]) == (4, 1.0, 2560, 1920)
+    crop = {"width": 1440, "height": 1080, "x": 240, "y": 0, "source_width": 1920, "source_height": 1080}
+    plan = service.plan_resolution("esrgan", 1920, 1080, target_height=1440, crop=crop)
+    assert (plan["frame_width"], plan["frame_height"]) == (960, 720)
+    
+    args = FrameService.output_filter_args(crop, (plan["output_width"], plan["output_height"]))
+    assert args[0] == "-vf" and args[1].endswith(",scale=2560:1440:flags=lanczos")
+    assert FrameService.output_filter_args() == []
+
+def test_benchmark_regression_check():
+    """Test that the benchmark flags throughput drops beyond the threshold"""
+    from benchmarks.pipeline import compare_results
+    
+    baseline = {"clips": {"sample": {"stages": {
+        "frame_extract": {"ok": True, "seconds": 1.0, "frames_per_s": 100.0, "mb_per_s": 50.0},
+        "audio_extract": {"ok": True, "seconds": 1.0, "mb_per_s": 10.0},
+        "merge": {"ok": False, "seconds": 1.0},
+    }}}}
+    current = {"clips": {"sample": {"stages": {
+        "frame_extract": {"ok": True, "seconds": 1.2, "frames_per_s": 80.0, "mb_per_s": 40.0},
+        "audio_extract": {"ok": True, "seconds": 1.0, "mb_per_s": 9.0},
+        "merge": {"ok": True, "seconds": 1.0, "frames_per_s": 1.0},
+    }}}}
+    
+    regressions = compare_results(current, baseline, threshold=0.15)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("sample/frame_extract: frames_per_s")
+    assert compare_results(current, baseline, threshold=0.25) == []
+
+def test_benchmark_synthetic_frame():
+    """Test the synthetic anime-like frames of the benchmark"""
+    import numpy as np
+    from benchmarks.pipeline import render_anime_frame
+    
+    first = render_anime_frame(320, 180, 0)
+    second = render_anime_frame(320, 180, 1)
+    assert first.shape == (180, 320, 3) and first.dtype == np.uint8
+    # Only the character moves, most of the frame stays the same
+    assert 0 < np.count_nonzero((first != second).any(axis=2)) < 0.2 * 320 * 180
+
+def test_job_profiler(tmp_path):
+    """Test that a job profile bundles CPU samples and tracemalloc snapshots"""
+    import time
+    import zipfile
+    from app.profiling import JobProfiler
+    
+    profiler = JobProfiler(tmp_path / "profile", interval=0.001)
+    assert profiler.start()
+    # Only one job is profiled at a time
+    assert not JobProfiler(tmp_path / "other").start()
+    
+    deadline = time.perf_counter() + 0.1
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+    profiler.snapshot("probe")
+    archive = profiler.stop()
+    
+    names = zipfile.ZipFile(archive).namelist()
+    assert "cpu_samples.collapsed" in names
+    assert "tracemalloc_01_probe.snapshot" in names
+    assert "tracemalloc_01_probe.txt" in names
+    assert "test_job_profiler" in (tmp_path / "profile" / "cpu_samples.collapsed").read_text()
+    assert profiler.stop() is None
+    
+    # A profiler that fails to start does not keep the next job from being profiled
+    (tmp_path / "file").write_text("")
+    assert not JobProfiler(tmp_path / "file" / "profile").start()
+    profiler = JobProfiler(tmp_path / "profile", interval=0.001)
+    assert profiler.start()
+    profiler.stop()
+
+def test_admin_token(monkeypatch):
+    """Test that only the configured admin token is accepted"""
+    from app import profiling
+    
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", None)
+    assert not profiling.is_admin(None) and not profiling.is_admin("")
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "s3cret")
+    assert profiling.is_admin("s3cret")
+    assert not profiling.is_admin("s3cre") and not profiling.is_admin(None) and not profiling.is_admin("s3cret\u00e9")
+
+def test_trace_spans(tmp_path, monkeypatch):
+    """Test that spans nest, inherit job attributes and reach log records and the exporter"""
+    import json
+    import logging
+    import sys
+    from app import tracing
+    
+    monkeypatch.setattr(tracing, "TRACE_FILE", tmp_path / "spans.jsonl")
+    monkeypatch.setattr(tracing, "TRACE_EXPORTER", "file")
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "message", None, None)
+    
+    with tracing.start_span("pipeline", job_id="job", model="esrgan", scale=4) as root:
+        root.set_attributes(width=640, height=360)
+        with tracing.start_span("extract") as stage:
+            tracing.TraceContextFilter().filter(record)
+            tracing.traced_run([sys.executable, "-c", "raise SystemExit(3)"])
+    
+    spans = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    assert [span["name"] for span in spans] == ["subprocess " + Path(sys.executable).name, "extract", "pipeline"]
+    subprocess_span, extract_span, pipeline_span = spans
+    assert {span["trace_id"] for span in spans} == {root.trace_id}
+    assert subprocess_span["parent_id"] == extract_span["span_id"] == stage.span_id
+    assert extract_span["parent_id"] == pipeline_span["span_id"]
+    assert subprocess_span["attributes"]["job_id"] == "job"
+    assert subprocess_span["attributes"]["width"] == 640
+    assert subprocess_span["attributes"]["returncode"] == 3
+    assert subprocess_span["status"] == "error"
+    assert pipeline_span["status"] == "ok"
+    assert (record.trace_id, record.span_id) == (root.trace_id, stage.span_id)
+    assert tracing.current_span() is None
+
+def test_trace_file_rotation(tmp_path, monkeypatch):
+    """Test that the span file is rotated at its size limit and only the newest backups are kept"""
+    from app import tracing
+    
+    trace_file = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_FILE", trace_file)
+    monkeypatch.setattr(tracing, "TRACE_EXPORTER", "file")
+    monkeypatch.setattr(tracing, "TRACE_FILE_MAX_BYTES", 1)
+    monkeypatch.setattr(tracing, "TRACE_FILE_BACKUPS", 2)
+    
+    for index in range(4):
+        with tracing.start_span(f"span-{index}"):
+            pass
+    
+    # Every span fills the file, so each one ends up in a backup and the oldest two are deleted
+    assert not trace_file.exists()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["spans.jsonl.1", "spans.jsonl.2"]
+    assert '"name": "span-3"' in (tmp_path / "spans.jsonl.1").read_text()
+    assert '"name": "span-2"' in (tmp_path / "spans.jsonl.2").read_text()
+
+def test_engine_progress_events():
+    """Test that JSON progress lines become events and an idle engine is stopped"""
+    import subprocess
+    import sys
+    from app.services.clarity import ClarityService
+    
+    script = (
+        "import json\n"
+        "print('loading model')\n"
+        "for done in (1, 2):\n"
+        "    print(json.dumps({'event': 'tile', 'done': done, 'total': 2, 'computed': done}), flush=True)\n"
+        "print(json.dumps({'event': 'frame', 'seconds': 0.5, 'height': 8, 'width': 8}))\n"
+    )
+    events = []
+    returncode, output = ClarityService.run_with_progress([sys.executable, "-c", script], events.append, 10)
+    assert returncode == 0
+    assert output == "loading model\n"
+    assert [event["event"] for event in events] == ["tile", "tile", "frame"]
+    assert events[1]["done"] == 2 and events[2]["seconds"] == 0.5
+    
+    with pytest.raises(subprocess.TimeoutExpired):
+        ClarityService.run_with_progress([sys.executable, "-c", "import time; time.sleep(10)"], events.append, 0.5)
+
+def test_engine_killed_when_progress_handler_fails(monkeypatch):
+    """Test that the engine is killed and reaped when the progress handler raises"""
+    import sys
+    from app import resources
+    from app.services.clarity import ClarityService
+    
+    reaped = []
+    wait = resources.wait
+    monkeypatch.setattr(resources, "wait", lambda process: reaped.append(process) or wait(process))
+    
+    def on_event(event):
+        raise RuntimeError("status update failed")
+    
+    script = (
+        "import json, time\n"
+        "print(json.dumps({'event': 'tile', 'done': 1, 'total': 2}), flush=True)\n"
+        "time.sleep(30)\n"
+    )
+    with pytest.raises(RuntimeError):
+        ClarityService.run_with_progress([sys.executable, "-c", script], on_event, 30)
+    assert len(reaped) == 1 and reaped[0].returncode is not None and reaped[0].returncode < 0
+
+def test_stage_resource_accounting(tmp_path):
+    """Test that child processes and I/O are accounted to the stage that ran them"""
+    import json
+    import subprocess
+    import sys
+    from app import resources
+    from app.tracing import traced_run
+    
+    child = "x = bytearray(64 * 1024 * 1024); sum(range(2000000)); print('done')"
+    # Writes 4 MB to a file and flushes it to storage
+    writer = "import os, sys\nwith open(sys.argv[1], 'wb') as f:\n    f.write(bytes(4 << 20)); os.fsync(f.fileno())\n"
+    with resources.job_usage() as usage:
+        with resources.track_stage("extract"):
+            result = traced_run([sys.executable, "-c", child], capture_output=True, text=True)
+            traced_run([sys.executable, "-c", writer, str(tmp_path / "frames.bin")], check=True)
+        shm_file = Path("/dev/shm") / f"test-{tmp_path.name}.bin"
+        if shm_file.parent.is_dir():
+            # Frames staged in tmpfs are not I/O
+            with resources.track_stage("staged"):
+                traced_run([sys.executable, "-c", writer, str(shm_file)], check=True)
+            shm_file.unlink()
+        with resources.track_stage("merge"):
+            with pytest.raises(subprocess.CalledProcessError):
+                traced_run([sys.executable, "-c", "raise SystemExit(2)"], check=True)
+            with pytest.raises(subprocess.TimeoutExpired):
+                traced_run([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5)
+    
+    assert result.returncode == 0 and result.stdout == "done\n"
+    extract = usage.to_dict()["stages"]["extract"]
+    assert extract["child_processes"] == 2
+    assert extract["child_cpu_seconds"] > 0
+    assert extract["child_peak_rss_bytes"] > 64 * 1024 * 1024
+    if Path("/proc/self/io").exists():
+        assert extract["bytes_written"] >= 4 << 20
+        if "staged" in usage.stages:
+            assert usage.to_dict()["stages"]["staged"]["bytes_written"] < 4 << 20
+    assert extract["wall_seconds"] > 0 and extract["peak_rss_bytes"] > 0
+    total = usage.to_dict()["total"]
+    assert total["child_processes"] == 4 + ("staged" in usage.stages)
+    stages = usage.to_dict()["stages"].values()
+    assert total["child_peak_rss_bytes"] == max(stage["child_peak_rss_bytes"] for stage in stages)
+    
+    usage.save(tmp_path / "resources.json")
+    assert json.loads((tmp_path / "resources.json").read_text())["stages"]["merge"]["child_processes"] == 2
+
+def test_stage_peak_rss_with_overlapping_jobs():
+    """Test that a stage keeps its peak RSS when a stage of another job starts and ends meanwhile"""
+    import contextvars
+    import threading
+    import time
+    from app import resources
+    
+    with resources.job_usage() as usage:
+        with resources.track_stage("enhance"):
+            baseline = resources._rss()
+            buffer = bytearray(128 * 1024 * 1024)
+            for offset in range(0, len(buffer), 4096):
+                buffer[offset] = 1
+            time.sleep(5 * resources.RSS_SAMPLE_SECONDS)
+            del buffer
+            
+            # Another job runs a stage in its own context after the memory is freed
+            def other_job():
+                with resources.job_usage(), resources.track_stage("probe"):
+                    pass
+            
+            other = threading.Thread(target=contextvars.Context().run, args=(other_job,))
+            other.start()
+            other.join()
+    
+    assert usage.to_dict()["stages"]["enhance"]["peak_rss_bytes"] >= baseline + 100 * 1024 * 1024
+
+def test_frame_staging_and_quota(tmp_path):
+    """Test that frame directories spill to disk above the RAM budget and that the disk quota is enforced"""
+    from app.staging import StagingArea, QuotaExceeded, estimate_frames_bytes
+    
+    job_dir = tmp_path / "processing" / "job"
+    area = StagingArea(tmp_path / "shm", budget_bytes=1000, quota_bytes=10 ** 15)
+    frames_dir = area.allocate("job", "frames", 600, job_dir)
+    enhanced_dir = area.allocate("job", "enhanced_frames", 600, job_dir)
+    assert frames_dir == tmp_path / "shm" / "job" / "frames" and frames_dir.is_dir()
+    assert enhanced_dir == job_dir / "enhanced_frames" and enhanced_dir.is_dir()
+    assert area.staged_bytes() == 600
+    
+    assert area.reserve_disk("job", 1000, tmp_path)
+    # Larger than the free disk space: the job waits
+    assert not area.reserve_disk("other", 10 ** 15, tmp_path)
+    with pytest.raises(QuotaExceeded):
+        area.reserve_disk("other", 10 ** 16, tmp_path)
+    
+    # A staged directory whose tmpfs is full is moved to disk with its files
+    (frames_dir / "frame_000001.png").write_bytes(b"png")
+    assert not area.out_of_space(frames_dir, 1) and not area.out_of_space(enhanced_dir, 10 ** 18)
+    assert area.out_of_space(frames_dir, 10 ** 18)
+    spilled_dir = area.spill("job", frames_dir, job_dir)
+    assert spilled_dir == job_dir / "frames" and (spilled_dir / "frame_000001.png").read_bytes() == b"png"
+    assert not frames_dir.exists() and area.staged_bytes() == 0
+    assert area.spill("job", spilled_dir, job_dir) == spilled_dir
+    
+    area.release("job")
+    assert enhanced_dir.exists() and spilled_dir.exists()
+    assert area.staged_bytes() == 0
+    assert estimate_frames_bytes(10, 640, 360, "ppm") == 10 * 640 * 360 * 3
+    assert estimate_frames_bytes(10, 640, 360, "png") == 10 * 640 * 360 * 3
+
+def test_probe_cached_and_shared(tmp_path, monkeypatch):
+    """Test that one FFprobe run serves the video, audio and duration lookups of a file"""
+    import json
+    import subprocess
+    from app.services import probe
+    from app.services.audio import AudioService
+    from app.services.frames import FrameService
+    from app.services.merge import MergeService
+    
+    output = {
+        "streams": [
+            {"index": 0, "codec_type": "video", "codec_name": "h264", "width": 640, "height": 360,
+             "avg_frame_rate": "30000/1001", "r_frame_rate": "60/1", "nb_read_packets": "4"},
+            {"index": 1, "codec_type": "audio", "codec_name": "aac", "sample_rate": "48000", "channels": 2},
+        ],
+        "format": {"duration": "2.5", "size": "1000", "format_name": "matroska,webm"},
+        "packets": [
+            {"stream_index": 0, "pts_time": "0.000000", "flags": "K__"},
+            {"stream_index": 1, "pts_time": "0.000000", "flags": "K__"},
+            {"stream_index": 0, "pts_time": "0.033367", "flags": "___"},
+            {"stream_index": 0, "pts_time": "1.001000", "flags": "K__"},
+            {"stream_index": 0, "pts_time": "1.034367", "flags": "___"},
+        ],
+    }
+    runs = []
+    
+    def fake_run(cmd, **kwargs):
+        runs.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, json.dumps(output), "")
+    
+    monkeypatch.setattr(probe, "traced_run", fake_run)
+    video = tmp_path / "input.mkv"
+    video.write_bytes(b"video")
+    
+    video_info = FrameService.get_video_info(video)
+    assert video_info["fps"] == pytest.approx(29.97, abs=0.01) and video_info["vfr"]
+    assert video_info["frame_count"] == 4 and video_info["duration"] == 2.5
+    assert video_info["keyframes"] == [0.0, 1.001]
+    assert AudioService.get_audio_info(video)["sample_rate"] == 48000
+    assert MergeService._get_video_duration(video) == 2.5
+    assert len(runs) == 1
+    
+    # A changed file is probed again
+    video.write_bytes(b"other video")
+    FrameService.get_video_info(video)
+    assert len(runs) == 2
+    probe.ProbeService.clear_cache()
+
+def test_frame_store(tmp_path, monkeypatch):
+    """Test that frames are enhanced between memory-mapped frame stores by index"""
+    import numpy as np
+    from app.framestore import FrameStore, HEADER_SIZE, store_path
+    from app.services.clarity import ClarityService
+    from app.services.frames import FrameService
+    
+    frames = np.random.randint(0, 256, (5, 6, 8, 3), dtype=np.uint8)
+    store = FrameStore.create(store_path(tmp_path / "frames"), 5, 6, 8)
+    store.frames[:] = frames
+    store.flush()
+    assert FrameService.count_frames(tmp_path / "frames", "raw") == 5
+    args = FrameService.input_args(tmp_path / "frames", 24.0, "raw", start_frame=3)
+    assert args[args.index("-video_size") + 1] == "8x6"
+    assert args[args.index("-skip_initial_bytes") + 1] == str(HEADER_SIZE + 2 * 6 * 8 * 3)
+    
+    service = ClarityService()
+    assert service.input_frame_format("waifu2x", "raw") == "png"
+    assert service.input_frame_format("esrgan", "raw") == "raw"
+    done = []
+    assert service.enhance_frames_batch(tmp_path / "frames", tmp_path / "test", model="test", scale=1,
+                                        frame_format="raw", frame_callback=done.append)
+    assert np.array_equal(FrameStore.open(tmp_path / "test").frames, frames) and sorted(done) == list(range(5))
+    
+    # Real-ESRGAN enhances one contiguous range per worker; frames without a frame event failed
+    runs = []
+    
+    def fake_enhance_store(input_store, output_store, indices, scale, progress=None, **kwargs):
+        runs.append(list(indices))
+        for index in indices:
+            if index != 3:
+                progress({"event": "frame", "seconds": 0.1, "index": index})
+        return True
+    
+    monkeypatch.setattr(service, "enhance_store_esrgan", fake_enhance_store)
+    done.clear()
+    progress = []
+    assert not service.enhance_frames_batch(
+        tmp_path / "frames", tmp_path / "esrgan", model="esrgan", scale=4, max_workers=2, frame_format="raw",
+        frame_callback=done.append, progress_callback=lambda *update: progress.append(update)
+    )
+    assert sorted(runs) == [[0, 1], [2, 3, 4]] and sorted(done) == [0, 1, 2, 4]
+    assert FrameStore.open(tmp_path / "esrgan").shape == (24, 32, 3)
+    assert progress[-1] == (100, 4, 1)
+
+def test_frame_manifest(tmp_path):
+    """Test that the frame manifest lists frames, carries their timestamps and deduplicates held frames"""
+    from PIL import Image
+    from app.services.clarity import ClarityService
+    from app.services.frames import FrameService
+    from app.services.manifest import FrameManifest
+    
+    # showinfo lines of a variable frame rate video whose first and fourth frames are held
+    log = "\n".join(
+        f"[Parsed_showinfo_0 @ 0x55] n:{index:4d} pts:{int(pts * 1000):7d} pts_time:{pts:<8} duration:1 "
+        f"fmt:yuv420p sar:1/1 s:8x6 i:P iskey:0 type:P checksum:{checksum} plane_checksum:[1 2 3] mean:[1 2 3]"
+        for index, (pts, checksum) in enumerate([(0, "AA"), (0.04, "AA"), (0.08, "BB"), (0.2, "CC"), (0.24, "CC")])
+    )
+    manifest = FrameManifest.from_showinfo(log, "png", 25.0)
+    assert len(manifest) == 5 and (manifest.width, manifest.height) == (8, 6)
+    assert manifest.duplicates() == {0: [1], 3: [4]} and not manifest.is_constant_rate()
+    
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    for index in range(5):
+        Image.new("RGB", (8, 6), (index * 40, 0, 0)).save(frames_dir / manifest.file_name(index))
+    manifest.save(frames_dir)
+    assert FrameService.get_frame_list(frames_dir, "png")[-1] == frames_dir / "frame_000005.png"
+    assert FrameService.count_frames(frames_dir, "png") == 5
+    
+    # Held frames are enhanced once; the enhanced frames keep the timestamps
+    done = []
+    assert ClarityService().enhance_frames_batch(frames_dir, tmp_path / "enhanced", model="test", scale=1,
+                                                 frame_format="png", frame_callback=done.append)
+    assert sorted(done) == list(range(5))
+    enhanced_dir = tmp_path / "enhanced"
+    assert (enhanced_dir / "frame_000002.png").stat().st_ino == (enhanced_dir / "frame_000001.png").stat().st_ino
+    assert FrameManifest.load(enhanced_dir).frames[3]["pts"] == 0.2
+    
+    # Variable frame rate frames are encoded from a concat script with their durations
+    args = FrameService.input_args(enhanced_dir, 25.0, "png")
+    assert args[:2] == ["-f", "concat"] and FrameService.output_args(enhanced_dir, "png") == ["-vsync", "vfr"]
+    script = Path(args[-1]).read_text()
+    assert "file 'frame_000003.png'\nduration 0.120000" in script
+    assert script.rstrip().endswith("file 'frame_000005.png'")
+    assert FrameService.input_args(enhanced_dir, 25.0, "png", start_frame=2)[0] == "-framerate"
+    
+    constant = FrameManifest([{**frame, "pts": index / 25} for index, frame in enumerate(manifest.frames)],
+                             8, 6, "png", 25.0)
+    constant.save(enhanced_dir)
+    assert FrameService.input_args(enhanced_dir, 25.0, "png")[0] == "-framerate"
+    assert FrameService.output_args(enhanced_dir, "png") == []
+
+def test_crop_detection(monkeypatch):
+    """Test that black bars are found from sampled cropdetect output and padded back at any scale"""
+    import subprocess
+    from app.services import frames
+    from app.services.frames import FrameService
+    
+    # A pillarboxed 4:3 picture; one sample is a dark scene, another a fade to black
+    detected = iter([
+        "crop=1440:1080:240:0", "crop=1400:1000:262:40", "crop=-1904:-1072:1912:1080", "crop=1441:1080:239:0"
+    ])
+    
+    def fake_run(cmd, **kwargs):
+        return subprocess.CompletedProcess(cmd, 0, "", f"[Parsed_cropdetect_0] x1:0 {next(detected)}\n")
+    
+    monkeypatch.setattr(frames, "traced_run", fake_run)
+    monkeypatch.setattr(FrameService, "get_video_info",
+                        staticmethod(lambda path: {"width": 1920, "height": 1080, "duration": 60.0}))
+    crop = FrameService.detect_crop(Path("video.mp4"), samples=4)
+    assert crop == {"width": 1442, "height": 1080, "x": 238, "y": 0, "source_width": 1920, "source_height": 1080}
+    assert FrameService._frame_filters(None, crop) == "crop=1442:1080:238:0,showinfo"
+    assert FrameService.pad_filter(crop) == "pad=w=iw*1920/1442:h=ih*1080/1080:x=iw*238/1442:y=ih*0/1080:color=black"
+    
+    # Bars too thin to be worth cropping
+    detected = iter(["crop=1920:1072:0:4"] * 4)
+    assert FrameService.detect_crop(Path("video.mp4"), samples=4) is None
+
+def test_progressive_hls_stream(tmp_path, monkeypatch):
+    """Test that segments are encoded once all of their frames are enhanced, and the stream endpoint"""
+    from app.services.merge import MergeService
+    from app.services.stream import SegmentEncoder
+    
+    encoded = []
+    
+    def fake_encode_segment(frames_dir, audio_file, segment_file, start_frame, frame_count, **kwargs):
+        encoded.append((start_frame, frame_count))
+        segment_file.parent.mkdir(parents=True, exist_ok=True)
+        segment_file.write_bytes(b"ts")
+        return True
+    
+    monkeypatch.setattr(MergeService, "encode_segment", staticmethod(fake_encode_segment))
+    encoder = SegmentEncoder(tmp_path, tmp_path / "audio.wav", tmp_path / "hls", frame_count=5, fps=2.0,
+                             segment_seconds=1.0)
+    encoder.start()
+    # Frame 0 is missing, so the first segment must wait for it
+    for index in (1, 2, 3):
+        encoder.frame_done(index)
+    assert encoded == []
+    encoder.frame_done(0)
+    assert encoder.finish()
+    assert encoded == [(1, 2), (3, 2), (5, 1)]
+    
+    playlist = (tmp_path / "hls" / "playlist.m3u8").read_text()
+    assert playlist.count("#EXTINF:1.000,") == 2 and "#EXTINF:0.500," in playlist
+    assert playlist.rstrip().endswith("#EXT-X-ENDLIST")
+    
+    response = client.get("/stream/nonexistent-job/playlist.m3u8")
+    assert response.status_code == 404
+    response = client.get("/stream/nonexistent-job/secrets.txt")
+    assert response.status_code == 404
+
+def test_vfr_hls_segments(tmp_path, monkeypatch):
+    """Test that the segments of a variable frame rate source take their timing from the frame manifest"""
+    from app.services import merge
+    from app.services.manifest import FrameManifest
+    from app.services.stream import SegmentEncoder
+    
+    # 5 frames at 2 fps nominal, with frames 2 and 3 held longer
+    pts = [10.0, 10.5, 11.5, 13.0, 13.5]
+    frames = [{"index": index, "pts": value, "checksum": None, "duplicate_of": None} for index, value in enumerate(pts)]
+    manifest = FrameManifest(frames, 64, 36, "png", 2.0)
+    commands = []
+    
+    def fake_run(cmd, **kwargs):
+        script = Path(cmd[cmd.index("concat") + 2])
+        commands.append((cmd, script.read_text()))
+        Path(cmd[-1]).write_bytes(b"ts")
+    
+    monkeypatch.setattr(merge, "traced_run", fake_run)
+    encoder = SegmentEncoder(tmp_path, tmp_path / "audio.wav", tmp_path / "hls", frame_count=5, fps=2.0,
+                             format="png", segment_seconds=1.0, manifest=manifest)
+    encoder.start()
+    for index in range(5):
+        encoder.frame_done(index)
+    assert encoder.finish()
+    
+    # Segments start at the manifest timestamps, relative to the first frame, and last as long as their frames
+    # (the last frame as long as a typical one, as in the merge)
+    timing = [(cmd[cmd.index("-ss") + 1], cmd[cmd.index("-t") + 1], cmd[cmd.index("-output_ts_offset") + 1])
+              for cmd, _ in commands]
+    assert timing == [("0.000000", "1.500000", "0.000000"), ("1.500000", "2.000000", "1.500000"),
+                      ("3.500000", "0.750000", "3.500000")]
+    assert all("vfr" in cmd for cmd, _ in commands)
+    assert "file 'frame_000003.png'\nduration 1.500000" in commands[1][1]
+    # The concat scripts are removed with their segment
+    assert not list(tmp_path.glob("*.ffconcat"))
+    playlist = (tmp_path / "hls" / "playlist.m3u8").read_text()
+    assert ["#EXTINF:1.500,", "#EXTINF:2.000,", "#EXTINF:0.750,"] == \
+        [line for line in playlist.splitlines() if line.startswith("#EXTINF")]
+
+def test_job_scheduler_preview_priority():
+    """Test that previews do not wait behind full jobs, and full jobs do not start while a preview runs"""
+    import threading
+    from app.scheduler import JobScheduler, PREVIEW, FULL
+    
+    started = []
+    events = {name: (threading.Event(), threading.Event()) for name in ("full-a", "preview", "full-b")}
+    
+    def job(name):
+        running, release = events[name]
+        started.append(name)
+        running.set()
+        release.wait(timeout=10)
+    
+    scheduler = JobScheduler(2)
+    scheduler.submit(FULL, job, "full-a")
+    assert events["full-a"][0].wait(timeout=5)
+    # The preview starts while full-a runs; full-b waits for the preview although a full job worker is idle
+    scheduler.submit(PREVIEW, job, "preview")
+    assert events["preview"][0].wait(timeout=5)
+    scheduler.submit(FULL, job, "full-b")
+    assert not events["full-b"][0].wait(timeout=0.3)
+    events["preview"][1].set()
+    assert events["full-b"][0].wait(timeout=5)
+    assert started == ["full-a", "preview", "full-b"]
+    events["full-a"][1].set()
+    events["full-b"][1].set()
+
+def test_job_scheduler_preview_flood():
+    """Test that previews submitted after a full job do not keep it from starting"""
+    import threading
+    from app.scheduler import JobScheduler, PREVIEW, FULL
+    
+    release, hold = threading.Event(), threading.Event()
+    full_started = threading.Event()
+    previews_started = []
+    
+    def preview(index):
+        previews_started.append(index)
+        # The later previews keep the preview worker busy until the end of the test
+        (release if index == 0 else hold).wait(timeout=10)
+    
+    scheduler = JobScheduler(1)
+    scheduler.submit(PREVIEW, preview, 0)
+    scheduler.submit(FULL, full_started.set)
+    for index in range(1, 20):
+        scheduler.submit(PREVIEW, preview, index)
+    # The full job waits for the preview submitted before it
+    assert not full_started.wait(timeout=0.3)
+    release.set()
+    assert full_started.wait(timeout=5)
+    assert previews_started == [0, 1]
+    hold.set()
+
+def test_cancel_queued_job(tmp_path, monkeypatch):
+    """Test that a cancelled job and its preview are dropped from the queue and never start"""
+    import threading
+    from app import metrics, routes, scheduler
+    
+    monkeypatch.setattr(routes, "PROCESSING_DIR", tmp_path / "processing")
+    monkeypatch.setattr(routes, "OUTPUT_DIR", tmp_path / "output")
+    job_scheduler = scheduler.JobScheduler(1)
+    monkeypatch.setattr(scheduler, "SCHEDULER", job_scheduler)
+    release = threading.Event()
+    
+    # Both workers are busy, so the pipelines of the job stay queued
+    job_scheduler.submit(scheduler.PREVIEW, release.wait, 10)
+    job_scheduler.submit(scheduler.FULL, release.wait, 10)
+    job_id, preview_job_id = "cancel-job", "cancel-preview"
+    input_file = routes.PROCESSING_DIR / job_id / "input.mp4"
+    for queued_id in (job_id, preview_job_id):
+        (routes.PROCESSING_DIR / queued_id).mkdir(parents=True)
+        routes.update_job_status(queued_id, "uploaded", 0, "Video uploaded successfully")
+    input_file.write_bytes(b"video")
+    routes.link_preview_job(job_id, preview_job_id)
+    job_scheduler.submit(scheduler.PREVIEW, routes.enhance_preview_pipeline, preview_job_id, input_file)
+    job_scheduler.submit(scheduler.FULL, routes.enhance_video_pipeline, job_id, input_file)
+    failed_before = metrics.JOBS_FINISHED.get(status="failed", kind="full")
+    
+    try:
+        response = client.delete(f"/job/{job_id}")
+        assert response.status_code == 200
+        assert job_scheduler.cancel(job_id) == 0 and job_scheduler.cancel(preview_job_id) == 0
+        
+        # A pipeline dequeued just before the job was cancelled returns without touching it
+        routes.enhance_video_pipeline(job_id, input_file)
+        release.set()
+        done = [threading.Event(), threading.Event()]
+        job_scheduler.submit(scheduler.PREVIEW, done[0].set)
+        job_scheduler.submit(scheduler.FULL, done[1].set)
+        assert done[0].wait(timeout=5) and done[1].wait(timeout=5)
+        
+        for cancelled_id in (job_id, preview_job_id):
+            assert routes.get_job_status_info(cancelled_id)["status"] == "cancelled"
+            assert not (routes.PROCESSING_DIR / cancelled_id).exists()
+            assert not (routes.OUTPUT_DIR / cancelled_id).exists()
+        assert metrics.JOBS_FINISHED.get(status="failed", kind="full") == failed_before
+    finally:
+        release.set()
+        with routes.JOB_LOCK:
+            routes.JOB_STATUS.pop(job_id, None)
+            routes.JOB_STATUS.pop(preview_job_id, None)
+
+def blocked_pipeline(tmp_path, monkeypatch):
+    """Fake the stages of a streamed 12 second job whose enhancement blocks after its first 6 seconds"""
+    import threading
+    from app import routes
+    from app.services.audio import AudioService
+    from app.services.frames import FrameService
+    from app.services.merge import MergeService
+    from app.services.clarity import ClarityService
+    
+    monkeypatch.setattr(routes, "PROCESSING_DIR", tmp_path / "processing")
+    monkeypatch.setattr(routes, "OUTPUT_DIR", tmp_path / "output")
+    video_info = {"width": 64, "height": 36, "fps": 2.0, "duration": 12.0, "frame_count": 24, "keyframes": []}
+    started, release = threading.Event(), threading.Event()
+    
+    def fake_encode(frames_dir, audio_file, output_file, *args, **kwargs):
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        output_file.write_bytes(b"video")
+        return True
+    
+    def fake_enhance(input_dir, output_dir, frame_callback=None, event_callback=None, progress_callback=None,
+                     **kwargs):
+        for index in range(12):
+            frame_callback(index)
+        progress_callback(50.0, 12, 0)
+        event_callback({"event": "tile", "index": 12, "frames": 24, "done": 3, "total": 8})
+        started.set()
+        release.wait(timeout=30)
+        for index in range(12, 24):
+            frame_callback(index)
+        progress_callback(100.0, 24, 0)
+        return True
+    
+    monkeypatch.setattr(FrameService, "get_video_info", staticmethod(lambda input_file: video_info))
+    monkeypatch.setattr(FrameService, "extract_frames", staticmethod(lambda *args, **kwargs: True))
+    monkeypatch.setattr(FrameService, "count_frames", staticmethod(lambda *args, **kwargs: 24))
+    monkeypatch.setattr(AudioService, "extract_audio", staticmethod(lambda *args, **kwargs: True))
+    monkeypatch.setattr(MergeService, "encode_segment", staticmethod(fake_encode))
+    monkeypatch.setattr(MergeService, "merge_frames_and_audio", staticmethod(fake_encode))
+    monkeypatch.setattr(ClarityService, "enhance_frames_batch", staticmethod(fake_enhance))
+    
+    job_id = "blocked-job"
+    (routes.PROCESSING_DIR / job_id).mkdir(parents=True)
+    input_file = tmp_path / "input.mp4"
+    input_file.write_bytes(b"video")
+    routes.update_job_status(job_id, "queued", 0, "Job queued")
+    return job_id, input_file, started, release
+
+async def run_blocked_pipeline(tmp_path, monkeypatch, check):
+    """Run the blocked pipeline as the endpoint would, and call check with a client once it blocks"""
+    import httpx
+    from app import routes
+    from app.scheduler import JobScheduler, FULL
+    
+    job_id, input_file, started, release = blocked_pipeline(tmp_path, monkeypatch)
+    finished = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    
+    def pipeline():
+        try:
+            routes.enhance_video_pipeline(job_id, input_file, "waifu2x", 2, optimize=False, stream=True, crop=False)
+        finally:
+            loop.call_soon_threadsafe(finished.set)
+    
+    JobScheduler(1).submit(FULL, pipeline)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as async_client:
+            for _ in range(200):
+                if started.is_set():
+                    break
+                await asyncio.sleep(0.05)
+            assert started.is_set()
+            await check(async_client, job_id)
+        assert not finished.is_set()
+    finally:
+        release.set()
+        await asyncio.wait_for(finished.wait(), timeout=30)
+        assert routes.get_job_status_info(job_id)["status"] == "completed"
+        with routes.JOB_LOCK:
+            routes.JOB_STATUS.pop(job_id, None)
+
+@pytest.mark.asyncio
+async def test_stream_served_while_enhancing(tmp_path, monkeypatch):
+    """Test that the pipeline leaves the event loop free, so the stream is served while frames are enhanced"""
+    async def check(async_client, job_id):
+        # The segment of the first 6 seconds is encoded in the background while the enhancement blocks
+        for _ in range(200):
+            response = await async_client.get(f"/stream/{job_id}/playlist.m3u8")
+            if response.status_code == 200 and "segment_" in response.text:
+                break
+            await asyncio.sleep(0.05)
+        assert response.status_code == 200
+        assert "#EXTINF:6.000," in response.text and "#EXT-X-ENDLIST" not in response.text
+    
+    await run_blocked_pipeline(tmp_path, monkeypatch, check)
+
+@pytest.mark.asyncio
+async def test_status_polled_mid_frame(tmp_path, monkeypatch):
+    """Test that the status shows the tile progress of the frame being enhanced while the job runs"""
+    async def check(async_client, job_id):
+        response = await async_client.get(f"/status/{job_id}")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "processing"
+        assert data["message"] == "Enhanced 12 frames, 0 failed; frame 13: tile 3/8"
+        assert data["progress"] == pytest.approx(30 + (12 + 3 / 8) / 24 * 50)
+    
+    await run_blocked_pipeline(tmp_path, monkeypatch, check)
+
 @pytest.mark.asyncio
 async def test_merge_service():
     """Test merge service initialization"""
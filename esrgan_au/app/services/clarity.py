@@ -109,7 +109,9 @@ class ClarityService:
                 "-o", str(output_dir),
                 "-s", str(scale),
                 "--fp32",
-                "--tile", "256"
+                "--tile", "256",
+                "--tile_pad", "4",
+                "--tile_blend"
             ]
             
             logger.info(f"Running Real-ESRGAN: {' '.join(cmd)}")
@@ -51,12 +51,14 @@ pip install -e .
 echo "Installing additional dependencies..."
 pip install opencv-python numpy Pillow
 
-# Check if model weights exist
-if [ -f "weights/RealESRGAN_x4plus_anime_6B.pth" ]; then
-    echo "Model weights found!"
+# Verify the model weights and register them for memory-mapped loading
+# (downloads weights/RealESRGAN_x4plus_anime_6B.pth if it is missing)
+echo "Registering model weights..."
+if python -m realesrgan.weights RealESRGAN_x4plus_anime_6B; then
+    echo "Model weights registered!"
 else
-    echo "Warning: Model weights not found at weights/RealESRGAN_x4plus_anime_6B.pth"
-    echo "Please download the weights manually"
+    echo "Warning: Could not register weights/RealESRGAN_x4plus_anime_6B.pth"
+    echo "Please download the weights manually and run: python -m realesrgan.weights weights/RealESRGAN_x4plus_anime_6B.pth"
 fi
 
 echo "Setup complete!"
@@ -1,19 +1,23 @@
 import argparse
-import cv2
+import contextlib
 import glob
+import json
 import os
+import queue
+import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
 
-from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan import MODEL_URLS, RealESRGANer, verify_sha256
+from realesrgan.utils import FrameStore, IOConsumer, PrefetchReader
+from realesrgan.archs.srvgg_arch import SRVGGNetCompactInference
 
 
 def main():
     """Inference demo for Real-ESRGAN.
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', type=str, default='inputs', help='Input image or folder')
+    parser.add_argument('-i', '--input', type=str, default='inputs', help='Input image, folder or frame store')
     parser.add_argument(
         '-n',
         '--model_name',
@@ -33,8 +37,33 @@ def main():
     parser.add_argument(
         '--model_path', type=str, default=None, help='[Option] Model path. Usually, you do not need to specify it')
     parser.add_argument('--suffix', type=str, default='out', help='Suffix of the restored image')
+    parser.add_argument(
+        '--output_store',
+        type=str,
+        default=None,
+        help=('Write the outputs into this frame store instead of image files. It must have the frames of the input '
+              'frame store at the output size'))
+    parser.add_argument(
+        '--frame_range',
+        type=str,
+        default=None,
+        help='start:end indices of the frames of an input frame store to process. Default: all frames')
+    parser.add_argument(
+        '--frame_list',
+        type=str,
+        default=None,
+        help='File with the indices of the frames of an input frame store to process, one per line. '
+        'Overrides --frame_range')
     parser.add_argument('-t', '--tile', type=int, default=0, help='Tile size, 0 for no tile during testing')
     parser.add_argument('--tile_pad', type=int, default=10, help='Tile padding')
+    parser.add_argument(
+        '--tile_blend',
+        action='store_true',
+        help='Blend overlapping tile borders instead of cropping them. Allows a smaller --tile_pad without seams')
+    parser.add_argument(
+        '--tile_reuse',
+        action='store_true',
+        help='Only re-run tiles that changed since the previous image. For folders of consecutive video frames')
     parser.add_argument('--pre_pad', type=int, default=0, help='Pre padding size at each border')
     parser.add_argument('--face_enhance', action='store_true', help='Use GFPGAN to enhance face')
     parser.add_argument(
@@ -49,40 +78,57 @@ def main():
         type=str,
         default='auto',
         help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
+    parser.add_argument(
+        '--num_prefetch_queue', type=int, default=4, help='Number of decoded images read ahead of the model')
+    parser.add_argument(
+        '--num_save_queue', type=int, default=8, help='Number of outputs that may wait for a writer before blocking')
+    parser.add_argument('--num_io_workers', type=int, default=4, help='Number of threads encoding and saving outputs')
+    parser.add_argument(
+        '--profile_dir', type=str, default=None, help='Write torch profiler traces of the first images to this folder')
+    parser.add_argument('--profile_frames', type=int, default=1, help='Number of images to trace with --profile_dir')
+    parser.add_argument(
+        '--progress',
+        type=str,
+        default='text',
+        choices=['text', 'json', 'none'],
+        help=('Progress output. text: one line per image | json: one JSON line per tile and per image, with the image '
+              'index and name, and the seconds per image | none'))
     parser.add_argument(
         '-g', '--gpu-id', type=int, default=None, help='gpu device to use (default=None) can be 0,1,2 for multi-gpu')
 
     args = parser.parse_args()
 
+    store = FrameStore(args.input) if FrameStore.is_store(args.input) else None
+    output_store = None
+    if args.output_store is not None:
+        if store is None:
+            parser.error('--output_store needs a frame store as --input')
+        if args.face_enhance:
+            parser.error('--output_store does not support --face_enhance')
+        output_store = FrameStore(args.output_store, writable=True)
+
     # determine models according to model names
     args.model_name = args.model_name.split('.')[0]
     if args.model_name == 'RealESRGAN_x4plus':  # x4 RRDBNet model
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
         netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth']
     elif args.model_name == 'RealESRNet_x4plus':  # x4 RRDBNet model
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
         netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth']
     elif args.model_name == 'RealESRGAN_x4plus_anime_6B':  # x4 RRDBNet model with 6 blocks
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
         netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth']
     elif args.model_name == 'RealESRGAN_x2plus':  # x2 RRDBNet model
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
         netscale = 2
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth']
     elif args.model_name == 'realesr-animevideov3':  # x4 VGG-style model (XS size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
         netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth']
     elif args.model_name == 'realesr-general-x4v3':  # x4 VGG-style model (S size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
         netscale = 4
-        file_url = [
-            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
-            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth'
-        ]
 
     # determine model paths
     if args.model_path is not None:
@@ -91,10 +137,11 @@ def main():
         model_path = os.path.join('weights', args.model_name + '.pth')
         if not os.path.isfile(model_path):
             ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-            for url in file_url:
+            for url in MODEL_URLS[args.model_name]:
                 # model_path will be updated
                 model_path = load_file_from_url(
                     url=url, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
+                verify_sha256(model_path)
 
     # use dni to control the denoise strength
     dni_weight = None
@@ -103,6 +150,14 @@ def main():
         model_path = [model_path, wdn_model_path]
         dni_weight = [args.denoise_strength, 1 - args.denoise_strength]
 
+    # progress events of the current image, as JSON lines on stdout
+    current = {}
+    progress_callback = None
+    if args.progress == 'json':
+
+        def progress_callback(event):
+            print(json.dumps({**event, **current}), flush=True)
+
     # restorer
     upsampler = RealESRGANer(
         scale=netscale,
@@ -111,9 +166,12 @@ def main():
         model=model,
         tile=args.tile,
         tile_pad=args.tile_pad,
+        tile_blend=args.tile_blend,
+        tile_reuse=args.tile_reuse,
         pre_pad=args.pre_pad,
         half=not args.fp32,
-        gpu_id=args.gpu_id)
+        gpu_id=args.gpu_id,
+        progress_callback=progress_callback)
 
     if args.face_enhance:  # Use GFPGAN for face enhancement
         from gfpgan import GFPGANer
@@ -125,41 +183,92 @@ def main():
             bg_upsampler=upsampler)
     os.makedirs(args.output, exist_ok=True)
 
-    if os.path.isfile(args.input):
-        paths = [args.input]
+    if store is not None:
+        # frames of a store are views of its mapping, so they are read by index without a reader thread
+        indices = range(len(store))
+        if args.frame_list is not None:
+            with open(args.frame_list) as f:
+                indices = [int(line) for line in f if line.strip()]
+        elif args.frame_range is not None:
+            start, end = (int(bound) for bound in args.frame_range.split(':'))
+            indices = range(start, end)
+        images = ((idx, f'frame_{idx + 1:06d}', '.png', store[idx]) for idx in indices)
     else:
-        paths = sorted(glob.glob(os.path.join(args.input, '*')))
+        if os.path.isfile(args.input):
+            paths = [args.input]
+        else:
+            paths = sorted(glob.glob(os.path.join(args.input, '*')))
 
-    for idx, path in enumerate(paths):
-        imgname, extension = os.path.splitext(os.path.basename(path))
-        print('Testing', idx, imgname)
+        # read, enhance and write in a pipeline: a reader thread decodes the next images while the model runs, and a
+        # pool of writer threads encodes and saves the outputs
+        reader = PrefetchReader(paths, num_prefetch_queue=args.num_prefetch_queue)
+        reader.start()
+        images = ((idx, *os.path.splitext(os.path.basename(path)), img)
+                  for idx, (path, img) in enumerate(zip(paths, reader)))
+    save_queue = queue.Queue(args.num_save_queue)
+    io_workers = [IOConsumer(args, save_queue, qid) for qid in range(args.num_io_workers)]
+    for worker in io_workers:
+        worker.start()
 
-        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-        if len(img.shape) == 3 and img.shape[2] == 4:
-            img_mode = 'RGBA'
-        else:
-            img_mode = None
+    try:
+        for idx, imgname, extension, img in images:
+            current.update(index=idx, name=imgname)
+            if args.progress == 'text':
+                print('Testing', idx, imgname)
 
-        try:
-            if args.face_enhance:
-                _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
-            else:
-                output, _ = upsampler.enhance(img, outscale=args.outscale)
-        except RuntimeError as error:
-            print('Error', error)
-            print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
-        else:
-            if args.ext == 'auto':
-                extension = extension[1:]
+            if img is None:
+                print('Error', f'cannot read {imgname}{extension}')
+                continue
+            if len(img.shape) == 3 and img.shape[2] == 4:
+                img_mode = 'RGBA'
             else:
-                extension = args.ext
-            if img_mode == 'RGBA':  # RGBA images should be saved in png format
-                extension = 'png'
-            if args.suffix == '':
-                save_path = os.path.join(args.output, f'{imgname}.{extension}')
+                img_mode = None
+
+            profiler = contextlib.nullcontext()
+            if args.profile_dir is not None and idx < args.profile_frames:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+
+            try:
+                with profiler as prof:
+                    if args.face_enhance:
+                        _, _, output = face_enhancer.enhance(
+                            img, has_aligned=False, only_center_face=False, paste_back=True)
+                    else:
+                        # outputs of a store are written into the output store as they are assembled
+                        out = output_store[idx] if output_store is not None else None
+                        output, _ = upsampler.enhance(img, outscale=args.outscale, out=out)
+                if prof is not None:
+                    os.makedirs(args.profile_dir, exist_ok=True)
+                    prof.export_chrome_trace(os.path.join(args.profile_dir, f'torch_trace_{imgname}.json'))
+            except RuntimeError as error:
+                print('Error', error)
+                print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
             else:
-                save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
-            cv2.imwrite(save_path, output)
+                if output_store is not None:
+                    continue
+                if args.ext == 'auto':
+                    extension = extension[1:]
+                else:
+                    extension = args.ext
+                if img_mode == 'RGBA':  # RGBA images should be saved in png format
+                    extension = 'png'
+                if args.suffix == '':
+                    save_path = os.path.join(args.output, f'{imgname}.{extension}')
+                else:
+                    save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
+                save_queue.put({'output': output, 'save_path': save_path})
+    finally:
+        # the workers are not daemons: they always get their quit message, also when enhancement fails, and the
+        # outputs already queued are saved before the process exits
+        for _ in io_workers:
+            save_queue.put('quit')
+        for worker in io_workers:
+            worker.join()
+    if output_store is not None:
+        output_store.flush()
 
 
 if __name__ == '__main__':
@@ -4,3 +4,4 @@ from .data import *
 from .models import *
 from .utils import *
 from .version import *
+from .weights import *
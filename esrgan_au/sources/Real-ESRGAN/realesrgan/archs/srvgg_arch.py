@@ -67,3 +67,37 @@ class SRVGGNetCompact(nn.Module):
         base = F.interpolate(x, scale_factor=self.upscale, mode='nearest')
         out += base
         return out
+
+
+@ARCH_REGISTRY.register()
+class SRVGGNetCompactInference(SRVGGNetCompact):
+    """Inference-only variant of SRVGGNetCompact, e.g. for real-time previews.
+
+    It has the same structure and parameters as SRVGGNetCompact and loads the same checkpoints, and its output is
+    numerically the same. The forward pass calls each conv directly followed by its activation (ReLU and LeakyReLU in
+    place), without going through the module call machinery for every layer. The nearest-upsampled residual is added
+    to the last conv output before the PixelShuffle, as an in-place broadcast of the input over the upscale * upscale
+    sub-pixel channels, so the upsampled base image is never materialized.
+
+    Args: See SRVGGNetCompact.
+    """
+
+    def forward(self, x):
+        out = x
+        for i in range(0, len(self.body) - 1, 2):
+            conv = self.body[i]
+            out = F.conv2d(out, conv.weight, conv.bias, padding=1)
+            if self.act_type == 'prelu':
+                out = F.prelu(out, self.body[i + 1].weight)
+            elif self.act_type == 'relu':
+                out = F.relu_(out)
+            elif self.act_type == 'leakyrelu':
+                out = F.leaky_relu_(out, negative_slope=0.1)
+
+        conv = self.body[-1]
+        out = F.conv2d(out, conv.weight, conv.bias, padding=1)
+        # channel c * upscale**2 + k of the last conv becomes sub-pixel k of output channel c after the PixelShuffle,
+        # where the nearest-upsampled base is x[:, c]
+        b, _, h, w = out.shape
+        out.view(b, self.num_out_ch, self.upscale * self.upscale, h, w).add_(x.unsqueeze(2))
+        return F.pixel_shuffle(out, self.upscale)
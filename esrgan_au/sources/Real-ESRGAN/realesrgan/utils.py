@@ -3,11 +3,15 @@ import math
 import numpy as np
 import os
 import queue
+import struct
 import threading
+import time
 import torch
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
+from .weights import WeightRegistry, verify_sha256
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
@@ -22,8 +26,23 @@ class RealESRGANer():
             input images into tiles, and then process each of them. Finally, they will be merged into one image.
             0 denotes for do not use tile. Default: 0.
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
+        tile_blend (bool): Blend the padded borders of neighbouring tiles with a feathered weight mask instead of
+            cropping them away. A much smaller tile_pad (about the receptive field radius of the model) is then
+            enough to hide the seams. Default: False.
+        tile_reuse (bool): Keep the padded input and the output of every tile, and only run tiles whose padded input
+            changed since the previous image through the network. Changed tiles of a tile row are batched. Meant for
+            consecutive video frames, where static backgrounds stay the same; only used with tile > 0. The cache holds
+            one full-resolution output in the model precision. Default: False.
+        tile_reuse_tol (float): Largest absolute difference of an input pixel in [0, 1] for which a tile still counts
+            as unchanged. Default: 2 / 255.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        weight_registry (WeightRegistry): Registry to load converted weights from, memory-mapped. Checkpoints that are
+            not registered are loaded as before. Default: None, which uses the registry in the ``weights`` folder.
+        progress_callback (callable): Called with a dict per progress event: ``{'event': 'tile', 'done', 'total',
+            'computed'}`` after each tile (after each tile row with tile_reuse; ``computed`` counts the tiles that
+            went through the network), and ``{'event': 'frame', 'seconds', 'height', 'width'}`` after each image
+            passed to ``enhance``. Default: None.
     """
 
     def __init__(self,
@@ -33,16 +52,31 @@ class RealESRGANer():
                  model=None,
                  tile=0,
                  tile_pad=10,
+                 tile_blend=False,
+                 tile_reuse=False,
+                 tile_reuse_tol=2 / 255.,
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 weight_registry=None,
+                 progress_callback=None):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
+        self.tile_blend = tile_blend
+        self.tile_reuse = tile_reuse
+        self.tile_reuse_tol = tile_reuse_tol
+        # per cache key: the padded image shape, and the input and output of each tile, keyed by (y, x)
+        self.tile_cache = {}
         self.pre_pad = pre_pad
         self.mod_scale = None
         self.half = half
+        # padded input buffer, reused across 8-bit images of the same size
+        self.input_buffer = None
+        # uint8 BGR(A) array that tile_process writes finished tiles into, if set
+        self.output_uint8 = None
+        self.progress_callback = progress_callback
 
         # initialize model
         if gpu_id:
@@ -51,23 +85,36 @@ class RealESRGANer():
         else:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
 
+        self.weight_registry = WeightRegistry() if weight_registry is None else weight_registry
+        mmapped = False
         if isinstance(model_path, list):
             # dni
             assert len(model_path) == len(dni_weight), 'model_path and dni_weight should have the save length.'
-            loadnet = self.dni(model_path[0], model_path[1], dni_weight)
+            loadnet, mmapped = self.weight_registry.dni(model_path[0], model_path[1], dni_weight)
         else:
             # if the model_path starts with https, it will first download models to the folder: weights
             if model_path.startswith('https://'):
-                model_path = load_file_from_url(
-                    url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
-            loadnet = torch.load(model_path, map_location=torch.device('cpu'))
+                registered_path = os.path.join(self.weight_registry.root, os.path.basename(model_path))
+                if self.weight_registry.lookup(registered_path) is not None:
+                    model_path = registered_path
+                else:
+                    model_path = load_file_from_url(
+                        url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
+                    verify_sha256(model_path)
+            loadnet, mmapped = self.weight_registry.load(model_path)
+            if loadnet is None:
+                loadnet = torch.load(model_path, map_location=torch.device('cpu'))
 
         # prefer to use params_ema
         if 'params_ema' in loadnet:
             keyname = 'params_ema'
         else:
             keyname = 'params'
-        model.load_state_dict(loadnet[keyname], strict=True)
+        if mmapped:
+            # keep the memory-mapped tensors as parameters, so that workers share them through the page cache
+            model.load_state_dict(loadnet[keyname], strict=True, assign=True)
+        else:
+            model.load_state_dict(loadnet[keyname], strict=True)
 
         model.eval()
         self.model = model.to(self.device)
@@ -78,12 +125,13 @@ class RealESRGANer():
         """Deep network interpolation.
 
         ``Paper: Deep Network Interpolation for Continuous Imagery Effect Transition``
+
+        The interpolated weights are cached by the weight registry, see :meth:`WeightRegistry.dni`.
         """
-        net_a = torch.load(net_a, map_location=torch.device(loc))
-        net_b = torch.load(net_b, map_location=torch.device(loc))
-        for k, v_a in net_a[key].items():
-            net_a[key][k] = dni_weight[0] * v_a + dni_weight[1] * net_b[key][k]
-        return net_a
+        loadnet, _ = self.weight_registry.dni(net_a, net_b, dni_weight, key=key)
+        if loc != 'cpu':
+            loadnet = {key: {k: v.to(loc) for k, v in loadnet[key].items()}}
+        return loadnet
 
     def pre_process(self, img):
         """Pre-process, such as pre-pad and mod pad, so that the images can be divisible
@@ -97,41 +145,120 @@ class RealESRGANer():
         if self.pre_pad != 0:
             self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
         # mod pad for divisible borders
+        _, _, h, w = self.img.size()
+        self.set_mod_pad(h, w)
+        if self.mod_scale is not None:
+            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+
+    def pre_process_uint8(self, img):
+        """Pre-process 8-bit BGR images without intermediate float copies in numpy.
+
+        The uint8 image is normalized and converted from BGR to RGB while it is copied into a padded input buffer,
+        and the pre pad and mod pad are reflected inside that buffer. The buffer is reused for images of the same size.
+        """
+        h, w = img.shape[0:2]
+        self.set_mod_pad(h + self.pre_pad, w + self.pre_pad)
+        mod_pad_h, mod_pad_w = (self.mod_pad_h, self.mod_pad_w) if self.mod_scale is not None else (0, 0)
+        shape = (1, 3, h + self.pre_pad + mod_pad_h, w + self.pre_pad + mod_pad_w)
+        dtype = torch.float16 if self.half else torch.float32
+        if self.input_buffer is None or tuple(self.input_buffer.shape) != shape or self.input_buffer.dtype != dtype:
+            self.input_buffer = torch.empty(shape, dtype=dtype, device=self.device)
+
+        src = torch.from_numpy(img).to(self.device)
+        for channel in range(3):
+            self.input_buffer[0, channel, :h, :w].copy_(src[:, :, 2 - channel])
+        self.input_buffer[:, :, :h, :w].div_(255.)
+
+        self._reflect_pad_(self.input_buffer, h, w, self.pre_pad, self.pre_pad)
+        self._reflect_pad_(self.input_buffer, h + self.pre_pad, w + self.pre_pad, mod_pad_h, mod_pad_w)
+        self.img = self.input_buffer
+
+    def set_mod_pad(self, h, w):
+        """Compute the mod pad that makes an (already pre-padded) image of size h x w divisible."""
         if self.scale == 2:
             self.mod_scale = 2
         elif self.scale == 1:
             self.mod_scale = 4
         if self.mod_scale is not None:
             self.mod_pad_h, self.mod_pad_w = 0, 0
-            _, _, h, w = self.img.size()
             if (h % self.mod_scale != 0):
                 self.mod_pad_h = (self.mod_scale - h % self.mod_scale)
             if (w % self.mod_scale != 0):
                 self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
-            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+
+    @staticmethod
+    def _reflect_pad_(buffer, h, w, pad_h, pad_w):
+        """Reflect buffer[..., :h, :w] into the pad_h rows below and pad_w columns right of it, in place.
+
+        Gives the same result as ``F.pad(x, (0, pad_w, 0, pad_h), 'reflect')``.
+        """
+        if pad_h > 0:
+            buffer[:, :, h:h + pad_h, :w].copy_(buffer[:, :, h - pad_h - 1:h - 1, :w].flip(2))
+        if pad_w > 0:
+            buffer[:, :, :h + pad_h, w:w + pad_w].copy_(buffer[:, :, :h + pad_h, w - pad_w - 1:w - 1].flip(3))
+
+    def _report(self, **event):
+        """Pass a progress event to ``progress_callback``, if set."""
+        if self.progress_callback is not None:
+            self.progress_callback(event)
 
     def process(self):
         # model inference
         self.output = self.model(self.img)
 
-    def tile_process(self):
+    def tile_process(self, reuse_key=None):
         """It will first crop input images to tiles, and then process each tile.
         Finally, all the processed tiles are merged into one images.
 
+        If reuse_key is given, tiles are taken from the tile cache of that key where their input did not change, see
+        ``tile_reuse``.
+
+        If ``self.output_uint8`` is set, finished tiles are converted to uint8 BGR and written straight into it, so no
+        full-resolution float output is kept. With tile_blend, only the band of rows that neighbouring tile rows still
+        blend into is kept in float.
+
         Modified from: https://github.com/ata4/esrgan-launcher
         """
         batch, channel, height, width = self.img.shape
         output_height = height * self.scale
         output_width = width * self.scale
         output_shape = (batch, channel, output_height, output_width)
+        streaming = self.output_uint8 is not None
 
-        # start with black image
-        self.output = self.img.new_zeros(output_shape)
+        if streaming:
+            self.output = None
+        else:
+            # start with black image
+            self.output = self.img.new_zeros(output_shape)
+        if self.tile_blend:
+            # blended output rows [acc_start, acc_start + acc.shape[2]) and their accumulated feather weights
+            acc_start = 0
+            if streaming:
+                acc = self.img.new_zeros((batch, channel, 0, output_width))
+                weight = self.img.new_zeros((1, 1, 0, output_width))
+            else:
+                acc = self.output
+                weight = self.img.new_zeros((1, 1, output_height, output_width))
         tiles_x = math.ceil(width / self.tile_size)
         tiles_y = math.ceil(height / self.tile_size)
+        computed = 0
+        if reuse_key is not None:
+            cache_shape, cached_tiles = self.tile_cache.get(reuse_key, (None, None))
+            if cache_shape != self.img.shape:
+                cached_tiles = {}
+                self.tile_cache[reuse_key] = (self.img.shape, cached_tiles)
 
         # loop over all tiles
         for y in range(tiles_y):
+            if self.tile_blend and streaming:
+                # make room for the padded rows of this tile row
+                rows = min((y + 1) * self.tile_size + self.tile_pad, height) * self.scale - acc_start
+                acc = torch.cat((acc, acc.new_zeros((batch, channel, rows - acc.shape[2], output_width))), dim=2)
+                weight = torch.cat((weight, weight.new_zeros((1, 1, rows - weight.shape[2], output_width))), dim=2)
+            if reuse_key is not None:
+                computed += self._update_tile_row(cached_tiles, y, tiles_x, width, height)
+                self._report(event='tile', done=(y + 1) * tiles_x, total=tiles_x * tiles_y, computed=computed)
+
             for x in range(tiles_x):
                 # extract tile from input image
                 ofs_x = x * self.tile_size
@@ -155,12 +282,16 @@ class RealESRGANer():
                 input_tile = self.img[:, :, input_start_y_pad:input_end_y_pad, input_start_x_pad:input_end_x_pad]
 
                 # upscale tile
-                try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
-                except RuntimeError as error:
-                    print('Error', error)
-                print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
+                if reuse_key is not None:
+                    output_tile = cached_tiles[(y, x)][1]
+                else:
+                    try:
+                        with torch.no_grad():
+                            output_tile = self.model(input_tile)
+                    except RuntimeError as error:
+                        print('Error', error)
+                    computed += 1
+                    self._report(event='tile', done=tile_idx, total=tiles_x * tiles_y, computed=computed)
 
                 # output tile area on total image
                 output_start_x = input_start_x * self.scale
@@ -174,10 +305,118 @@ class RealESRGANer():
                 output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
                 output_end_y_tile = output_start_y_tile + input_tile_height * self.scale
 
-                # put tile into output image
-                self.output[:, :, output_start_y:output_end_y,
-                            output_start_x:output_end_x] = output_tile[:, :, output_start_y_tile:output_end_y_tile,
-                                                                       output_start_x_tile:output_end_x_tile]
+                if self.tile_blend:
+                    # blend the whole padded tile, fading it out where it overlaps its neighbours
+                    mask_x = self._feather_weights(x, tiles_x, input_start_x, input_end_x, input_start_x_pad,
+                                                   input_end_x_pad, width)
+                    mask_y = self._feather_weights(y, tiles_y, input_start_y, input_end_y, input_start_y_pad,
+                                                   input_end_y_pad, height)
+                    mask = mask_y.view(1, 1, -1, 1) * mask_x.view(1, 1, 1, -1)
+                    acc_y = input_start_y_pad * self.scale - acc_start
+                    acc[:, :, acc_y:acc_y + output_tile.shape[2],
+                        input_start_x_pad * self.scale:input_end_x_pad * self.scale] += output_tile * mask
+                    weight[:, :, acc_y:acc_y + output_tile.shape[2],
+                           input_start_x_pad * self.scale:input_end_x_pad * self.scale] += mask
+                elif streaming:
+                    self.write_uint8(
+                        output_tile[:, :, output_start_y_tile:output_end_y_tile, output_start_x_tile:output_end_x_tile],
+                        output_start_y, output_start_x)
+                else:
+                    # put tile into output image
+                    self.output[:, :, output_start_y:output_end_y,
+                                output_start_x:output_end_x] = output_tile[:, :, output_start_y_tile:output_end_y_tile,
+                                                                           output_start_x_tile:output_end_x_tile]
+
+            if self.tile_blend and streaming:
+                # rows above the padded area of the next tile row will not change any more
+                if y < tiles_y - 1:
+                    done = max(min((y + 1) * self.tile_size - self.tile_pad, height) * self.scale, acc_start)
+                else:
+                    done = output_height
+                rows = done - acc_start
+                self.write_uint8(acc[:, :, :rows].div_(weight[:, :, :rows]), acc_start, 0)
+                acc, weight = acc[:, :, rows:], weight[:, :, rows:]
+                acc_start = done
+
+        if self.tile_blend and not streaming:
+            self.output.div_(weight)
+
+    def _tile_input_area(self, x, y, width, height):
+        """Padded input area (start_y, end_y, start_x, end_x) of tile (y, x) on the total image."""
+        start_x = max(x * self.tile_size - self.tile_pad, 0)
+        end_x = min((x + 1) * self.tile_size + self.tile_pad, width)
+        start_y = max(y * self.tile_size - self.tile_pad, 0)
+        end_y = min((y + 1) * self.tile_size + self.tile_pad, height)
+        return start_y, end_y, start_x, end_x
+
+    @torch.no_grad()
+    def _update_tile_row(self, cached_tiles, y, tiles_x, width, height):
+        """Run the tiles of tile row y whose padded input changed through the network, and cache them.
+
+        Tiles whose input differs from the cached input by at most ``tile_reuse_tol`` keep their cached output. The
+        changed tiles are batched, one batch per tile shape.
+
+        Returns:
+            int: The number of tiles that went through the network.
+        """
+        inputs = []
+        for x in range(tiles_x):
+            start_y, end_y, start_x, end_x = self._tile_input_area(x, y, width, height)
+            inputs.append(self.img[:, :, start_y:end_y, start_x:end_x])
+
+        # compare all cached tiles of the row at once, with a single device sync
+        candidates = [x for x in range(tiles_x) if (y, x) in cached_tiles]
+        unchanged = set()
+        if candidates:
+            diffs = torch.stack([(inputs[x] - cached_tiles[(y, x)][0]).abs_().amax() for x in candidates])
+            unchanged = {x for x, diff in zip(candidates, diffs.tolist()) if diff <= self.tile_reuse_tol}
+
+        changed = {}
+        for x in range(tiles_x):
+            if x not in unchanged:
+                changed.setdefault(inputs[x].shape, []).append(x)
+        for xs in changed.values():
+            output_tiles = self.model(torch.cat([inputs[x] for x in xs]))
+            for i, x in enumerate(xs):
+                cached_tiles[(y, x)] = (inputs[x].clone(), output_tiles[i:i + 1].clone())
+        return tiles_x - len(unchanged)
+
+    def write_uint8(self, tensor, y, x):
+        """Convert an RGB tensor in [0, 1] to uint8 BGR and write it into ``self.output_uint8`` at (y, x).
+
+        Parts that fall outside of ``self.output_uint8`` (the pre pad and mod pad area) are dropped.
+        """
+        out = self.output_uint8
+        h = min(tensor.shape[2], out.shape[0] - y)
+        w = min(tensor.shape[3], out.shape[1] - x)
+        if h <= 0 or w <= 0:
+            return
+        tile = tensor[0, :, :h, :w].float().clamp(0, 1).mul_(255.).round_().to(dtype=torch.uint8, device='cpu')
+        dst = torch.from_numpy(out[y:y + h, x:x + w])
+        for channel in range(3):
+            dst[:, :, channel].copy_(tile[2 - channel])
+
+    def _feather_weights(self, idx, num_tiles, start, end, start_pad, end_pad, size):
+        """Feather weights of a padded tile along one axis, in output pixels.
+
+        The weights follow a raised cosine across the area shared with the previous and the next tile, so that the
+        weights of two neighbouring tiles sum up to one there. Borders of the image are not feathered.
+        """
+        length = (end_pad - start_pad) * self.scale
+        weights = self.img.new_ones(length)
+        ramp_left = (min(start + self.tile_pad, size) - start_pad) * self.scale if idx > 0 else 0
+        ramp_right = (end_pad - max(end - self.tile_pad, 0)) * self.scale if idx < num_tiles - 1 else 0
+        if ramp_left > 0:
+            weights[:ramp_left] = torch.minimum(weights[:ramp_left], self._raised_cosine(ramp_left, weights))
+        if ramp_right > 0:
+            weights[length - ramp_right:] = torch.minimum(weights[length - ramp_right:],
+                                                          self._raised_cosine(ramp_right, weights).flip(0))
+        return weights
+
+    @staticmethod
+    def _raised_cosine(length, like):
+        steps = (torch.arange(length, device=like.device, dtype=torch.float32) + 0.5) / length
+        return torch.sin(steps * (math.pi / 2)).pow_(2).to(like.dtype)
 
     def post_process(self):
         # remove extra pad
@@ -191,67 +430,106 @@ class RealESRGANer():
         return self.output
 
     @torch.no_grad()
-    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
+    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan', out=None):
+        """Upsample an image.
+
+        Args:
+            img (ndarray): Input image in BGR(A) or gray order, read by cv2.
+            outscale (float): The final upsampling scale. Default: None, which means the network scale.
+            alpha_upsampler (str): The upsampler for the alpha channel. Options: realesrgan | bicubic.
+            out (ndarray | buffer): Optional preallocated uint8 output of shape (h * outscale, w * outscale, c) for
+                8-bit BGR(A) inputs. Any writable buffer (e.g. a memoryview) of that size is accepted. 8-bit BGR(A)
+                outputs are always assembled tile by tile in uint8, without a full-resolution float copy.
+
+        Returns:
+            tuple: The output image and the image mode (L | RGB | RGBA).
+        """
+        start_time = time.perf_counter()
         h_input, w_input = img.shape[0:2]
+        if out is not None and not (img.dtype == np.uint8 and len(img.shape) == 3):
+            raise ValueError('out is only supported for 8-bit BGR(A) images.')
         # img: numpy
-        img = img.astype(np.float32)
-        if np.max(img) > 256:  # 16-bit image
-            max_range = 65535
-            print('\tInput is a 16-bit image')
-        else:
+        if img.dtype == np.uint8 and len(img.shape) == 3:
+            # fast path for 8-bit BGR(A) frames: the bit depth comes from the dtype, and the normalization and the
+            # channel swap happen while the image is copied into the input buffer
             max_range = 255
-        img = img / max_range
-        if len(img.shape) == 2:  # gray image
-            img_mode = 'L'
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        elif img.shape[2] == 4:  # RGBA image with alpha channel
-            img_mode = 'RGBA'
-            alpha = img[:, :, 3]
-            img = img[:, :, 0:3]
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            if alpha_upsampler == 'realesrgan':
-                alpha = cv2.cvtColor(alpha, cv2.COLOR_GRAY2RGB)
+            if img.shape[2] == 4:  # RGBA image with alpha channel
+                img_mode = 'RGBA'
+                alpha = img[:, :, 3].astype(np.float32) / max_range
+            else:
+                img_mode = 'RGB'
+            self.pre_process_uint8(img[:, :, 0:3])
         else:
-            img_mode = 'RGB'
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            if img.dtype == np.uint16:
+                max_range = 65535
+            elif img.dtype == np.uint8:
+                max_range = 255
+            elif np.max(img) > 256:  # 16-bit image
+                max_range = 65535
+            else:
+                max_range = 255
+            if max_range == 65535:
+                print('\tInput is a 16-bit image')
+            img = img.astype(np.float32) / max_range
+            if len(img.shape) == 2:  # gray image
+                img_mode = 'L'
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+            elif img.shape[2] == 4:  # RGBA image with alpha channel
+                img_mode = 'RGBA'
+                alpha = img[:, :, 3]
+                img = img[:, :, 0:3]
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            else:
+                img_mode = 'RGB'
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            self.pre_process(img)
 
         # ------------------- process image (without the alpha channel) ------------------- #
-        self.pre_process(img)
-        if self.tile_size > 0:
-            self.tile_process()
+        stream_output = img.dtype == np.uint8 and img_mode != 'L'
+        if stream_output:
+            output_shape = (h_input * self.scale, w_input * self.scale, 4 if img_mode == 'RGBA' else 3)
+            if outscale is not None and outscale != float(self.scale):
+                output = np.empty(output_shape, dtype=np.uint8)
+            else:
+                output = self._get_output_array(out, output_shape)
+            self.output_uint8 = output
+            try:
+                if self.tile_size > 0:
+                    self.tile_process(reuse_key='image' if self.tile_reuse else None)
+                else:
+                    self.process()
+                    self.write_uint8(self.post_process(), 0, 0)
+            finally:
+                self.output_uint8 = None
+                self.output = None
         else:
-            self.process()
-        output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
-        if img_mode == 'L':
-            output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
+            if self.tile_size > 0:
+                self.tile_process(reuse_key='image' if self.tile_reuse else None)
+            else:
+                self.process()
+            output_img = self.post_process()
+            output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+            output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+            if img_mode == 'L':
+                output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
 
         # ------------------- process the alpha channel if necessary ------------------- #
         if img_mode == 'RGBA':
-            if alpha_upsampler == 'realesrgan':
-                self.pre_process(alpha)
-                if self.tile_size > 0:
-                    self.tile_process()
-                else:
-                    self.process()
-                output_alpha = self.post_process()
-                output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-                output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
-                output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
-            else:  # use the cv2 resize for alpha channel
-                h, w = alpha.shape[0:2]
-                output_alpha = cv2.resize(alpha, (w * self.scale, h * self.scale), interpolation=cv2.INTER_LINEAR)
+            output_alpha = self.upsample_alpha(alpha, alpha_upsampler)
 
             # merge the alpha channel
-            output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2BGRA)
-            output_img[:, :, 3] = output_alpha
+            if stream_output:
+                output[:, :, 3] = (output_alpha * 255.0).round()
+            else:
+                output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2BGRA)
+                output_img[:, :, 3] = output_alpha
 
         # ------------------------------ return ------------------------------ #
-        if max_range == 65535:  # 16-bit image
-            output = (output_img * 65535.0).round().astype(np.uint16)
-        else:
-            output = (output_img * 255.0).round().astype(np.uint8)
+        if not stream_output:
+            if max_range == 65535:  # 16-bit image
+                output = (output_img * 65535.0).round().astype(np.uint16)
+            else:
+                output = (output_img * 255.0).round().astype(np.uint8)
 
         if outscale is not None and outscale != float(self.scale):
             output = cv2.resize(
@@ -259,20 +537,75 @@ class RealESRGANer():
                     int(w_input * outscale),
                     int(h_input * outscale),
                 ), interpolation=cv2.INTER_LANCZOS4)
+            if out is not None:
+                resized, output = output, self._get_output_array(out, output.shape)
+                output[...] = resized
 
+        self._report(event='frame', seconds=time.perf_counter() - start_time, height=h_input, width=w_input)
         return output, img_mode
 
+    def upsample_alpha(self, alpha, alpha_upsampler='realesrgan'):
+        """Upsample an alpha channel in [0, 1] by the network scale.
+
+        The network only runs on alpha with intermediate levels. Constant alpha (e.g. fully opaque video frames) is
+        filled directly, and binary masks are resized linearly and then sharpened back to a one pixel wide transition
+        between their two levels.
+        """
+        h, w = alpha.shape[0:2]
+        low, high = cv2.minMaxLoc(alpha)[0:2]
+        if low == high:
+            return np.full((h * self.scale, w * self.scale), low, dtype=alpha.dtype)
+        binary = np.count_nonzero((alpha != low) & (alpha != high)) == 0
+
+        if alpha_upsampler == 'realesrgan' and not binary:
+            self.pre_process(cv2.cvtColor(alpha, cv2.COLOR_GRAY2RGB))
+            if self.tile_size > 0:
+                self.tile_process(reuse_key='alpha' if self.tile_reuse else None)
+            else:
+                self.process()
+            output_alpha = self.post_process()
+            output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+            output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
+            return cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
+
+        # use the cv2 resize for alpha channel
+        output_alpha = cv2.resize(alpha, (w * self.scale, h * self.scale), interpolation=cv2.INTER_LINEAR)
+        if alpha_upsampler == 'realesrgan':
+            # the linear ramp across a mask edge is self.scale pixels wide; steepen it to one pixel
+            edge = (output_alpha - low) / (high - low)
+            edge = np.clip((edge - 0.5) * self.scale + 0.5, 0, 1, out=edge)
+            output_alpha = low + edge * (high - low)
+        return output_alpha
+
+    @staticmethod
+    def _get_output_array(out, shape):
+        """Return ``out`` as a uint8 array of the given shape, or a new array if ``out`` is None."""
+        if out is None:
+            return np.empty(shape, dtype=np.uint8)
+        if not isinstance(out, np.ndarray):
+            out = np.frombuffer(out, dtype=np.uint8)
+            if out.size != np.prod(shape):
+                raise ValueError(f'out has {out.size} bytes, expected {np.prod(shape)}.')
+            out = out.reshape(shape)
+        if out.shape != tuple(shape) or out.dtype != np.uint8:
+            raise ValueError(f'out must be a uint8 array of shape {tuple(shape)}, got {out.dtype} {out.shape}.')
+        return out
+
 
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
+    Images that cannot be read are yielded as None, in order with the image list.
+
     Args:
         img_list (list[str]): A image list of image paths to be read.
         num_prefetch_queue (int): Number of prefetch queue.
     """
 
+    _end = object()
+
     def __init__(self, img_list, num_prefetch_queue):
-        super().__init__()
+        super().__init__(daemon=True)
         self.que = queue.Queue(num_prefetch_queue)
         self.img_list = img_list
 
@@ -281,11 +614,11 @@ class PrefetchReader(threading.Thread):
             img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
             self.que.put(img)
 
-        self.que.put(None)
+        self.que.put(self._end)
 
     def __next__(self):
         next_item = self.que.get()
-        if next_item is None:
+        if next_item is self._end:
             raise StopIteration
         return next_item
 
@@ -309,5 +642,62 @@ class IOConsumer(threading.Thread):
 
             output = msg['output']
             save_path = msg['save_path']
-            cv2.imwrite(save_path, output)
+            # a failed save is reported and the worker keeps consuming: a dead worker would leave the bounded
+            # queue full and block the producer forever
+            try:
+                if not cv2.imwrite(save_path, output):
+                    print('Error', f'IO worker {self.qid} cannot write {save_path}')
+            except Exception as error:
+                print('Error', f'IO worker {self.qid} cannot save {save_path}: {error}')
         print(f'IO worker {self.qid} is done.')
+
+
+class FrameStore():
+    """Memory-mapped store of same-sized 8-bit BGR frames in a single file.
+
+    The file is a 4096-byte header (magic, version, frame count, height, width, channels) followed by the frames as
+    one uint8 array of shape (count, height, width, channels), so frames are read and written by index as views of
+    the mapping, without decoding or encoding images. This is the frame store layout of the anime upscaler service
+    (app/framestore.py), which creates the stores.
+
+    Args:
+        path (str): Path of an existing store.
+        writable (bool): Map the frames for writing. Default: False.
+    """
+
+    MAGIC = b'AUFRAMES'
+    VERSION = 1
+    HEADER_SIZE = 4096
+    _header = struct.Struct('<8sIQIII')
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, count, height, width, channels = self._header.unpack(f.read(self._header.size))
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f'{path} is not a frame store.')
+        # read-only stores are mapped copy-on-write: reads still come straight from the page cache, and torch can wrap
+        # the frames without warning about read-only arrays
+        self.frames = np.memmap(
+            path,
+            dtype=np.uint8,
+            mode='r+' if writable else 'c',
+            offset=self.HEADER_SIZE,
+            shape=(count, height, width, channels))
+
+    @classmethod
+    def is_store(cls, path):
+        """Whether a path is a frame store file."""
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def flush(self):
+        self.frames.flush()
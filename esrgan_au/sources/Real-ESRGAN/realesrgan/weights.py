@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import json
+import os
+import torch
+from basicsr.utils.download_util import load_file_from_url
+
+__all__ = ['MODEL_URLS', 'MODEL_SHA256', 'WeightRegistry', 'verify_sha256']
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODEL_URLS = {
+    'RealESRGAN_x4plus': ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth'],
+    'RealESRNet_x4plus': ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth'],
+    'RealESRGAN_x4plus_anime_6B':
+    ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth'],
+    'RealESRGAN_x2plus': ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth'],
+    'realesr-animevideov3':
+    ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth'],
+    'realesr-general-x4v3': [
+        'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
+        'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth'
+    ],
+}
+
+# sha256 of the published checkpoints, by file name. Downloads and registrations of these files are refused when
+# their checksum differs; files without a pin are registered with the checksum they have, and reported as unpinned.
+MODEL_SHA256 = {
+    'RealESRGAN_x4plus.pth': '4fa0d38905f75ac06eb49a7951b426670021be3018265fd191d2125df9d682f1',
+    'RealESRGAN_x4plus_anime_6B.pth': 'f872d837d3c90ed2e05227bed711af5671a6fd1c9f7d7e91c911a61f155e99da',
+    'RealESRGAN_x2plus.pth': '49fafd45f8fd7aa8d31ab2a22d14d91b536c34494a5cfe31eb5d89c2fa266abb',
+    'realesr-animevideov3.pth': 'b8a8376811077954d82ca3fcf476f1ac3da3e8a68a4f4d71363008000a18b75d',
+    'realesr-general-x4v3.pth': '8dc7edb9ac80ccdc30c3a5dca6616509367f05fbc184ad95b731f05bece96292',
+}
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def verify_sha256(path, sha256=None):
+    """Check the sha256 of a checkpoint against an expected value, or against its pin in MODEL_SHA256.
+
+    Args:
+        path (str): Path to the checkpoint.
+        sha256 (str): Expected sha256 (or a prefix of it). Default: None, which uses the pin of the file name.
+
+    Returns:
+        str: The sha256 of the checkpoint.
+
+    Raises:
+        ValueError: If the checksum differs.
+    """
+    expected = sha256 or MODEL_SHA256.get(os.path.basename(path))
+    digest = file_sha256(path)
+    if expected is not None and not digest.startswith(expected.lower()):
+        raise ValueError(f'Checksum mismatch for {path}: expected {expected}, got {digest}.')
+    return digest
+
+
+def load_mmap(path):
+    """Load a checkpoint with its tensors memory-mapped from the file.
+
+    Processes that map the same file share one copy of the weights in the page cache. Falls back to a normal load on
+    torch versions without mmap support.
+    """
+    try:
+        return torch.load(path, map_location=torch.device('cpu'), mmap=True, weights_only=True), True
+    except TypeError:
+        return torch.load(path, map_location=torch.device('cpu')), False
+
+
+class WeightRegistry():
+    """A local registry of model weights shared by inference workers.
+
+    Registering a checkpoint verifies its sha256 once and converts it to a plain state dict saved in torch's zip
+    format, which can be loaded memory-mapped. Workers then resolve their model path to the converted file instead of
+    unpickling the original checkpoint into private memory. The registry is populated offline with::
+
+        python -m realesrgan.weights RealESRGAN_x4plus_anime_6B realesr-animevideov3
+
+    Args:
+        root (str): Directory holding the weights and the registry manifest. Default: ``weights`` in the Real-ESRGAN
+            root directory.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(ROOT_DIR, 'weights')
+        self.manifest_path = os.path.join(self.root, 'registry.json')
+
+    def _load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def fetch(self, name_or_url, sha256=None):
+        """Download (if needed) and register the weights of a model name from MODEL_URLS, or of a single url.
+
+        Each checkpoint is verified against sha256 (single url only) or its pin in MODEL_SHA256.
+
+        Returns:
+            list[str]: Paths of the registered checkpoints.
+        """
+        urls = MODEL_URLS.get(name_or_url, [name_or_url])
+        paths = []
+        for url in urls:
+            path = os.path.join(self.root, os.path.basename(url))
+            expected = (sha256 if len(urls) == 1 else None) or MODEL_SHA256.get(os.path.basename(url))
+            entry = self.lookup(path)
+            if entry is None or (expected is not None and not entry['sha256'].startswith(expected.lower())):
+                if not os.path.isfile(path):
+                    path = load_file_from_url(url=url, model_dir=self.root, progress=True, file_name=None)
+                self.register(path, sha256=expected)
+            paths.append(path)
+        return paths
+
+    def register(self, model_path, sha256=None):
+        """Verify a checkpoint and convert it to the memory-mappable format.
+
+        Args:
+            model_path (str): Path to the original checkpoint.
+            sha256 (str): Expected sha256 (or a prefix of it). Default: None, which checks the pin of the file name in
+                MODEL_SHA256, and records the current checksum of files without a pin.
+
+        Returns:
+            dict: The manifest entry of the checkpoint.
+        """
+        model_path = os.path.abspath(model_path)
+        digest = verify_sha256(model_path, sha256)
+
+        loadnet = torch.load(model_path, map_location=torch.device('cpu'))
+        keyname = 'params_ema' if 'params_ema' in loadnet else 'params'
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        converted_path = os.path.join(self.root, f'{name}.{digest[:8]}.mmap.pth')
+        os.makedirs(self.root, exist_ok=True)
+        torch.save({keyname: {k: v.contiguous() for k, v in loadnet[keyname].items()}}, converted_path)
+
+        stat = os.stat(model_path)
+        entry = {
+            'source': model_path,
+            'sha256': digest,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'converted': converted_path,
+            'converted_size': os.path.getsize(converted_path),
+            'pinned': sha256 is not None or os.path.basename(model_path) in MODEL_SHA256,
+        }
+        manifest = self._load_manifest()
+        manifest[name] = entry
+        self._save_manifest(manifest)
+        return entry
+
+    def lookup(self, model_path):
+        """Return the manifest entry of a registered checkpoint, or None if it is unknown or changed since."""
+        model_path = os.path.abspath(model_path)
+        entry = self._load_manifest().get(os.path.splitext(os.path.basename(model_path))[0])
+        if entry is None or entry['source'] != model_path or not os.path.isfile(model_path):
+            return None
+        stat = os.stat(model_path)
+        if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+            return None
+        if not os.path.isfile(entry['converted']) or os.path.getsize(entry['converted']) != entry['converted_size']:
+            return None
+        return entry
+
+    def checksum(self, model_path):
+        """sha256 of a checkpoint, taken from the manifest if it is registered and computed otherwise."""
+        entry = self.lookup(model_path)
+        if entry is not None:
+            return entry['sha256']
+        return file_sha256(model_path)
+
+    def dni(self, net_a, net_b, dni_weight, key='params'):
+        """Deep network interpolation of two checkpoints, cached on disk.
+
+        The interpolated checkpoint is keyed by the checksums of both checkpoints and by dni_weight, so that repeated
+        jobs with the same denoise strength load one precomputed, memory-mapped checkpoint. There is no in-memory
+        cache: the service starts one inference process per run, which loads each checkpoint once.
+
+        Returns:
+            tuple: The interpolated checkpoint and whether its tensors are memory-mapped.
+        """
+        weights = tuple(float(w) for w in dni_weight)
+        cache_key = (self.checksum(net_a), self.checksum(net_b), weights, key)
+        name = hashlib.sha256(repr(cache_key).encode()).hexdigest()[:16]
+        dni_path = os.path.join(self.root, 'dni', f'dni.{name}.mmap.pth')
+        if not os.path.isfile(dni_path):
+            loadnet_a = torch.load(net_a, map_location=torch.device('cpu'))
+            loadnet_b = torch.load(net_b, map_location=torch.device('cpu'))
+            for k, v_a in loadnet_a[key].items():
+                loadnet_a[key][k] = weights[0] * v_a + weights[1] * loadnet_b[key][k]
+            os.makedirs(os.path.dirname(dni_path), exist_ok=True)
+            tmp_path = f'{dni_path}.{os.getpid()}.tmp'
+            torch.save({key: loadnet_a[key]}, tmp_path)
+            os.replace(tmp_path, dni_path)
+
+        return load_mmap(dni_path)
+
+    def load(self, model_path):
+        """Load a registered checkpoint memory-mapped.
+
+        Returns:
+            tuple: The checkpoint and whether its tensors are memory-mapped, or (None, False) if the checkpoint is not
+                registered.
+        """
+        entry = self.lookup(model_path)
+        if entry is None:
+            return None, False
+        return load_mmap(entry['converted'])
+
+
+def main():
+    """Populate the weight registry ahead of time, so that workers neither download nor convert weights."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'models', nargs='*', help=f'Model names ({" | ".join(MODEL_URLS)}), urls or local checkpoint paths')
+    parser.add_argument('--all', action='store_true', help='Fetch all known models')
+    parser.add_argument('--root', type=str, default=None, help='Registry directory. Default: weights')
+    parser.add_argument(
+        '--sha256', type=str, default=None, help='Expected checksum, for a single model. Default: the pinned checksum')
+    args = parser.parse_args()
+
+    registry = WeightRegistry(args.root)
+    models = list(MODEL_URLS) if args.all else args.models
+    for model in models:
+        if os.path.isfile(model):
+            entries = [registry.register(model, sha256=args.sha256)]
+        else:
+            entries = [registry.lookup(path) for path in registry.fetch(model, sha256=args.sha256)]
+        for entry in entries:
+            pinned = '' if entry.get('pinned') else '  (unpinned)'
+            print(f'{entry["sha256"][:8]}  {entry["converted"]}{pinned}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact, SRVGGNetCompactInference
+
+
+@pytest.mark.parametrize('act_type', ['prelu', 'relu', 'leakyrelu'])
+@pytest.mark.parametrize('upscale', [2, 4])
+def test_srvggnet_compact_inference(act_type, upscale):
+    torch.manual_seed(0)
+    model = SRVGGNetCompact(num_feat=8, num_conv=3, upscale=upscale, act_type=act_type).eval()
+    if act_type == 'prelu':
+        # random slopes, so that a wrong activation weight would show in the output
+        for module in model.body:
+            if isinstance(module, torch.nn.PReLU):
+                torch.nn.init.uniform_(module.weight, -0.5, 0.5)
+    inference_model = SRVGGNetCompactInference(num_feat=8, num_conv=3, upscale=upscale, act_type=act_type).eval()
+    inference_model.load_state_dict(model.state_dict())
+
+    x = torch.rand(2, 3, 12, 10)
+    with torch.no_grad():
+        expected = model(x.clone())
+        output = inference_model(x.clone())
+    assert output.shape == (2, 3, 12 * upscale, 10 * upscale)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
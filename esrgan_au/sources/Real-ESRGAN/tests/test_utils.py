@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.utils import RealESRGANer
+from realesrgan.weights import WeightRegistry
+
+
+def build_upsampler(tmp_path, **kwargs):
+    """A 2x upsampler with a small random network and 16 px tiles, and the list of its progress events."""
+    torch.manual_seed(0)
+    model = SRVGGNetCompact(num_feat=8, num_conv=2, upscale=2)
+    model_path = str(tmp_path / 'model.pth')
+    torch.save({'params': model.state_dict()}, model_path)
+    events = []
+    upsampler = RealESRGANer(
+        scale=2,
+        model_path=model_path,
+        model=model,
+        tile=16,
+        tile_pad=4,
+        pre_pad=0,
+        weight_registry=WeightRegistry(str(tmp_path / 'weights')),
+        progress_callback=events.append,
+        **kwargs)
+    return upsampler, events
+
+
+def computed_tiles(events):
+    """Number of tiles that went through the network for the last image."""
+    tile_events = [event for event in events if event['event'] == 'tile']
+    return tile_events[-1]['computed']
+
+
+def test_tile_reuse(tmp_path):
+    upsampler, events = build_upsampler(tmp_path, tile_reuse=True)
+    reference, _ = build_upsampler(tmp_path)
+    batches = []
+    upsampler.model.register_forward_hook(lambda module, inputs, output: batches.append(inputs[0].shape[0]))
+    # 48 x 64 pixels: 3 rows of 4 tiles
+    frame = np.random.default_rng(0).integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+    upsampler.enhance(frame)
+    assert computed_tiles(events) == 12
+    # a repeated frame takes every tile from the cache
+    batches.clear()
+    output, _ = upsampler.enhance(frame.copy())
+    assert computed_tiles(events) == 0
+    assert batches == []
+    np.testing.assert_array_equal(output, reference.enhance(frame)[0])
+
+    # a local change inside the padded areas of tiles 1 and 2 of the first row recomputes only those two tiles,
+    # which have the same shape and go through the network as one batch
+    changed = frame.copy()
+    changed[2:6, 30:34] = 255 - changed[2:6, 30:34]
+    batches.clear()
+    output, _ = upsampler.enhance(changed)
+    assert computed_tiles(events) == 2
+    assert batches == [2]
+    assert np.abs(output.astype(int) - reference.enhance(changed)[0].astype(int)).max() <= 1
+
+
+def test_tile_reuse_tolerance(tmp_path):
+    frame = np.random.default_rng(0).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+    # a change of 1 / 255 everywhere is within the default tolerance of 2 / 255
+    upsampler, events = build_upsampler(tmp_path, tile_reuse=True)
+    upsampler.enhance(frame)
+    upsampler.enhance(frame + 1)
+    assert computed_tiles(events) == 0
+
+    upsampler, events = build_upsampler(tmp_path, tile_reuse=True, tile_reuse_tol=0)
+    upsampler.enhance(frame)
+    upsampler.enhance(frame + 1)
+    assert computed_tiles(events) == 12
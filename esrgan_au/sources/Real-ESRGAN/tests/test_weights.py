@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from realesrgan.weights import WeightRegistry, file_sha256
+
+
+def test_register_checks_pinned_sha256(tmp_path):
+    registry = WeightRegistry(str(tmp_path / 'weights'))
+    # a file with the name of a published checkpoint, but other contents
+    fake_path = str(tmp_path / 'RealESRGAN_x2plus.pth')
+    torch.save({'params': {'weight': torch.ones(2)}}, fake_path)
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        registry.register(fake_path)
+
+    # files without a pin are registered with their checksum and reported as unpinned
+    custom_path = str(tmp_path / 'custom.pth')
+    torch.save({'params': {'weight': torch.ones(2)}}, custom_path)
+    entry = registry.register(custom_path)
+    assert entry['sha256'] == file_sha256(custom_path)
+    assert not entry['pinned']
+    assert registry.register(custom_path, sha256=entry['sha256'][:8])['pinned']
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        registry.register(custom_path, sha256='0' * 64)